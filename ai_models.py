@@ -1,226 +1,500 @@
-from openai import OpenAI
-from azure.ai.inference import ChatCompletionsClient
-from azure.ai.inference.models import SystemMessage as AzureSystemMessage, UserMessage as AzureUserMessage
-from azure.core.credentials import AzureKeyCredential
-from mistralai import Mistral, UserMessage, SystemMessage
+import os
+import time
+import asyncio
+import socket
 
-# Factory functions to create model function with API keys
-def create_openAIo3(token):
-    def openAIo3(prompt):
-        if not token:
-            return "API key not provided. Please enter your GitHub token in the settings."
-            
-        endpoint = "https://models.github.ai/inference"
-        model_name = "openai/o3"
-
-        client = OpenAI(
-            base_url=endpoint,
-            api_key=token,
-        )
-
-        response = client.chat.completions.create(
-            messages=[
-                {
-                    "role": "developer",
-                    "content": "You are a helpful assistant.",
-                },
-                {
-                    "role": "user",
-                    "content": prompt,
-                }
-            ],
-            model=model_name
-        )    
-        return response.choices[0].message.content
-    return openAIo3
+from conversations import estimate_tokens
+from client_pool import POOL, KEEPALIVE_CONNECTIONS, KEEPALIVE_EXPIRY_SECONDS
+from model_registry import MODEL_SPECS, SYSTEM_PROMPT, SDK_OPENAI, SDK_AZURE, SDK_MISTRAL
+from rate_limits import RATE_LIMITS
+from response_cache import RESPONSE_CACHE, cache_key
+from tracing import CURRENT_CALL, httpx_request_hook, async_httpx_request_hook
+from usage import USAGE
 
-def create_openAIo4preview(token):
-    def openAIo4preview(prompt):
-        if not token:
-            return "API key not provided. Please enter your GitHub token in the settings."
-            
-        endpoint = "https://models.github.ai/inference"
-        model_name = "openai/o4-mini"
-
-        client = OpenAI(
-            base_url=endpoint,
-            api_key=token,
-        )
-
-        response = client.chat.completions.create(
-            messages=[
-                {
-                    "role": "developer",
-                    "content": "You are a helpful assistant.",
-                },
-                {
-                    "role": "user",
-                    "content": prompt,
-                }
-            ],
-            model=model_name
-        )
+# The provider SDKs (and httpx) are imported inside the functions that build clients,
+# so a process only pays for the SDKs of the providers it actually calls
 
-        return response.choices[0].message.content
-    return openAIo4preview
+# Connect deadline for every provider; time to first token and the total are enforced
+# per model by whoever schedules the call (see latency.py)
+CONNECT_TIMEOUT_SECONDS = float(os.getenv('CONNECT_TIMEOUT_SECONDS', '5'))
 
-def create_chatgpt41(token):
-    def chatgpt41(prompt):
-        if not token:
-            return "API key not provided. Please enter your GitHub token in the settings."
-            
-        endpoint = "https://models.github.ai/inference"
-        model_name = "openai/gpt-4.1"
-
-        client = OpenAI(
-            base_url=endpoint,
-            api_key=token,
-        )
-
-        response = client.chat.completions.create(
-            messages=[
-                {
-                    "role": "system",
-                    "content": "You are a helpful assistant.",
-                },
-                {
-                    "role": "user",
-                    "content": prompt,
-                }
-            ],
-            temperature=1.0,
-            top_p=1.0,
-            max_tokens=1024,
-            model=model_name
-        )
+# Ask OpenAI-compatible endpoints for token usage at the end of a stream (for the
+# tokens/s metrics); off by default since not every endpoint accepts stream_options
+STREAM_USAGE = os.getenv('STREAM_USAGE', 'false').lower() == 'true'
 
-        return response.choices[0].message.content
-    return chatgpt41
+MISSING_GITHUB_TOKEN = "API key not provided. Please enter your GitHub token in the settings."
+MISSING_NVIDIA_KEY = "API key not provided. Please enter your Nvidia API key in the settings."
 
-def create_phi4(token):
-    def phi4(prompt):
-        if not token:
-            return "API key not provided. Please enter your GitHub token in the settings."
-            
-        endpoint = "https://models.inference.ai.azure.com"
-        model_name = "Phi-4"
-            
-        client = ChatCompletionsClient(
-        endpoint=endpoint,
-        credential=AzureKeyCredential(token),
-        )
-
-        response = client.complete(
-        messages=[
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.7,
-            top_p=0.8,
-            max_tokens=1024,
-            model=model_name
-        )
+# Retries are done by rate_limits.py, which knows the call's deadline and shares what
+# it learns per key, so the SDKs' own retries are turned off. Every response is shown
+# to the rate limiter through a hook; an endpoint only ever serves one provider, so the
+# hooks of a pooled client are bound to that provider and key.
+def _observer(provider, token):
+    def observe(status, headers):
+        RATE_LIMITS.observe(provider, token, status, headers)
+    return observe
+
+def _httpx_hooks(provider, token):
+    observe = _observer(provider, token)
+    return {'request': [httpx_request_hook],
+            'response': [lambda response: observe(response.status_code, response.headers)]}
+
+def _async_httpx_hooks(provider, token):
+    observe = _observer(provider, token)
+    async def hook(response):
+        observe(response.status_code, response.headers)
+    return {'request': [async_httpx_request_hook], 'response': [hook]}
+
+def _azure_hook(provider, token):
+    observe = _observer(provider, token)
+    return lambda pipeline_response: observe(pipeline_response.http_response.status_code,
+                                             pipeline_response.http_response.headers)
+
+# Pooled clients: one per (provider, endpoint, credential), shared by every request
+def _http_limits():
+    import httpx
+    return httpx.Limits(
+        max_connections=KEEPALIVE_CONNECTIONS,
+        max_keepalive_connections=KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=KEEPALIVE_EXPIRY_SECONDS,
+    )
+
+def _http_client(hooks):
+    import httpx
+    return httpx.Client(limits=_http_limits(), timeout=httpx.Timeout(600.0, connect=CONNECT_TIMEOUT_SECONDS),
+                        event_hooks=hooks)
+
+def _async_http_client(hooks):
+    import httpx
+    return httpx.AsyncClient(limits=_http_limits(), timeout=httpx.Timeout(600.0, connect=CONNECT_TIMEOUT_SECONDS),
+                             event_hooks=hooks)
+
+# Every client getter checks a client out of the pool; callers hand it back with POOL.release()
+def get_openai_client(endpoint, token, provider):
+    def build():
+        from openai import OpenAI
+        client = OpenAI(base_url=endpoint, api_key=token, max_retries=0,
+                        http_client=_http_client(_httpx_hooks(provider, token)))
+        return client, client.close
+    return POOL.get('openai', endpoint, token, build)
+
+def get_azure_client(endpoint, token, provider):
+    def build():
+        from azure.ai.inference import ChatCompletionsClient
+        from azure.core.credentials import AzureKeyCredential
+        client = ChatCompletionsClient(endpoint=endpoint, credential=AzureKeyCredential(token),
+                                      connection_timeout=CONNECT_TIMEOUT_SECONDS, retry_total=0,
+                                      raw_response_hook=_azure_hook(provider, token))
+        return client, client.close
+    return POOL.get('azure', endpoint, token, build)
+
+def get_mistral_client(endpoint, token, provider):
+    def build():
+        from mistralai import Mistral
+        http_client = _http_client(_httpx_hooks(provider, token))
+        client = Mistral(api_key=token, server_url=endpoint, client=http_client)
+        return client, http_client.close
+    return POOL.get('mistral', endpoint, token, build)
+
+# Async clients are bound to the event loop that created them, so they are pooled per loop
+def _async_closer(aclose):
+    def close():
+        try:
+            asyncio.get_running_loop().create_task(aclose())
+        except RuntimeError:
+            asyncio.run(aclose())
+    return close
+
+def _loop_scoped(provider):
+    return f"{provider}-async:{id(asyncio.get_running_loop())}"
+
+def get_async_openai_client(endpoint, token, provider):
+    def build():
+        from openai import AsyncOpenAI
+        client = AsyncOpenAI(base_url=endpoint, api_key=token, max_retries=0,
+                             http_client=_async_http_client(_async_httpx_hooks(provider, token)))
+        return client, _async_closer(client.close)
+    return POOL.get(_loop_scoped('openai'), endpoint, token, build)
+
+def get_async_azure_client(endpoint, token, provider):
+    def build():
+        from azure.ai.inference.aio import ChatCompletionsClient as AsyncChatCompletionsClient
+        from azure.core.credentials import AzureKeyCredential
+        client = AsyncChatCompletionsClient(endpoint=endpoint, credential=AzureKeyCredential(token),
+                                           connection_timeout=CONNECT_TIMEOUT_SECONDS, retry_total=0,
+                                           raw_response_hook=_azure_hook(provider, token))
+        return client, _async_closer(client.close)
+    return POOL.get(_loop_scoped('azure'), endpoint, token, build)
+
+def get_async_mistral_client(endpoint, token, provider):
+    def build():
+        from mistralai import Mistral
+        http_client = _async_http_client(_async_httpx_hooks(provider, token))
+        client = Mistral(api_key=token, server_url=endpoint, async_client=http_client)
+        return client, _async_closer(http_client.aclose)
+    return POOL.get(_loop_scoped('mistral'), endpoint, token, build)
+
+CLIENT_GETTERS = {
+    SDK_OPENAI: get_openai_client,
+    SDK_AZURE: get_azure_client,
+    SDK_MISTRAL: get_mistral_client,
+}
+
+ASYNC_CLIENT_GETTERS = {
+    SDK_OPENAI: get_async_openai_client,
+    SDK_AZURE: get_async_azure_client,
+    SDK_MISTRAL: get_async_mistral_client,
+}
+
+# Which pooled clients each key is used for, so they can be built ahead of the first prompt
+def _prewarm_targets(api_keys):
+    targets = []
+    for spec in MODEL_SPECS.values():
+        token = api_keys.get(spec['key'], '')
+        target = (spec['sdk'], spec['endpoint'], token, spec['provider'])
+        if token and target not in targets:
+            targets.append(target)
+    return targets
+
+def _open_connection(sdk, client, endpoint):
+    # Any response will do, the point is to leave a TLS connection in the keep-alive pool
+    if sdk == SDK_AZURE:
+        from azure.core.rest import HttpRequest
+        client.send_request(HttpRequest("HEAD", endpoint)).close()
+    elif sdk == SDK_MISTRAL:
+        client.sdk_configuration.client.head(endpoint).close()
+    else:
+        client._client.head(endpoint).close()
+
+def prewarm_clients(api_keys, open_connections=True):
+    for sdk, endpoint, token, provider in _prewarm_targets(api_keys):
+        try:
+            client = CLIENT_GETTERS[sdk](endpoint, token, provider)
+            try:
+                if open_connections:
+                    _open_connection(sdk, client, endpoint)
+            finally:
+                POOL.release(client)
+        except Exception:
+            # Pre-warming is best effort, the real call will surface any error
+            pass
+
+def build_messages(spec, prompt, context=None):
+    # context: the conversation so far, from ModelThread.context()
+    summary = context['summary'] if context is not None else None
+    messages = []
+    if spec['system_role']:
+        system_prompt = f"{SYSTEM_PROMPT}\n\n{summary}" if summary else SYSTEM_PROMPT
+        messages.append({"role": spec['system_role'], "content": system_prompt})
+    if context is not None:
+        messages.extend(context['messages'])
+    messages.append({"role": "user", "content": prompt})
+    if summary and not spec['system_role']:
+        # No system prompt to carry it: the summary leads the first user message
+        messages[0] = {"role": "user", "content": f"{summary}\n\n{messages[0]['content']}"}
+    return messages
+
+def _missing_key_message(spec):
+    return MISSING_NVIDIA_KEY if spec['key'] == 'nvidia_key' else MISSING_GITHUB_TOKEN
+
+def _delta_text(chunk):
+    # OpenAI, Azure inference and Mistral stream chunks share the choices[0].delta shape
+    if not chunk.choices:
+        return None
+    content = chunk.choices[0].delta.content
+    return content if isinstance(content, str) else None
+
+def _record_usage(call, payload):
+    # Token counts, where the provider reports them
+    usage = getattr(payload, 'usage', None)
+    tokens = getattr(usage, 'completion_tokens', None)
+    if call is not None and isinstance(tokens, int):
+        call.output_tokens = tokens
+    tokens = getattr(usage, 'prompt_tokens', None)
+    if call is not None and isinstance(tokens, int):
+        call.input_tokens = tokens
+
+def _meter(spec, token, prompt, call, context, response=None, error=None):
+    # Every request sent counts in the usage ledger; token counts are estimated where
+    # the provider did not report them (or the request failed part way)
+    prompt_tokens = call.input_tokens if call is not None else None
+    if prompt_tokens is None:
+        prompt_tokens = estimate_tokens(SYSTEM_PROMPT) + estimate_tokens(prompt) + (context['tokens'] if context else 0)
+    completion_tokens = call.output_tokens if call is not None else None
+    if completion_tokens is None:
+        text = response if isinstance(response, str) else (call.text() if call is not None else '')
+        completion_tokens = len(text) // 4
+    USAGE.record(spec, token, prompt_tokens, completion_tokens, error)
+
+def _metered(spec, token, prompt, call, context):
+    try:
+        response = _complete(spec, token, prompt, call, context)
+    except Exception as e:
+        _meter(spec, token, prompt, call, context, error=e)
+        raise
+    _meter(spec, token, prompt, call, context, response)
+    return response
+
+async def _metered_async(spec, token, prompt, call, context):
+    try:
+        response = await _complete_async(spec, token, prompt, call, context)
+    except BaseException as e:
+        # Including the task being cancelled mid-stream: the request was still made
+        _meter(spec, token, prompt, call, context, error=e)
+        raise
+    _meter(spec, token, prompt, call, context, response)
+    return response
+
+def _stream_options(spec, streaming):
+    if streaming and STREAM_USAGE and spec['sdk'] == SDK_OPENAI:
+        return {'stream_options': {'include_usage': True}}
+    return {}
 
+def _close_stream(stream):
+    try:
+        if hasattr(stream, 'close'):
+            stream.close()
+        else:
+            stream.response.close()
+    except Exception:
+        pass
+
+async def _aclose_stream(stream):
+    try:
+        if hasattr(stream, 'aclose'):
+            await stream.aclose()
+        elif hasattr(stream, 'close'):
+            result = stream.close()
+            if asyncio.iscoroutine(result):
+                await result
+        else:
+            await stream.response.aclose()
+    except Exception:
+        pass
+
+def _stream_socket(stream):
+    # httpx-based streams (OpenAI, Mistral) expose the connection's socket through the
+    # response extensions; Azure's requests transport keeps it on the urllib3 connection
+    response = getattr(stream, 'response', None)
+    network_stream = getattr(response, 'extensions', {}).get('network_stream')
+    if network_stream is not None:
+        return network_stream.get_extra_info('socket')
+    internal = getattr(getattr(stream, '_response', None), 'internal_response', None)
+    connection = getattr(getattr(internal, 'raw', None), 'connection', None)
+    return getattr(connection, 'sock', None)
+
+def _abort_stream(stream):
+    # Closing a stream does not wake a thread blocked reading it; shutting the socket
+    # down does, and the provider sees the request go away
+    try:
+        sock = _stream_socket(stream)
+        if sock is not None:
+            sock.shutdown(socket.SHUT_RDWR)
+    except Exception:
+        pass
+    _close_stream(stream)
+
+def complete(spec, token, prompt, call=None, context=None):
+    # Waits for a rate limit slot first, and retries rate limited or overloaded requests
+    if call is not None:
+        call.check()
+    return RATE_LIMITS.call(spec['provider'], token, lambda: _metered(spec, token, prompt, call, context), call)
+
+def _trace_request(call, started_at):
+    # For a traced call: records getting the client, and lets the pooled client's request
+    # hook tie connection events to the call. Returns what _trace_response needs.
+    if call is None or call.trace is None:
+        return None
+    call.span('client', started_at)
+    return time.monotonic(), CURRENT_CALL.set(call)
+
+def _trace_response(call, traced, streaming):
+    # Until the response headers when streaming, the whole answer otherwise
+    if traced is None:
+        return None
+    sent_at, current = traced
+    CURRENT_CALL.reset(current)
+    call.span('request', sent_at, stream=streaming)
+    return time.monotonic()
+
+def _complete(spec, token, prompt, call, context=None):
+    messages = build_messages(spec, prompt, context)
+    started_at = time.monotonic()
+    client = CLIENT_GETTERS[spec['sdk']](spec['endpoint'], token, spec['provider'])
+    try:
+        return _request(spec, client, messages, call, started_at)
+    finally:
+        # The pool may close the client now if it was evicted meanwhile
+        POOL.release(client)
+
+def _request(spec, client, messages, call, started_at):
+    streaming = call is not None and call.streaming
+
+    traced = _trace_request(call, started_at)
+    try:
+        if spec['sdk'] == SDK_OPENAI:
+            response = client.chat.completions.create(messages=messages, model=spec['model_name'], stream=streaming,
+                                                      **_stream_options(spec, streaming), **spec['params'])
+        elif spec['sdk'] == SDK_AZURE:
+            response = client.complete(messages=messages, model=spec['model_name'], stream=streaming, **spec['params'])
+        elif streaming:
+            response = client.chat.stream(model=spec['model_name'], messages=messages, **spec['params'])
+        else:
+            response = client.chat.complete(model=spec['model_name'], messages=messages, **spec['params'])
+    finally:
+        received_at = _trace_response(call, traced, streaming)
+
+    if not streaming:
+        _record_usage(call, response)
         return response.choices[0].message.content
-    return phi4
 
-def create_deepseekv30324(token):
-    def deepseekv30324(prompt):
-        if not token:
-            return "API key not provided. Please enter your GitHub token in the settings."
-            
-        endpoint = "https://models.github.ai/inference"
-        model_name = "deepseek/DeepSeek-V3-0324"
-        
-        client = ChatCompletionsClient(
-            endpoint=endpoint,
-            credential=AzureKeyCredential(token),
-        )
-
-        response = client.complete(
-            messages=[
-                AzureSystemMessage("You are a helpful assistant."),
-                AzureUserMessage(prompt)
-            ],
-            temperature=1.0,
-            top_p=1.0,
-            max_tokens=1000,
-            model=model_name
-        )
+    try:
+        with call.attach(lambda: _abort_stream(response)):
+            for chunk in response:
+                # Mistral wraps each chunk in a server-sent event
+                data = getattr(chunk, 'data', chunk)
+                _record_usage(call, data)
+                call.emit(_delta_text(data))
+    except Exception:
+        # A read error caused by our own abort is reported as the cancellation
+        call.check()
+        raise
+    finally:
+        _close_stream(response)
+        if received_at is not None:
+            call.span('stream', received_at)
+    return call.text()
+
+async def complete_async(spec, token, prompt, call=None, context=None):
+    # Cancelling the asyncio task is what aborts an async call, so cancelling the
+    # context (e.g. at a deadline) cancels the task running it
+    if call is None:
+        return await RATE_LIMITS.call_async(spec['provider'], token,
+                                            lambda: _metered_async(spec, token, prompt, None, context))
+    call.check()
+    loop = asyncio.get_running_loop()
+    task = asyncio.current_task()
+    try:
+        with call.attach(lambda: loop.call_soon_threadsafe(task.cancel)):
+            return await RATE_LIMITS.call_async(spec['provider'], token,
+                                                lambda: _metered_async(spec, token, prompt, call, context), call)
+    except asyncio.CancelledError:
+        if not call.cancelled:
+            raise
+        # Our own abort, not the task's owner: report it as the cancellation
+        if hasattr(task, 'uncancel'):
+            task.uncancel()
+        call.check()
+
+async def _complete_async(spec, token, prompt, call, context=None):
+    messages = build_messages(spec, prompt, context)
+    started_at = time.monotonic()
+    client = ASYNC_CLIENT_GETTERS[spec['sdk']](spec['endpoint'], token, spec['provider'])
+    try:
+        return await _request_async(spec, client, messages, call, started_at)
+    finally:
+        POOL.release(client)
+
+async def _request_async(spec, client, messages, call, started_at):
+    streaming = call is not None and call.streaming
+
+    traced = _trace_request(call, started_at)
+    try:
+        if spec['sdk'] == SDK_OPENAI:
+            response = await client.chat.completions.create(messages=messages, model=spec['model_name'],
+                                                            stream=streaming, **_stream_options(spec, streaming),
+                                                            **spec['params'])
+        elif spec['sdk'] == SDK_AZURE:
+            response = await client.complete(messages=messages, model=spec['model_name'], stream=streaming,
+                                             **spec['params'])
+        elif streaming:
+            response = await client.chat.stream_async(model=spec['model_name'], messages=messages, **spec['params'])
+        else:
+            response = await client.chat.complete_async(model=spec['model_name'], messages=messages, **spec['params'])
+    finally:
+        received_at = _trace_response(call, traced, streaming)
 
+    if not streaming:
+        _record_usage(call, response)
         return response.choices[0].message.content
-    return deepseekv30324
 
-def create_metallama(token):
-    def metallama(prompt):
+    try:
+        async for chunk in response:
+            data = getattr(chunk, 'data', chunk)
+            _record_usage(call, data)
+            call.emit(_delta_text(data))
+    finally:
+        await _aclose_stream(response)
+        if received_at is not None:
+            call.span('stream', received_at)
+    return call.text()
+
+def probe_model(model_id, token, call):
+    # The cheapest real request a model allows: a one-token answer, past the response
+    # cache, used to check whether a model that kept failing has recovered
+    spec = MODEL_SPECS[model_id]
+    params = dict(spec['params'])
+    if 'max_tokens' in params:
+        params['max_tokens'] = 1
+    return complete(dict(spec, params=params), token, "ping", call)
+
+# Factory functions to create model function with API keys
+def create_model_function(model_id, token):
+    spec = MODEL_SPECS[model_id]
+
+    def model_function(prompt, call=None):
         if not token:
-            return "API key not provided. Please enter your GitHub token in the settings."
-            
-        endpoint = "https://models.inference.ai.azure.com"
-        model_name = "Llama-3.2-90B-Vision-Instruct"
-        client = ChatCompletionsClient(
-        endpoint=endpoint,
-        credential=AzureKeyCredential(token),
-        )
-
-        response = client.complete(
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.7,
-            top_p=0.8,
-            max_tokens=1024,
-            model=model_name
-        )
+            return _missing_key_message(spec)
+        history = call.history if call is not None else None
+        context = history.context(prompt) if history is not None else None
+        key = cache_key(model_id, spec, SYSTEM_PROMPT, prompt, context)
+        fetch = lambda call: complete(spec, token, prompt, call, context)
+        response = RESPONSE_CACHE.call(key, fetch, call)
+        if history is not None:
+            history.append(prompt, response)
+        return response
 
-        return response.choices[0].message.content
-    return metallama
+    model_function.__name__ = model_id
+    return model_function
 
-def create_mistral(token):
-    def mistral(prompt):
+def create_async_model_function(model_id, token):
+    spec = MODEL_SPECS[model_id]
+
+    async def model_function(prompt, call=None):
         if not token:
-            return "API key not provided. Please enter your GitHub token in the settings."
-            
-        endpoint = "https://models.inference.ai.azure.com"
-        model_name = "Mistral-Large-2411"
-
-        client = Mistral(api_key=token, server_url=endpoint)
-
-        response = client.chat.complete(
-        model=model_name,
-        messages=[
-            SystemMessage(content="You are a helpful assistant."),
-            UserMessage(content=prompt),
-        ],
-        temperature=0.7,
-        top_p=0.8,
-        max_tokens=1024,
-        )
+            return _missing_key_message(spec)
+        history = call.history if call is not None else None
+        context = history.context(prompt) if history is not None else None
+        key = cache_key(model_id, spec, SYSTEM_PROMPT, prompt, context)
+        fetch = lambda call: complete_async(spec, token, prompt, call, context)
+        response = await RESPONSE_CACHE.call_async(key, fetch, call)
+        if history is not None:
+            history.append(prompt, response)
+        return response
 
-        return response.choices[0].message.content
-    return mistral
+    model_function.__name__ = model_id
+    return model_function
 
-def create_nvidia_nemotron(nvkey):
-    def nvidia_nemotron(prompt):
-        if not nvkey:
-            return "API key not provided. Please enter your Nvidia API key in the settings."
-            
-        client = OpenAI(
-            base_url="https://integrate.api.nvidia.com/v1",
-            api_key=nvkey
-        )
+def create_openAIo3(token):
+    return create_model_function('o3', token)
 
-        try:
-            # Using non-streaming version for simplicity in the web app
-            completion = client.chat.completions.create(
-                model="nvidia/llama-3.1-nemotron-70b-instruct",
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.7,
-                top_p=0.8,
-                max_tokens=1024,
-                stream=False
-            )
-            return completion.choices[0].message.content
-        except Exception as e:
-            return f"Error with Nvidia API: {str(e)}"
-    return nvidia_nemotron
+def create_openAIo4preview(token):
+    return create_model_function('o4preview', token)
+
+def create_chatgpt41(token):
+    return create_model_function('gpt41', token)
+
+def create_phi4(token):
+    return create_model_function('phi4', token)
+
+def create_deepseekv30324(token):
+    return create_model_function('deepseekv30324', token)
+
+def create_metallama(token):
+    return create_model_function('metallama', token)
+
+def create_mistral(token):
+    return create_model_function('mistral', token)
+
+def create_nvidia_nemotron(nvkey):
+    return create_model_function('nemotron', nvkey)
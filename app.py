@@ -1,61 +1,197 @@
 import os
-from flask import Flask, render_template, request, jsonify, session, Response, stream_with_context
+from flask import Flask, render_template, request, jsonify, session, Response, stream_with_context, after_this_request
 from dotenv import load_dotenv
 import threading
 import time
 import uuid
 import json
-from flask.ctx import copy_current_request_context
-from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError
+from concurrent.futures import TimeoutError, CancelledError
 import queue
 
-app = Flask(__name__)
-app.secret_key = os.urandom(24)  # For session management
+from ai_models import create_model_function, prewarm_clients, probe_model
+from archive import ARCHIVE
+from breakers import BREAKERS, BREAKER_PROBE_TIMEOUT_SECONDS
+from call_context import CallContext
+from conversations import CONVERSATIONS, CONVERSATION_MEMORY_ENABLED, CONVERSATION_STORE
+from cancellation import CANCELLATIONS, CancelScope, Cancelled
+from client_pool import credential_fingerprint
+from dispatcher import DISPATCHER, Saturated
+from jobs import JOBS, JOBS_MAX_TASKS, parse_prompts
+# Per-model timeouts adapt to recent latency; MODEL_TIMEOUT_SECONDS is the starting budget
+from latency import LATENCY, MODEL_TIMEOUT_SECONDS, parse_deadline, cancel_if_silent, watch_first_token
+from metrics import REGISTRY, model_started, model_finished, model_skipped, tracked_stream
+# Display names and providers come from the shared registry (also used by rawcode.py)
+from model_registry import MODEL_SPECS, MODEL_NAMES, MODEL_PROVIDERS, api_key_for, error_message
+from model_selection import outlook, select_models, parse_model_list, parse_fastest_k, parse_latency_budget
+from rate_limits import RATE_LIMITS, RateLimited
+from runs import RUNS, TIMER, RESUME_GRACE_SECONDS, parse_last_event_id
+from streaming import DeltaBatcher
+from tracing import TRACER, queued
+from usage import USAGE
+
 load_dotenv()
+# Sessions (API keys included) live server-side; the cookie only holds a signed id, and
+# SECRET_KEY must be the same on every worker and node
+from session_store import SESSIONS, ServerSessionInterface, load_secret_key
+
+app = Flask(__name__)
+app.secret_key = load_secret_key()
+app.session_interface = ServerSessionInterface(SESSIONS)
+if CONVERSATION_STORE == 'shared':
+    # Conversation memory lives next to the sessions, where every worker can read it
+    CONVERSATIONS.share(SESSIONS)
 
-# Add a timeout constant you can adjust as needed
-MODEL_TIMEOUT_SECONDS = 60  # Timeout after 60 seconds
+# Which engine serves the "all models" stream under asgi.py: 'thread' or 'async'
+FANOUT_ENGINE = os.getenv('FANOUT_ENGINE', 'thread')
+
+# Build provider clients (and open their connections) as soon as keys are saved
+PREWARM_CLIENTS_ON_SAVE = os.getenv('PREWARM_CLIENTS_ON_SAVE', 'true').lower() == 'true'
+
+# How many answers mode=first_n waits for when n is not given
+FIRST_N_DEFAULT = int(os.getenv('FIRST_N_DEFAULT', '2'))
 
-# Dictionary mapping model IDs to functions (moved to a function to use API keys from session)
 def get_model_function(model_id, api_keys):
-    from ai_models import (
-        create_openAIo3, create_openAIo4preview, create_chatgpt41, create_phi4, 
-        create_deepseekv30324, create_metallama, create_mistral, create_nvidia_nemotron
-    )
-    
-    github_token = api_keys.get('github_token', '')
-    nvidia_key = api_keys.get('nvidia_key', '')
-    
-    MODEL_FUNCTIONS = {
-        'gpt41': create_chatgpt41(github_token),
-        'o3': create_openAIo3(github_token),
-        'o4preview': create_openAIo4preview(github_token),
-        'phi4': create_phi4(github_token),
-        'deepseekv30324': create_deepseekv30324(github_token),
-        'metallama': create_metallama(github_token),
-        'mistral': create_mistral(github_token),
-        'nemotron': create_nvidia_nemotron(nvidia_key)
+    if model_id not in MODEL_SPECS:
+        return None
+    remember_probe(model_id, api_keys)
+    return create_model_function(model_id, api_key_for(model_id, api_keys))
+
+def remember_probe(model_id, api_keys):
+    # The circuit breaker checks a failing model with the most recent key it was called with
+    token = api_key_for(model_id, api_keys)
+    if token:
+        BREAKERS.set_probe(model_id, lambda: probe(model_id, token))
+
+def probe(model_id, token):
+    call = CallContext(on_delta=lambda text: None, use_cache=False, deadline=BREAKER_PROBE_TIMEOUT_SECONDS)
+    watch = TIMER.call_later(BREAKER_PROBE_TIMEOUT_SECONDS, lambda: call.cancel('timed out'))
+    try:
+        probe_model(model_id, token, call)
+    except Cancelled:
+        raise TimeoutError(f"No answer within {BREAKER_PROBE_TIMEOUT_SECONDS:g} seconds")
+    finally:
+        TIMER.cancel(watch)
+
+def get_user_id():
+    # Queue fairness is per browser session, falling back to the client address
+    return session.get('user_id') or request.remote_addr or 'anonymous'
+
+def provider_counts(model_ids):
+    counts = {}
+    for model_id in model_ids:
+        provider = MODEL_PROVIDERS[model_id]
+        counts[provider] = counts.get(provider, 0) + 1
+    return counts
+
+def start_call(model_id, on_delta, use_cache, budget=None, on_throttle=None, history=None, trace=None):
+    model_started(model_id, MODEL_PROVIDERS[model_id])
+    # The deadline tells the rate limiter how long the call may wait for a slot
+    call = CallContext(on_delta=on_delta, use_cache=use_cache,
+                       deadline=budget['total'] if budget else None, on_throttle=on_throttle, history=history)
+    if trace is not None:
+        # One lane per model in the run's trace
+        call.trace = trace
+        call.trace_lane = MODEL_NAMES[model_id]
+    return call
+
+def conversation_thread(user_id, conversation_id, model_id, memory=True):
+    # What the model has said so far in this conversation, None to answer the prompt alone
+    if not (memory and CONVERSATION_MEMORY_ENABLED):
+        return None
+    return CONVERSATIONS.thread(user_id, conversation_id, model_id)
+
+def record_call(model_id, call, status, error=None):
+    # Every started call ends here exactly once: 'success', 'error', 'timeout' or 'cancelled'
+    model_finished(model_id, MODEL_PROVIDERS[model_id], status, call)
+    # Only calls that reached the provider tell the breaker anything; the rest just
+    # hand back a half-open breaker's trial
+    reached_provider = call.cache_status in ('miss', 'bypass') or status == 'timeout'
+    BREAKERS.record(model_id, status if reached_provider else 'ignored', error)
+    # Cache hits and coalesced calls say nothing about how fast the provider is
+    # and neither does time spent waiting on a rate limit
+    if status == 'success' and call.cache_status in ('miss', 'bypass'):
+        throttled = call.throttle_seconds
+        first_token = call.first_token_seconds()
+        LATENCY.record(model_id, time.monotonic() - call.started_at - throttled,
+                       first_token - throttled if first_token is not None else None)
+    if call.trace is not None:
+        if call.first_delta_at is not None:
+            call.trace.instant(call.trace_lane, 'first_token', call.first_delta_at)
+        call.span('call', call.started_at, status=status, cache=call.cache_status, retries=call.retries,
+                  throttle_seconds=round(call.throttle_seconds, 3), output_tokens=call.output_tokens,
+                  error=str(error) if error is not None else None)
+
+def archive_call(prompt, model_id, call, status, response=None, error=None, user_id=None, run_id=None, source='web'):
+    # Kept in the local archive (see archive.py); only queued here, the disk is written
+    # by the archive's own thread
+    ARCHIVE.record(prompt, model_id, status, response, error, time.monotonic() - call.started_at, call.output_tokens,
+                   call.cache_status == 'hit', source, user_id, run_id, call.history is not None)
+
+def timeout_message(budget, first_token=False):
+    if first_token:
+        return f"Model sent no response within {budget['first_token']:g} seconds"
+    return f"Model response timed out after {budget['total']:g} seconds"
+
+def unavailable_event(model_id):
+    return {
+        'event': 'model_error',
+        'model_id': model_id,
+        'model_name': MODEL_NAMES.get(model_id),
+        'error': BREAKERS.unavailable_message(model_id),
+        'status': 'unavailable'
     }
-    
-    return MODEL_FUNCTIONS.get(model_id)
-
-MODEL_NAMES = {
-    'gpt41': 'GPT-4.1',
-    'o3': 'O3',
-    'o4preview': 'O4-Mini (Preview)',
-    'phi4': 'Phi-4',
-    'deepseekv30324': 'DeepSeek-V3-0324',
-    'metallama': 'Meta Llama-3.2-90B',
-    'mistral': 'Mistral-Large',
-    'nemotron': 'Nvidia Nemotron-70B'
-}
+
+def unavailable_response(model_id):
+    retry_after = max(1, round(BREAKERS.retry_in(model_id)))
+    response = jsonify({'error': BREAKERS.unavailable_message(model_id), 'status': 'unavailable',
+                        'retry_after': retry_after})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+def quota_event(model_id, api_keys):
+    return {
+        'event': 'model_error',
+        'model_id': model_id,
+        'model_name': MODEL_NAMES.get(model_id),
+        'error': USAGE.quota_message(model_id, api_key_for(model_id, api_keys)),
+        'status': 'quota'
+    }
+
+def quota_response(model_id, api_keys, wait):
+    retry_after = max(1, round(wait))
+    response = jsonify({'error': USAGE.quota_message(model_id, api_key_for(model_id, api_keys)), 'status': 'quota',
+                        'retry_after': retry_after})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+def parse_mode(mode, n):
+    # How many answers a fan-out waits for: None for every model ('all'), 1 for 'race',
+    # n for 'first_n'; ValueError when invalid
+    mode = mode or 'all'
+    if mode == 'all':
+        return None
+    if mode == 'race':
+        return 1
+    if mode == 'first_n':
+        wanted = int(n) if n not in (None, '') else FIRST_N_DEFAULT
+        if wanted < 1:
+            raise ValueError('n must be at least 1')
+        return wanted
+    raise ValueError('mode must be one of all, race, first_n')
+
+def saturated_response(error):
+    response = jsonify({'error': error.reason, 'retry_after': error.retry_after})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
     
 @app.route('/')
 def index():
     # Generate a session ID if not present
     if 'user_id' not in session:
         session['user_id'] = str(uuid.uuid4())
-        session['conversations'] = {}
         session['api_keys'] = {'github_token': '', 'nvidia_key': ''}
     
     return render_template('index.html', models=MODEL_NAMES)
@@ -67,12 +203,138 @@ def save_api_keys():
         'github_token': data.get('github_token', ''),
         'nvidia_key': data.get('nvidia_key', '')
     }
+    
+    if PREWARM_CLIENTS_ON_SAVE:
+        api_keys = dict(session['api_keys'])
+        threading.Thread(target=prewarm_clients, args=(api_keys,), daemon=True).start()
+    
     return jsonify({'success': True})
 
 @app.route('/get_api_keys', methods=['GET'])
 def get_api_keys():
     return jsonify(session.get('api_keys', {'github_token': '', 'nvidia_key': ''}))
 
+@app.route('/pool_stats', methods=['GET'])
+def pool_stats():
+    from client_pool import POOL
+    return jsonify(POOL.stats())
+
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    from response_cache import RESPONSE_CACHE
+    return jsonify(RESPONSE_CACHE.stats())
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    # Prometheus text format, summed over every worker when METRICS_DIR is set
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/latency_stats', methods=['GET'])
+def latency_stats():
+    return jsonify(LATENCY.stats())
+
+@app.route('/health', methods=['GET'])
+def health():
+    # Circuit breaker state per model; the sidebar greys out models that are unavailable
+    models = {}
+    for model_id, stats in BREAKERS.stats().items():
+        models[model_id] = dict(stats, name=MODEL_NAMES[model_id], provider=MODEL_PROVIDERS[model_id],
+                                available=BREAKERS.available(model_id))
+    degraded = any(model['state'] != 'closed' for model in models.values())
+    return jsonify({'status': 'degraded' if degraded else 'ok', 'models': models})
+
+@app.route('/models', methods=['GET'])
+def model_outlook():
+    # What to expect from each model (the sidebar shows expected latency), and which
+    # models a request with the same models / fastest_k / latency_budget would get
+    try:
+        selected = select_models(parse_model_list(request.args.get('models')),
+                                 parse_fastest_k(request.args.get('fastest_k')),
+                                 parse_latency_budget(request.args.get('latency_budget')),
+                                 session.get('api_keys', {}))
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+    breakers = BREAKERS.stats()
+    return jsonify({
+        'models': {model_id: dict(outlook(model_id), provider=MODEL_PROVIDERS[model_id],
+                                  last_error=breakers[model_id]['last_error']) for model_id in MODEL_NAMES},
+        'selected': selected
+    })
+
+@app.route('/session_stats', methods=['GET'])
+def session_stats():
+    return jsonify(SESSIONS.stats())
+
+@app.route('/conversation_stats', methods=['GET'])
+def conversation_stats():
+    return jsonify(CONVERSATIONS.stats())
+
+@app.route('/usage', methods=['GET'])
+def usage():
+    # Requests and tokens used with this session's keys, against their quotas
+    api_keys = session.get('api_keys', {})
+    fingerprints = {credential_fingerprint(key) for key in api_keys.values() if key}
+    return jsonify({'usage': USAGE.report(fingerprints)})
+
+@app.route('/usage_stats', methods=['GET'])
+def usage_stats():
+    # Every key this process has used, by fingerprint only
+    return jsonify(dict(USAGE.stats(), usage=USAGE.report()))
+
+@app.route('/archive/search', methods=['GET'])
+def archive_search():
+    # This user's archived answers, newest first: q=<words> searches prompts and answers,
+    # prompt=<text> (or hash=<sha256 of it>) finds every answer to exactly that prompt,
+    # and model, status and since=<unix time> narrow it down
+    args = request.args
+    try:
+        since = float(args['since']) if args.get('since') else None
+        results = ARCHIVE.search(args.get('q'), args.get('prompt'), args.get('hash'), args.get('model'),
+                                 args.get('status'), since, get_user_id(), int(args.get('limit', 50)))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'results': results})
+
+@app.route('/archive/<int:response_id>', methods=['GET'])
+def archived_response(response_id):
+    result = ARCHIVE.get(response_id, get_user_id())
+    if result is None:
+        return jsonify({'error': 'Unknown archived response'}), 404
+    return jsonify(result)
+
+@app.route('/archive_stats', methods=['GET'])
+def archive_stats():
+    return jsonify(ARCHIVE.stats())
+
+@app.route('/debug/trace/<trace_id>', methods=['GET'])
+def debug_trace(trace_id):
+    # Chrome trace event JSON: load it in chrome://tracing or https://ui.perfetto.dev
+    trace = TRACER.get(trace_id)
+    if trace is None:
+        return jsonify({'error': 'Unknown or unsampled trace'}), 404
+    return jsonify(trace)
+
+@app.route('/trace_stats', methods=['GET'])
+def trace_stats():
+    return jsonify(TRACER.stats())
+
+@app.route('/rate_limit_stats', methods=['GET'])
+def rate_limit_stats():
+    return jsonify(RATE_LIMITS.stats())
+
+@app.route('/dispatcher_stats', methods=['GET'])
+def dispatcher_stats():
+    stats = DISPATCHER.stats()
+    stats['active_operations'] = CANCELLATIONS.stats()
+    stats['runs'] = RUNS.stats()
+    return jsonify(stats)
+
+@app.route('/channel_stats', methods=['GET'])
+def channel_stats():
+    # Channels are only opened under asgi.py; elsewhere this reports none
+    from channels import CHANNELS
+    return jsonify(CHANNELS.stats())
+
 @app.route('/generate', methods=['POST', 'GET'])
 def generate():
     # Handle both GET and POST requests
@@ -80,150 +342,693 @@ def generate():
         prompt = request.args.get('prompt')
         selected_model = request.args.get('model')
         conversation_id = request.args.get('conversation_id', 'default')
+        use_cache = request.args.get('cache', 'true')
+        memory = request.args.get('memory', 'true')
+        deadline = request.args.get('deadline')
+        mode = request.args.get('mode')
+        n = request.args.get('n')
+        hedge = request.args.get('hedge')
+        models = request.args.get('models')
+        fastest_k = request.args.get('fastest_k')
+        latency_budget = request.args.get('latency_budget')
+        trace = request.args.get('trace')
     else:
         data = request.json
         prompt = data.get('prompt')
         selected_model = data.get('model')
         conversation_id = data.get('conversation_id', 'default')
+        use_cache = data.get('cache', True)
+        memory = data.get('memory', True)
+        deadline = data.get('deadline')
+        mode = data.get('mode')
+        n = data.get('n')
+        hedge = data.get('hedge')
+        models = data.get('models')
+        fastest_k = data.get('fastest_k')
+        latency_budget = data.get('latency_budget')
+        trace = data.get('trace')
+    
+    # cache=false asks for fresh answers from every model
+    use_cache = str(use_cache).lower() not in ('false', '0', 'no', 'off')
+    # memory=false answers the prompt on its own and leaves it out of the conversation
+    memory = str(memory).lower() not in ('false', '0', 'no', 'off')
+    # trace=true records this request's trace whatever the sample rate
+    force_trace = str(trace).lower() in ('true', '1', 'yes', 'on')
     
     if not prompt:
         return jsonify({'error': 'Prompt is required'}), 400
     
+    # Optional overall deadline in seconds; no model call is given longer than this
+    try:
+        deadline = parse_deadline(deadline)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'deadline must be a positive number of seconds'}), 400
+    
+    # mode=race stops at the first answer, mode=first_n at n answers; the rest are cancelled
+    try:
+        wanted = parse_mode(mode, n)
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+    
     # Save session data without adding to conversation history
     api_keys = session.get('api_keys', {'github_token': '', 'nvidia_key': ''})
     
+    user_id = get_user_id()
+    
     if selected_model == 'all':
-        return stream_all_models(prompt, api_keys)
+        # A reconnecting EventSource sends the id of the last event it saw; pick the
+        # same run up from there instead of asking every model again
+        run_id, after_seq = parse_last_event_id(
+            request.headers.get('Last-Event-ID') or request.args.get('last_event_id'))
+        if run_id is not None:
+            run = RUNS.get(run_id)
+            if run is None:
+                # Unknown or expired run: 204 tells EventSource to stop reconnecting
+                return Response(status=204)
+            if run.user_id != user_id:
+                # Someone else's run, as with /cancel_operations
+                return jsonify({'error': 'Unknown run'}), 404
+            return event_stream(run, after_seq)
+        # models=<ids>, fastest_k=<k> and latency_budget=<seconds> narrow the fan-out;
+        # models with an open circuit breaker are skipped, so they take no capacity
+        try:
+            model_ids = parse_model_list(models)
+            fastest_k = parse_fastest_k(fastest_k)
+            latency_budget = parse_latency_budget(latency_budget)
+        except (TypeError, ValueError) as e:
+            return jsonify({'error': str(e)}), 400
+        available = select_models(model_ids, fastest_k, latency_budget, api_keys)
+        if latency_budget is not None:
+            # Models picked for a budget are not given longer than it either
+            deadline = min(deadline, latency_budget) if deadline is not None else latency_budget
+        if not available and (model_ids or fastest_k or latency_budget):
+            return jsonify({'error': 'No available model matches the selection'}), 400
+        try:
+            if available:
+                DISPATCHER.admit(provider_counts(available),
+                                 max(LATENCY.budget(model_id, deadline)['total'] for model_id in available))
+        except Saturated as e:
+            return saturated_response(e)
+        if model_ids is None and fastest_k is None and latency_budget is None:
+            # Plain "all": unavailable (and out of quota) models are still listed, as such
+            available = None
+        return stream_all_models(prompt, api_keys, user_id, conversation_id, use_cache, deadline, wanted, available,
+                                 memory, force_trace)
     
+    if hedge:
+        # hedge=<model_id>: also ask that model if this one is slow to start answering
+        if selected_model not in MODEL_SPECS or hedge not in MODEL_SPECS or hedge == selected_model:
+            return jsonify({'error': 'hedge must be a different, valid model'}), 400
+        try:
+            DISPATCHER.admit(provider_counts([selected_model, hedge]),
+                             max(LATENCY.budget(model_id, deadline)['total'] for model_id in (selected_model, hedge)))
+        except Saturated as e:
+            return saturated_response(e)
+        return hedged_response(prompt, api_keys, user_id, conversation_id, use_cache, deadline,
+                               selected_model, hedge, memory, force_trace)
+    
+    scope = None
+    watch = None
+    call = None
+    response = None
+    status = 'error'
+    error = None
+    trace = None
     try:
+        resolve_started = time.monotonic()
         model_function = get_model_function(selected_model, api_keys)
         
         if not model_function:
             return jsonify({'error': 'Invalid model selected'}), 400
         
-        response = model_function(prompt)
+        budget = LATENCY.budget(selected_model, deadline)
+        DISPATCHER.admit(provider_counts([selected_model]), budget['total'])
+        # Checked before the breaker, so a skipped call does not take a half-open trial
+        wait = USAGE.quota_wait(selected_model, api_key_for(selected_model, api_keys))
+        if wait is not None:
+            model_skipped(selected_model, MODEL_PROVIDERS[selected_model])
+            return quota_response(selected_model, api_keys, wait)
+        if not BREAKERS.allow(selected_model):
+            model_skipped(selected_model, MODEL_PROVIDERS[selected_model])
+            return unavailable_response(selected_model)
+        trace = TRACER.start(uuid.uuid4().hex, f"generate {selected_model}", force=force_trace)
+        if trace is not None:
+            @after_this_request
+            def add_trace_id(response):
+                response.headers['X-Trace-Id'] = trace.trace_id
+                return response
+        # Streamed internally (deltas discarded) so a cancel can abort the request mid-flight
+        call = start_call(selected_model, lambda text: None, use_cache, budget,
+                          history=conversation_thread(user_id, conversation_id, selected_model, memory), trace=trace)
+        call.span('get_model_function', resolve_started, call.started_at)
+        scope = CANCELLATIONS.open(user_id, conversation_id)
+        future = DISPATCHER.submit(user_id, MODEL_PROVIDERS[selected_model], queued(model_function, call),
+                                   prompt, call)
+        scope.add(future.cancel)
+        scope.add(call.cancel)
+        watch = watch_first_token(call, budget, lambda: cancel_if_silent(call))
+        try:
+            response = future.result(timeout=budget['total'])
+        except TimeoutError:
+            future.cancel()
+            call.cancel('timed out')
+            status = 'timeout'
+            return jsonify({'error': timeout_message(budget)}), 504
+        except Cancelled as e:
+            if e.reason != 'timed out' or scope.cancelled:
+                raise
+            status = 'timeout'
+            return jsonify({'error': timeout_message(budget, first_token=True)}), 504
+        status = 'success'
         
         return jsonify({
             'model': MODEL_NAMES.get(selected_model),
-            'response': response
+            'response': response,
+            'cached': call.cache_status == 'hit'
         })
+    except Saturated as e:
+        return saturated_response(e)
+    except (Cancelled, CancelledError) as e:
+        status = 'cancelled'
+        return jsonify({'error': 'Operation cancelled'}), 409
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        error = e
+        return jsonify({'error': error_message(selected_model, e)}), 500
+    finally:
+        if watch is not None:
+            TIMER.cancel(watch[0])
+        if call is not None:
+            record_call(selected_model, call, status, error)
+            archive_call(prompt, selected_model, call, status, response, error, user_id)
+        if trace is not None:
+            TRACER.finish(trace, TIMER.call_later)
+        if scope is not None:
+            CANCELLATIONS.close(user_id, conversation_id, scope)
+
+def sse(event_data):
+    return f"data: {json.dumps(event_data)}\n\n"
+
+def delta_event(model_id, seq, text):
+    return {
+        'event': 'model_delta',
+        'model_id': model_id,
+        'seq': seq,
+        'delta': text
+    }
 
-def stream_all_models(prompt, api_keys):
-    def generate():
-        event_queue = queue.Queue()
-        executor = ThreadPoolExecutor(max_workers=len(MODEL_NAMES))
+def throttle_event(model_id, info):
+    # The model is waiting for a rate limit slot ('queued') or to retry ('retry')
+    event_data = {'event': 'model_throttled', 'model_id': model_id}
+    event_data.update(info)
+    return event_data
+
+class FanOut:
+    # Runs a fan-out in the background and publishes its events to a Run, so the
+    # models keep going while the browser reconnects. Everything is driven by
+    # callbacks: worker threads report deltas and completions, the shared timer flushes
+    # held deltas and enforces each model's deadlines, and nothing polls.
+    #
+    # model_ids: which models to ask (all of them by default)
+    # wanted: stop once this many have answered and cancel the rest (race / first_n)
+    # hedges: {model_id: delay} models only started if no model has begun answering
+    #     after `delay` seconds, or as soon as every started model has failed
+    # trace: the run's Trace when it is sampled (see tracing.py)
+    def __init__(self, run, prompt, api_keys, user_id, conversation_id, use_cache=True, deadline=None,
+                 model_ids=None, wanted=None, hedges=None, memory=True, trace=None):
+        self.run = run
+        self.prompt = prompt
+        self.api_keys = api_keys
+        self.user_id = user_id
+        self.conversation_id = conversation_id
+        self.use_cache = use_cache
+        self.memory = memory
+        self.model_ids = list(MODEL_NAMES if model_ids is None else model_ids)
+        self.wanted = wanted
+        self.hedges = dict(hedges or {})
+        self.trace = trace
+        # Every model gets its own budget, capped by the request's deadline if any
+        self.budgets = {model_id: LATENCY.budget(model_id, deadline) for model_id in self.model_ids}
+        self.batcher = DeltaBatcher()
+        self.futures = {}
+        self.calls = {}
+        # Models launched (or skipped as unavailable), in order, and those that have ended
+        self.started = []
+        self.reported = set()
+        # model_id -> final event, and the responses of the models that answered
+        self.outcomes = {}
+        self.results = {}
+        self.done = False
+        self.finished = threading.Event()
+        self._lock = threading.Lock()
+        self._flush_timer = None
+        self._grace_timer = None
+        self._deadline_timers = []
+        self._first_token_watches = []
+        self.scope = None
+
+    def start(self):
+        self.run.publish({'event': 'run_started', 'run_id': self.run.run_id, 'wanted': self.wanted,
+                          'trace_url': f"/debug/trace/{self.run.run_id}" if self.trace is not None else None})
+        self.scope = CANCELLATIONS.open(self.user_id, self.conversation_id)
+        # /cancel_operations (or nobody listening for too long) ends the run right away
+        self.scope.add(lambda: self._finish(self.scope.reason))
+        self.run.scope = self.scope
+        self.run.on_abandoned = self._abandoned
         
-        def process_model(model_id):
-            try:
-                model_function = get_model_function(model_id, api_keys)
-                
-                # Send model starting event
-                event_data = {
-                    'event': 'model_started',
-                    'model_id': model_id,
-                    'model_name': MODEL_NAMES.get(model_id)
-                }
-                event_queue.put(f"data: {json.dumps(event_data)}\n\n")
-                
-                # Create a Future for the model response with a timeout
-                future = executor.submit(model_function, prompt)
-                try:
-                    # Wait for the model to respond with a timeout
-                    response = future.result(timeout=MODEL_TIMEOUT_SECONDS)
-                    
-                    # Send model completed event
+        # Queue the models on the shared dispatcher; they start as soon as a worker and
+        # a slot for their provider are free
+        for model_id in self.model_ids:
+            if model_id in self.hedges:
+                self._deadline_timers.append(TIMER.call_later(
+                    self.hedges[model_id], lambda model_id=model_id: self._hedge_due(model_id)))
+            elif not self._launch(model_id):
+                break
+        # Every model launched so far was skipped as unavailable: no point waiting to hedge
+        self._launch_hedges_now()
+        self._finish_if_complete()
+
+    def _launch(self, model_id):
+        # Returns False when the run already ended and nothing more should start
+        resolve_started = time.monotonic()
+        model_function = get_model_function(model_id, self.api_keys)
+        budget = self.budgets[model_id]
+        with self._lock:
+            # A cancel can land while we are still queueing; later models never start
+            if self.done:
+                return False
+            self.started.append(model_id)
+            self.run.publish({
+                'event': 'model_started',
+                'model_id': model_id,
+                'model_name': MODEL_NAMES.get(model_id),
+                'deadline_seconds': budget['total'],
+                'hedge': model_id in self.hedges
+            })
+            if USAGE.quota_wait(model_id, api_key_for(model_id, self.api_keys)) is not None:
+                # The key has (nearly) used up its quota for this model; a request would be rejected
+                model_skipped(model_id, MODEL_PROVIDERS[model_id])
+                self._report_locked(model_id, quota_event(model_id, self.api_keys))
+                return True
+            if not BREAKERS.allow(model_id):
+                # Failing lately: report it at once instead of waiting out its deadline
+                model_skipped(model_id, MODEL_PROVIDERS[model_id])
+                self._report_locked(model_id, unavailable_event(model_id))
+                return True
+            call = start_call(model_id, lambda text, model_id=model_id: self._on_delta(model_id, text),
+                              self.use_cache, budget,
+                              lambda info, model_id=model_id: self._on_throttle(model_id, info),
+                              conversation_thread(self.user_id, self.conversation_id, model_id, self.memory),
+                              self.trace)
+            call.span('get_model_function', resolve_started, call.started_at)
+            self.calls[model_id] = call
+        future = DISPATCHER.submit(self.user_id, MODEL_PROVIDERS[model_id], queued(model_function, call),
+                                   self.prompt, call)
+        self.futures[model_id] = future
+        # Queued calls are dropped, running ones have their stream aborted
+        self.scope.add(future.cancel)
+        self.scope.add(call.cancel)
+        self._first_token_watches.append(watch_first_token(
+            call, budget, lambda: self._expire(model_id, timeout_message(budget, first_token=True))))
+        self._deadline_timers.append(TIMER.call_later(
+            budget['total'], lambda: self._expire(model_id, timeout_message(budget))))
+        future.add_done_callback(lambda f: self._on_done(model_id, f))
+        return True
+
+    def _hedge_due(self, model_id):
+        # Only worth a duplicate request if nobody has started answering yet
+        with self._lock:
+            if self.done or model_id not in self.hedges:
+                return
+            answering = any(call.first_delta_at is not None for call in self.calls.values())
+            del self.hedges[model_id]
+        if not answering:
+            self._launch(model_id)
+        self._finish_if_complete()
+
+    def _launch_hedges_now(self):
+        # Every started model has ended without an answer: stop waiting for the hedge delay
+        with self._lock:
+            if self.done or len(self.reported) < len(self.started):
+                return
+            hedges, self.hedges = list(self.hedges), {}
+        for model_id in hedges:
+            self._launch(model_id)
+
+    def _report_locked(self, model_id, event_data):
+        self.reported.add(model_id)
+        self.outcomes[model_id] = event_data
+        self.run.publish(event_data)
+
+    def _finish_if_complete(self):
+        with self._lock:
+            complete = not self.hedges and len(self.reported) == len(self.started)
+            enough = self.wanted is not None and len(self.results) >= self.wanted
+        if enough:
+            self._finish('outpaced')
+        elif complete:
+            self._finish(None)
+
+    def _expire(self, model_id, error):
+        # This model is past its deadline; the others carry on
+        with self._lock:
+            if self.done or model_id in self.reported:
+                return
+            self.batcher.flush(model_id)
+            self._report_locked(model_id, {
+                'event': 'model_error',
+                'model_id': model_id,
+                'model_name': MODEL_NAMES.get(model_id),
+                'error': error,
+                'status': 'timeout'
+            })
+        # Drop it from the queue if it never started, abort its request if it did
+        self.futures[model_id].cancel()
+        self.calls[model_id].cancel('timed out')
+        record_call(model_id, self.calls[model_id], 'timeout')
+        archive_call(self.prompt, model_id, self.calls[model_id], 'timeout', error=error, user_id=self.user_id,
+                     run_id=self.run.run_id)
+        self._launch_hedges_now()
+        self._finish_if_complete()
+
+    def _on_delta(self, model_id, text):
+        # Deltas are held briefly and published in batches; the timer sends late ones
+        with self._lock:
+            if self.done or model_id in self.reported:
+                return
+            batch = self.batcher.add(model_id, text)
+            if batch:
+                self.run.publish(delta_event(model_id, *batch))
+            self._schedule_flush_locked()
+
+    def _on_throttle(self, model_id, info):
+        with self._lock:
+            if self.done or model_id in self.reported:
+                return
+            self.run.publish(throttle_event(model_id, info))
+
+    def _schedule_flush_locked(self):
+        flush_in = self.batcher.next_flush_in()
+        if flush_in is not None and self._flush_timer is None:
+            self._flush_timer = TIMER.call_later(flush_in, self._flush_due)
+
+    def _flush_due(self):
+        with self._lock:
+            self._flush_timer = None
+            if self.done:
+                return
+            for model_id, seq, text in self.batcher.flush_due():
+                self.run.publish(delta_event(model_id, seq, text))
+            self._schedule_flush_locked()
+
+    def _on_done(self, model_id, future):
+        if future.cancelled():
+            return
+        call = self.calls[model_id]
+        error = None
+        try:
+            response = future.result()
+            event_data = {
+                'event': 'model_completed',
+                'model_id': model_id,
+                'model_name': MODEL_NAMES.get(model_id),
+                'response': response,
+                'status': 'success',
+                # Cache hits replay through the same events, flagged so the UI can tell
+                'cached': call.cache_status == 'hit',
+                'cache': call.cache_status
+            }
+        except Exception as e:
+            error = e
+            event_data = {
+                'event': 'model_error',
+                'model_id': model_id,
+                'model_name': MODEL_NAMES.get(model_id),
+                'error': error_message(model_id, e),
+                'status': 'error'
+            }
+        with self._lock:
+            if self.done or model_id in self.reported:
+                return
+            # Anything still buffered for this model goes out before its completion
+            batch = self.batcher.flush(model_id)
+            if batch:
+                self.run.publish(delta_event(model_id, *batch))
+            self._report_locked(model_id, event_data)
+            if error is None:
+                self.results[model_id] = response
+                # Someone answered, so hedges still waiting are not needed
+                self.hedges.clear()
+        record_call(model_id, call, event_data['status'], error)
+        archive_call(self.prompt, model_id, call, event_data['status'], event_data.get('response'), error, self.user_id,
+                     self.run.run_id)
+        if error is not None:
+            self._launch_hedges_now()
+        self._finish_if_complete()
+
+    def _finish(self, reason):
+        # reason is None when every model answered or timed out, 'outpaced' when enough
+        # models have answered, otherwise why the rest are stopped
+        with self._lock:
+            if self.done:
+                return
+            self.done = True
+            outstanding = [model_id for model_id in self.started if model_id not in self.reported]
+            for model_id in outstanding:
+                if reason == 'outpaced':
+                    # Not an error: the UI drops the models that lost the race
                     event_data = {
-                        'event': 'model_completed',
+                        'event': 'model_error',
                         'model_id': model_id,
                         'model_name': MODEL_NAMES.get(model_id),
-                        'response': response,
-                        'status': 'success'
+                        'error': 'Not needed, enough models already answered',
+                        'status': 'outpaced'
                     }
-                    event_queue.put(f"data: {json.dumps(event_data)}\n\n")
-                except TimeoutError:
-                    # Cancel the future if possible
-                    future.cancel()
-                    # Send timeout event
+                else:
                     event_data = {
                         'event': 'model_error',
                         'model_id': model_id,
                         'model_name': MODEL_NAMES.get(model_id),
-                        'error': f"Model response timed out after {MODEL_TIMEOUT_SECONDS} seconds",
-                        'status': 'timeout'
+                        'error': 'Operation cancelled',
+                        'status': 'cancelled'
                     }
-                    event_queue.put(f"data: {json.dumps(event_data)}\n\n")
-                    
-            except Exception as e:
-                # Send error event
-                event_data = {
-                    'event': 'model_error',
-                    'model_id': model_id,
-                    'model_name': MODEL_NAMES.get(model_id),
-                    'error': str(e),
-                    'status': 'error'
-                }
-                event_queue.put(f"data: {json.dumps(event_data)}\n\n")
-        
-        # Start all models in parallel
-        futures = []
-        for model_id in MODEL_NAMES:
-            thread_func = copy_current_request_context(process_model)
-            futures.append(executor.submit(thread_func, model_id))
-        
-        # Start a monitoring thread to check for completion
-        all_done = threading.Event()
+                self._report_locked(model_id, event_data)
+            self.run.publish({'event': 'all_completed', 'answered': list(self.results)})
+        if self.trace is not None:
+            TRACER.finish(self.trace, TIMER.call_later)
         
-        def monitor_futures():
-            try:
-                for future in futures:
-                    # Wait for all threads with a reasonable timeout
-                    future.result(timeout=MODEL_TIMEOUT_SECONDS + 5)  # Give a little extra time for cleanup
-            except TimeoutError:
-                # Just log this, individual model timeouts are handled in process_model
-                pass
-            except Exception as e:
-                print(f"Error in monitor_futures: {str(e)}")
-            finally:
-                # Always set all_done to ensure we exit properly
-                all_done.set()
-                # Send completion event
-                event_queue.put(f"data: {json.dumps({'event': 'all_completed'})}\n\n")
-        
-        monitor_thread = threading.Thread(target=monitor_futures)
-        monitor_thread.daemon = True
-        monitor_thread.start()
-        
-        # Set an overall timeout in case the monitor thread itself gets stuck
-        overall_timeout = threading.Timer(
-            MODEL_TIMEOUT_SECONDS * 1.5,  # 150% of the model timeout
-            lambda: all_done.set() if not all_done.is_set() else None
-        )
-        overall_timeout.daemon = True
-        overall_timeout.start()
-        
-        # Yield events as they become available
-        while not (all_done.is_set() and event_queue.empty()):
-            try:
-                # Get events with a timeout to check if we're done
-                event = event_queue.get(timeout=0.1)
-                yield event
-            except queue.Empty:
-                # No events right now, continue checking
-                pass
-                
-        # Clean up the overall timeout if it's still active
-        if overall_timeout.is_alive():
-            overall_timeout.cancel()
-    
-    return Response(stream_with_context(generate()), 
+        # Outside the lock: cancelling runs done callbacks and stream aborts inline.
+        # Drop what never started, abort what did, so losers stop using quota too.
+        for model_id in outstanding:
+            future = self.futures.get(model_id)
+            if future is not None:
+                future.cancel()
+            call = self.calls.get(model_id)
+            if call is not None:
+                call.cancel(reason)
+                record_call(model_id, call, 'cancelled')
+        watches = [watch[0] for watch in self._first_token_watches]
+        for timer in [self._flush_timer, self._grace_timer] + self._deadline_timers + watches:
+            TIMER.cancel(timer)
+        CANCELLATIONS.close(self.user_id, self.conversation_id, self.scope)
+        RUNS.finish(self.run)
+        self.finished.set()
+
+    def _abandoned(self, run):
+        # The last listener went away; give the browser a chance to reconnect first
+        TIMER.cancel(self._grace_timer)
+        self._grace_timer = TIMER.call_later(RESUME_GRACE_SECONDS, self._grace_expired)
+
+    def _grace_expired(self):
+        if self.run.subscribers == 0 and not self.done:
+            self.scope.cancel('disconnected')
+
+def event_stream(run, after_seq=0):
+    return Response(tracked_stream(run.follow(after_seq)),
                    mimetype='text/event-stream',
                    headers={'Cache-Control': 'no-cache',
                            'X-Accel-Buffering': 'no'})
 
-# Store active conversations and their cancellation status
-active_conversations = {}
+def stream_all_models(prompt, api_keys, user_id, conversation_id, use_cache=True, deadline=None, wanted=None,
+                      model_ids=None, memory=True, force_trace=False):
+    run = RUNS.create(len(MODEL_NAMES if model_ids is None else model_ids), user_id)
+    FanOut(run, prompt, api_keys, user_id, conversation_id, use_cache, deadline,
+           model_ids=model_ids, wanted=wanted, memory=memory,
+           trace=TRACER.start(run.run_id, 'generate all', force=force_trace)).start()
+    return event_stream(run)
+
+# HTTP status for a hedged call where neither model answered, by the primary's outcome
+HEDGE_FAILURE_STATUS = {'timeout': 504, 'unavailable': 503, 'quota': 429, 'cancelled': 409}
+
+def hedged_response(prompt, api_keys, user_id, conversation_id, use_cache, deadline, primary, fallback, memory=True,
+                    force_trace=False):
+    # A race between the primary and a fallback that is only started if the primary has
+    # not begun answering within its usual time to first token (or fails first)
+    run = RUNS.create(2, user_id)
+    trace = TRACER.start(run.run_id, f"generate {primary} hedged by {fallback}", force=force_trace)
+    if trace is not None:
+        @after_this_request
+        def add_trace_id(response):
+            response.headers['X-Trace-Id'] = trace.trace_id
+            return response
+    fanout = FanOut(run, prompt, api_keys, user_id, conversation_id, use_cache, deadline,
+                    model_ids=[primary, fallback], wanted=1,
+                    hedges={fallback: LATENCY.hedge_delay(primary)}, memory=memory, trace=trace)
+    fanout.start()
+    fanout.finished.wait()
+    hedged = fallback in fanout.started
+    for model_id, response in fanout.results.items():
+        return jsonify({
+            'model': MODEL_NAMES.get(model_id),
+            'model_id': model_id,
+            'response': response,
+            'cached': fanout.outcomes[model_id].get('cached', False),
+            'hedged': hedged
+        })
+    outcome = fanout.outcomes.get(primary, {'status': 'cancelled', 'error': 'Operation cancelled'})
+    return jsonify({'error': outcome['error'], 'hedged': hedged}), HEDGE_FAILURE_STATUS.get(outcome['status'], 500)
+
+def run_job_task(task, done):
+    # One prompt/model pair of a batch job (see jobs.py). It goes through the shared
+    # dispatcher under the job's own queue, so a big job takes turns with interactive
+    # users, and through the same rate limits and circuit breakers as /generate.
+    model_id = task['model_id']
+    wait = USAGE.quota_wait(model_id, api_key_for(model_id, task['api_keys']))
+    if wait is not None:
+        # Out of quota for now: back in the queue until the key has room again
+        model_skipped(model_id, MODEL_PROVIDERS[model_id])
+        done(task, {'status': 'quota', 'error': USAGE.quota_message(model_id, api_key_for(model_id, task['api_keys']))},
+             retry_in=wait, attempted=False)
+        return None
+    if not BREAKERS.allow(model_id):
+        model_skipped(model_id, MODEL_PROVIDERS[model_id])
+        done(task, {'status': 'unavailable', 'error': BREAKERS.unavailable_message(model_id)},
+             retry_in=BREAKERS.retry_in(model_id), attempted=False)
+        return None
+    model_function = get_model_function(model_id, task['api_keys'])
+    budget = LATENCY.budget(model_id, None)
+    call = start_call(model_id, lambda text: None, task['use_cache'], budget)
+    future = DISPATCHER.submit(f"job:{task['job_id']}", MODEL_PROVIDERS[model_id], queued(model_function, call),
+                               task['prompt'], call)
+    watch = watch_first_token(call, budget, lambda: cancel_if_silent(call))
+    timeout = TIMER.call_later(budget['total'], lambda: call.cancel('timed out'))
+    # Cancelling the job drops the call if it is queued and aborts it if it is running
+    scope = CancelScope()
+    scope.add(future.cancel)
+    scope.add(call.cancel)
+
+    def finished(future):
+        TIMER.cancel(watch[0])
+        TIMER.cancel(timeout)
+        status, error, retry_in, attempted = 'error', None, None, True
+        try:
+            response = future.result()
+            status = 'success'
+            record = {'status': 'success', 'response': response}
+        except (Cancelled, CancelledError):
+            if scope.cancelled:
+                status = 'cancelled'
+                record = {'status': 'cancelled', 'error': 'Operation cancelled'}
+            else:
+                status = 'timeout'
+                record = {'status': 'timeout', 'error': timeout_message(budget, call.first_delta_at is None)}
+                retry_in = 0
+        except RateLimited as e:
+            # No slot before the deadline: wait for one in the job queue, not in a worker
+            error = e
+            record = {'status': 'error', 'error': str(e)}
+            retry_in, attempted = e.wait, False
+        except Exception as e:
+            error = e
+            record = {'status': 'error', 'error': error_message(model_id, e, with_type=True)}
+        record_call(model_id, call, status, error)
+        archive_call(task['prompt'], model_id, call, status, record.get('response'), record.get('error'),
+                     task['user_id'], task['job_id'], 'job')
+        record['latency_seconds'] = round(time.monotonic() - call.started_at, 3)
+        record['output_tokens'] = call.output_tokens
+        record['cached'] = call.cache_status == 'hit'
+        done(task, record, retry_in, attempted)
+
+    future.add_done_callback(finished)
+    return scope
+
+def start_job_runner():
+    # Called when a server starts serving (gunicorn.conf.py, asgi.py's lifespan, the dev
+    # server below), so jobs left running before a restart are picked up again once their
+    # leases expire, without waiting for traffic; importing the app starts nothing. Safe
+    # to call again: a runner already going is left alone. Leases keep every task to one
+    # runner across processes.
+    JOBS.start(run_job_task)
+
+def own_job(job_id):
+    job = JOBS.get(job_id)
+    if job is None or job['user_id'] != get_user_id():
+        return None
+    return job
+
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    data = request.json or {}
+    try:
+        prompts = parse_prompts(data.get('prompts'))
+        model_ids = parse_model_list(data.get('models')) or list(MODEL_SPECS)
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+    api_keys = session.get('api_keys', {'github_token': '', 'nvidia_key': ''})
+    missing = [model_id for model_id in model_ids if not api_key_for(model_id, api_keys)]
+    if missing:
+        return jsonify({'error': f"No API key saved for: {', '.join(MODEL_NAMES[model_id] for model_id in missing)}"}), 400
+    if len(prompts) * len(model_ids) > JOBS_MAX_TASKS:
+        return jsonify({'error': f"A job may make at most {JOBS_MAX_TASKS} calls"}), 400
+    use_cache = str(data.get('cache', True)).lower() not in ('false', '0', 'no', 'off')
+    # Covers servers started without one of start_job_runner's hooks
+    start_job_runner()
+    job = JOBS.create(get_user_id(), prompts, model_ids, api_keys, use_cache)
+    job_id = job.pop('job_id')
+    job.pop('user_id')
+    return jsonify(dict(job, job_id=job_id, status_url=f"/jobs/{job_id}",
+                        results_url=f"/jobs/{job_id}/results")), 202
+
+@app.route('/jobs', methods=['GET'])
+def list_jobs():
+    jobs = JOBS.list(get_user_id())
+    for job in jobs:
+        job.pop('user_id')
+    return jsonify({'jobs': jobs})
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = own_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    job.pop('user_id')
+    return jsonify(job)
+
+@app.route('/jobs/<job_id>/results', methods=['GET'])
+def job_results(job_id):
+    # Every finished call as it comes in, as server-sent events (id = result number, so
+    # a reconnecting EventSource resumes where it left off) or with format=ndjson as
+    # one JSON line per result; after=<n> skips the first n results
+    if own_job(job_id) is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    try:
+        after = int(request.headers.get('Last-Event-ID') or request.args.get('after') or 0)
+    except ValueError:
+        return jsonify({'error': 'after must be a result number'}), 400
+    if request.args.get('format') == 'ndjson':
+        return Response(tracked_stream(JOBS.follow(job_id, after, sse=False)), mimetype='application/x-ndjson',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    return Response(tracked_stream(JOBS.follow(job_id, after)), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    if own_job(job_id) is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify({'success': True, 'cancelled': JOBS.cancel(job_id)})
+
+@app.route('/job_stats', methods=['GET'])
+def job_stats():
+    return jsonify(JOBS.stats())
 
 @app.route('/cancel_operations', methods=['POST'])
 def cancel_operations():
@@ -231,11 +1036,23 @@ def cancel_operations():
     conversation_id = data.get('conversation_id')
     
     if conversation_id:
-        # Mark this conversation as cancelled
-        active_conversations[conversation_id] = 'cancelled'
-        return jsonify({'success': True, 'message': 'Operations cancelled'})
+        # Abort every model call this user still has running for this conversation
+        cancelled = CANCELLATIONS.cancel(get_user_id(), conversation_id)
+        return jsonify({'success': True, 'message': 'Operations cancelled', 'cancelled_runs': cancelled})
+    else:
+        return jsonify({'success': False, 'error': 'No conversation ID provided'}), 400
+
+@app.route('/forget_conversation', methods=['POST'])
+def forget_conversation():
+    data = request.json
+    conversation_id = data.get('conversation_id')
+    
+    if conversation_id:
+        forgotten = CONVERSATIONS.forget(get_user_id(), conversation_id)
+        return jsonify({'success': True, 'forgotten': forgotten})
     else:
         return jsonify({'success': False, 'error': 'No conversation ID provided'}), 400
 
 if __name__ == '__main__':
+    start_job_runner()
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,304 @@
+import os
+import json
+import time
+import zlib
+import queue
+import sqlite3
+import hashlib
+import threading
+
+from model_registry import MODEL_SPECS, MODEL_NAMES
+
+# Local archive of every answer the app and rawcode.py get: prompt, model, sampling
+# parameters, response, latency and status, in an append-only SQLite file. Texts are
+# stored zlib-compressed, each distinct prompt once (keyed by its SHA-256), and an FTS5
+# index over prompts and responses makes a search a handful of B-tree lookups however
+# many answers are stored, as is finding every answer to the same prompt by its hash.
+#
+# Recording never touches the disk on the request path: records go into a bounded
+# queue and a writer thread stores them in batches, one transaction each. When the
+# queue is full (the disk cannot keep up) records are dropped and counted, never waited for.
+ARCHIVE_ENABLED = os.getenv('ARCHIVE_ENABLED', 'true').lower() == 'true'
+ARCHIVE_DB = os.getenv('ARCHIVE_DB', 'archive.db')
+ARCHIVE_BATCH_SIZE = int(os.getenv('ARCHIVE_BATCH_SIZE', '500'))
+# How long the writer lets records gather before writing a batch
+ARCHIVE_FLUSH_SECONDS = float(os.getenv('ARCHIVE_FLUSH_SECONDS', '1'))
+ARCHIVE_QUEUE_SIZE = int(os.getenv('ARCHIVE_QUEUE_SIZE', '10000'))
+ARCHIVE_MAX_RESULTS = 200
+
+# Outcomes worth keeping; cancelled, outpaced and skipped calls have no answer
+ARCHIVED_STATUSES = ('success', 'error', 'timeout')
+
+
+def prompt_hash(prompt):
+    return hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+
+
+def _pack(text):
+    return zlib.compress(text.encode('utf-8'), 6) if text is not None else None
+
+
+def _unpack(blob):
+    return zlib.decompress(blob).decode('utf-8') if blob is not None else None
+
+
+def fts_query(text):
+    # Every word must appear, in any order; quoted so punctuation is never FTS5 syntax
+    words = text.split()
+    if not words:
+        raise ValueError('search text is empty')
+    return ' '.join('"' + word.replace('"', '""') + '"' for word in words)
+
+
+class Archive:
+    def __init__(self, path=ARCHIVE_DB, enabled=ARCHIVE_ENABLED, batch_size=ARCHIVE_BATCH_SIZE,
+                 flush_seconds=ARCHIVE_FLUSH_SECONDS, queue_size=ARCHIVE_QUEUE_SIZE):
+        self.path = path
+        self.enabled = enabled
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self._queue = queue.Queue(maxsize=queue_size)
+        # Counters; the writer's connection is only used by the writer thread, searches
+        # have their own, and in WAL mode neither waits for the other
+        self._lock = threading.Lock()
+        self._open_lock = threading.Lock()
+        self._read_lock = threading.Lock()
+        self._db = None
+        self._reader = None
+        self._thread = None
+        self._fts = None
+        # Parameter sets are few and stored once each: json -> params row id
+        self._params = {}
+        self.queued = 0
+        self.dropped = 0
+        self.written = 0
+        self.batches = 0
+        self.write_errors = 0
+
+    def _connect(self):
+        # Opened on first use, so importing the app touches no file
+        if self._db is not None:
+            return self._db
+        with self._open_lock:
+            if self._db is not None:
+                return self._db
+            db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS prompts ('
+                'id INTEGER PRIMARY KEY, hash TEXT NOT NULL UNIQUE, prompt BLOB NOT NULL, created_at REAL NOT NULL)'
+            )
+            db.execute('CREATE TABLE IF NOT EXISTS params (id INTEGER PRIMARY KEY, value TEXT NOT NULL UNIQUE)')
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                'id INTEGER PRIMARY KEY, prompt_id INTEGER NOT NULL, params_id INTEGER NOT NULL, '
+                'model_id TEXT NOT NULL, status TEXT NOT NULL, latency_seconds REAL, output_tokens INTEGER, '
+                'cached INTEGER NOT NULL, source TEXT NOT NULL, user_id TEXT, run_id TEXT, '
+                'created_at REAL NOT NULL, response BLOB, error TEXT)'
+            )
+            db.execute('CREATE INDEX IF NOT EXISTS responses_prompt ON responses (prompt_id, id)')
+            db.execute('CREATE INDEX IF NOT EXISTS responses_model ON responses (model_id, id)')
+            db.execute('CREATE INDEX IF NOT EXISTS responses_user ON responses (user_id, id)')
+            try:
+                # Contentless: the index holds only the words, the texts stay compressed
+                # in the tables above. Its rowid is the response's id.
+                db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS responses_fts "
+                           "USING fts5(prompt, response, content='')")
+                self._fts = True
+            except sqlite3.OperationalError:
+                # SQLite built without FTS5: prompt hash lookups still work
+                self._fts = False
+            self._db = db
+        return db
+
+    def record(self, prompt, model_id, status, response=None, error=None, latency_seconds=None,
+               output_tokens=None, cached=False, source='web', user_id=None, run_id=None, memory=False):
+        # Queues one answer for the writer; returns at once whatever the disk is doing
+        if not self.enabled or status not in ARCHIVED_STATUSES or not prompt:
+            return
+        self._start()
+        item = (prompt, model_id, status, response if isinstance(response, str) else None,
+                str(error) if error is not None else None, latency_seconds, output_tokens, bool(cached),
+                source, user_id, run_id, bool(memory), time.time())
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return
+        with self._lock:
+            self.queued += 1
+
+    def _start(self):
+        # The writer starts with the first record, so gunicorn forks first
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='archive', daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            gather_until = time.monotonic() + self.flush_seconds
+            while len(batch) < self.batch_size:
+                left = gather_until - time.monotonic()
+                if left <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=left))
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            except sqlite3.Error:
+                with self._lock:
+                    self.write_errors += 1
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _params_id(self, db, value, added):
+        params_id = self._params.get(value) or added.get(value)
+        if params_id is None:
+            db.execute('INSERT OR IGNORE INTO params (value) VALUES (?)', (value,))
+            params_id = added[value] = db.execute('SELECT id FROM params WHERE value = ?', (value,)).fetchone()[0]
+        return params_id
+
+    def _write(self, batch):
+        db = self._connect()
+        prompt_ids, added = {}, {}
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            for (prompt, model_id, status, response, error, latency_seconds, output_tokens, cached,
+                 source, user_id, run_id, memory, created_at) in batch:
+                digest = prompt_hash(prompt)
+                prompt_id = prompt_ids.get(digest)
+                if prompt_id is None:
+                    row = db.execute('SELECT id FROM prompts WHERE hash = ?', (digest,)).fetchone()
+                    if row is None:
+                        prompt_id = db.execute('INSERT INTO prompts (hash, prompt, created_at) VALUES (?, ?, ?)',
+                                               (digest, _pack(prompt), created_at)).lastrowid
+                    else:
+                        prompt_id = row[0]
+                    prompt_ids[digest] = prompt_id
+                spec = MODEL_SPECS.get(model_id, {})
+                params = json.dumps(dict(spec.get('params', {}), model_name=spec.get('model_name'), memory=memory),
+                                    sort_keys=True)
+                response_id = db.execute(
+                    'INSERT INTO responses (prompt_id, params_id, model_id, status, latency_seconds, '
+                    'output_tokens, cached, source, user_id, run_id, created_at, response, error) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (prompt_id, self._params_id(db, params, added), model_id, status,
+                     round(latency_seconds, 3) if latency_seconds is not None else None, output_tokens,
+                     int(cached), source, user_id, run_id, created_at, _pack(response), error)).lastrowid
+                if self._fts:
+                    db.execute('INSERT INTO responses_fts (rowid, prompt, response) VALUES (?, ?, ?)',
+                               (response_id, prompt, response or error or ''))
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+        # Only ids of committed rows are remembered
+        self._params.update(added)
+        with self._lock:
+            self.written += len(batch)
+            self.batches += 1
+
+    def flush(self):
+        # Waits until everything recorded so far is on disk (rawcode.py before exiting)
+        if self._thread is not None:
+            self._queue.join()
+
+    def _read(self, sql, args=()):
+        self._connect()
+        with self._read_lock:
+            if self._reader is None:
+                self._reader = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+            return self._reader.execute(sql, args).fetchall()
+
+    def _rows(self, where, args, limit, text=False):
+        # text: walk the full-text matches newest first, so a search stops at `limit`
+        # however many answers match
+        source = ('responses_fts f JOIN responses r ON r.id = f.rowid' if text else 'responses r')
+        sql = ('SELECT r.id, p.hash, p.prompt, r.model_id, pa.value, r.status, r.latency_seconds, '
+               'r.output_tokens, r.cached, r.source, r.run_id, r.created_at, r.response, r.error '
+               f"FROM {source} JOIN prompts p ON p.id = r.prompt_id JOIN params pa ON pa.id = r.params_id "
+               f"WHERE {' AND '.join(where) or '1'} ORDER BY {'f.rowid' if text else 'r.id'} DESC LIMIT ?")
+        rows = self._read(sql, list(args) + [limit])
+        return [{
+            'id': response_id,
+            'prompt_hash': digest,
+            'prompt': _unpack(prompt),
+            'model_id': model_id,
+            'model_name': MODEL_NAMES.get(model_id),
+            'params': json.loads(params),
+            'status': status,
+            'latency_seconds': latency_seconds,
+            'output_tokens': output_tokens,
+            'cached': bool(cached),
+            'source': source,
+            'run_id': run_id,
+            'created_at': created_at,
+            'response': _unpack(response),
+            'error': error,
+        } for (response_id, digest, prompt, model_id, params, status, latency_seconds, output_tokens, cached,
+               source, run_id, created_at, response, error) in rows]
+
+    def search(self, text=None, prompt=None, digest=None, model_id=None, status=None, since=None,
+               user_id=None, limit=50):
+        # Newest first. text: words in the prompt or the answer; prompt (or its hash):
+        # every answer to exactly that prompt. user_id=None searches everyone's answers.
+        where, args = [], []
+        if prompt is not None:
+            digest = prompt_hash(prompt)
+        if digest is not None:
+            where.append('p.hash = ?')
+            args.append(digest)
+        if text:
+            self._connect()
+            if not self._fts:
+                raise ValueError('full-text search needs SQLite with FTS5')
+            where.append('responses_fts MATCH ?')
+            args.append(fts_query(text))
+        for column, value in (('r.model_id', model_id), ('r.status', status), ('r.user_id', user_id)):
+            if value is not None:
+                where.append(f"{column} = ?")
+                args.append(value)
+        if since is not None:
+            where.append('r.created_at >= ?')
+            args.append(since)
+        return self._rows(where, args, max(1, min(limit, ARCHIVE_MAX_RESULTS)), text=bool(text))
+
+    def get(self, response_id, user_id=None):
+        where, args = ['r.id = ?'], [response_id]
+        if user_id is not None:
+            where.append('r.user_id = ?')
+            args.append(user_id)
+        rows = self._rows(where, args, 1)
+        return rows[0] if rows else None
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                'enabled': self.enabled,
+                'path': self.path,
+                'queued': self.queued,
+                'pending': self._queue.qsize(),
+                'dropped': self.dropped,
+                'written': self.written,
+                'batches': self.batches,
+                'write_errors': self.write_errors,
+                'full_text': self._fts,
+            }
+        if self.enabled and os.path.exists(self.path):
+            # MAX(id) rather than COUNT(*): the tables are append-only and may be huge
+            stats['responses'] = self._read('SELECT MAX(id) FROM responses')[0][0] or 0
+            stats['prompts'] = self._read('SELECT MAX(id) FROM prompts')[0][0] or 0
+            stats['file_bytes'] = os.path.getsize(self.path)
+        return stats
+
+
+# Shared by every request handled by this process
+ARCHIVE = Archive()
@@ -0,0 +1,262 @@
+import asyncio
+import json
+from urllib.parse import parse_qs
+
+from asgiref.wsgi import WsgiToAsgi
+from flask import request as flask_request
+
+from app import app, FANOUT_ENGINE, parse_mode, start_job_runner
+from async_engine import start_all_models_async
+from channels import CHANNELS
+from dispatcher import Saturated
+from latency import parse_deadline
+from model_selection import select_models, parse_model_list, parse_fastest_k, parse_latency_budget
+from metrics import stream_opened, stream_closed
+from runs import RUNS, SSE_HEARTBEAT_SECONDS, SSE_RETRY_MS, parse_last_event_id, sse_text
+
+# ASGI entry point: `uvicorn asgi:application` or
+# `gunicorn -k uvicorn.workers.UvicornWorker asgi:application`.
+# With FANOUT_ENGINE=async (or ?engine=async on a request) the "all models" stream is
+# served by the asyncio engine; everything else goes to the Flask app unchanged.
+# /channel is a WebSocket carrying all of a browser tab's prompts (see channels.py);
+# uvicorn serves WebSockets with the `websockets` package.
+flask_application = WsgiToAsgi(app)
+
+SSE_HEADERS = [
+    (b'content-type', b'text/event-stream'),
+    (b'cache-control', b'no-cache'),
+    (b'x-accel-buffering', b'no'),
+]
+
+def _header(scope, name):
+    for key, value in scope.get('headers', []):
+        if key == name:
+            return value.decode('latin-1')
+    return ''
+
+def _load_session(scope):
+    # Let Flask's session interface decode the cookie so both engines see the same keys
+    with app.test_request_context('/', headers={'Cookie': _header(scope, b'cookie')}):
+        return app.session_interface.open_session(app, flask_request) or {}
+
+async def _read_body(receive):
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+    return body
+
+def _replay(body, receive):
+    # Hand an already-consumed request body on to the Flask app
+    sent = False
+
+    async def replay_receive():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+        return await receive()
+    return replay_receive
+
+async def _send_json(send, status, payload, headers=()):
+    body = json.dumps(payload).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json')] + list(headers),
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+async def _stream(receive, send, events):
+    await send({'type': 'http.response.start', 'status': 200, 'headers': SSE_HEADERS})
+
+    async def pump():
+        async for event in events:
+            await send({'type': 'http.response.body', 'body': event.encode('utf-8'), 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+    async def wait_for_disconnect():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    pump_task = asyncio.create_task(pump())
+    watch_task = asyncio.create_task(wait_for_disconnect())
+    opened_at = stream_opened()
+    try:
+        await asyncio.wait({pump_task, watch_task}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in (pump_task, watch_task):
+            task.cancel()
+        await asyncio.gather(pump_task, watch_task, return_exceptions=True)
+        # Closing the generator unsubscribes; the run goes on for a reconnect (see _follow)
+        await events.aclose()
+        stream_closed(opened_at)
+
+async def _follow(run, after_seq=0):
+    # Async twin of Run.follow: the run's events after after_seq as SSE text, with a
+    # heartbeat whenever it has been quiet for a while. The run pushes from whichever
+    # thread publishes, so each event hops onto this loop.
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+
+    def listener(seq, event_data):
+        try:
+            loop.call_soon_threadsafe(events.put_nowait, (seq, event_data))
+        except RuntimeError:
+            pass
+
+    yield f"retry: {SSE_RETRY_MS}\n\n"
+    run.subscribe(listener, after_seq)
+    try:
+        while True:
+            try:
+                seq, event_data = await asyncio.wait_for(events.get(), SSE_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": heartbeat\n\n"
+                continue
+            if seq is None:
+                return
+            yield sse_text(run.run_id, seq, event_data)
+    finally:
+        # The last listener leaving starts the run's grace period before it is cancelled
+        run.unsubscribe(listener)
+
+async def _generate_all(scope, receive, send, params):
+    session = _load_session(scope)
+    # Same conversation memory as the Flask app: per browser session, else per client address
+    user_id = session.get('user_id') or (scope.get('client') or ('anonymous',))[0]
+    # A reconnecting EventSource sends the id of the last event it saw, as with the Flask route
+    run_id, after_seq = parse_last_event_id(_header(scope, b'last-event-id') or params.get('last_event_id'))
+    if run_id is not None:
+        run = RUNS.get(run_id)
+        if run is None:
+            # Unknown or expired run: 204 tells EventSource to stop reconnecting
+            await send({'type': 'http.response.start', 'status': 204, 'headers': []})
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+        if run.user_id != user_id:
+            await _send_json(send, 404, {'error': 'Unknown run'})
+            return
+        await _stream(receive, send, _follow(run, after_seq))
+        return
+    prompt = params.get('prompt')
+    if not prompt:
+        await _send_json(send, 400, {'error': 'Prompt is required'})
+        return
+    try:
+        deadline = parse_deadline(params.get('deadline'))
+    except (TypeError, ValueError):
+        await _send_json(send, 400, {'error': 'deadline must be a positive number of seconds'})
+        return
+    try:
+        wanted = parse_mode(params.get('mode'), params.get('n'))
+        model_ids = parse_model_list(params.get('models'))
+        fastest_k = parse_fastest_k(params.get('fastest_k'))
+        latency_budget = parse_latency_budget(params.get('latency_budget'))
+    except (TypeError, ValueError) as e:
+        await _send_json(send, 400, {'error': str(e)})
+        return
+    api_keys = session.get('api_keys', {'github_token': '', 'nvidia_key': ''})
+    if model_ids is not None or fastest_k is not None or latency_budget is not None:
+        # Same selection as the Flask route: only available models with quota left, within the budget
+        model_ids = select_models(model_ids, fastest_k, latency_budget, api_keys)
+        if not model_ids:
+            await _send_json(send, 400, {'error': 'No available model matches the selection'})
+            return
+        if latency_budget is not None:
+            deadline = min(deadline, latency_budget) if deadline is not None else latency_budget
+    conversation_id = params.get('conversation_id', 'default')
+    use_cache = str(params.get('cache', 'true')).lower() not in ('false', '0', 'no', 'off')
+    memory = str(params.get('memory', 'true')).lower() not in ('false', '0', 'no', 'off')
+    # trace=true records this request's trace whatever the sample rate, as with the Flask route
+    force_trace = str(params.get('trace')).lower() in ('true', '1', 'yes', 'on')
+    try:
+        run = start_all_models_async(prompt, api_keys, conversation_id, use_cache, deadline, wanted, model_ids,
+                                     user_id, memory, force_trace)
+    except Saturated as e:
+        await _send_json(send, 503, {'error': e.reason, 'retry_after': e.retry_after},
+                         [(b'retry-after', str(e.retry_after).encode())])
+        return
+    await _stream(receive, send, _follow(run))
+
+async def _channel(scope, receive, send):
+    if (await receive())['type'] != 'websocket.connect':
+        return
+    session = _load_session(scope)
+    await send({'type': 'websocket.accept'})
+    loop = asyncio.get_running_loop()
+    outgoing = asyncio.Queue()
+
+    def push(text):
+        # Runs publish from worker threads; the socket is written from this loop only
+        try:
+            loop.call_soon_threadsafe(outgoing.put_nowait, text)
+        except RuntimeError:
+            pass
+
+    async def pump():
+        while True:
+            await send({'type': 'websocket.send', 'text': await outgoing.get()})
+
+    api_keys = session.get('api_keys', {'github_token': '', 'nvidia_key': ''})
+    user_id = session.get('user_id') or (scope.get('client') or ('anonymous',))[0]
+    channel = CHANNELS.open(api_keys, user_id, push)
+    pump_task = asyncio.create_task(pump())
+    opened_at = stream_opened()
+    try:
+        while not pump_task.done():
+            message = await receive()
+            if message['type'] == 'websocket.disconnect':
+                break
+            if message['type'] == 'websocket.receive':
+                # Starting a run may build a client or queue on the dispatcher: not on the loop.
+                # One message at a time, so a cancel never overtakes the prompt it cancels.
+                await loop.run_in_executor(None, CHANNELS.receive, channel,
+                                           message.get('text') or (message.get('bytes') or b'').decode('utf-8'))
+    finally:
+        CHANNELS.close(channel)
+        pump_task.cancel()
+        await asyncio.gather(pump_task, return_exceptions=True)
+        stream_closed(opened_at)
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            start_job_runner()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    if scope['type'] == 'websocket' and scope['path'] == '/channel':
+        await _channel(scope, receive, send)
+        return
+    if scope['type'] == 'websocket':
+        await send({'type': 'websocket.close', 'code': 1000})
+        return
+    if scope['type'] == 'http' and scope['path'] == '/generate':
+        params = {k: v[0] for k, v in parse_qs(scope['query_string'].decode('utf-8')).items()}
+        body = b''
+        if scope['method'] == 'POST':
+            body = await _read_body(receive)
+            try:
+                data = json.loads(body or b'{}')
+            except ValueError:
+                data = None
+            if isinstance(data, dict):
+                params.update(data)
+            receive = _replay(body, receive)
+
+        engine = params.get('engine', FANOUT_ENGINE)
+        if engine == 'async' and params.get('model') == 'all':
+            await _generate_all(scope, receive, send, params)
+            return
+
+    await flask_application(scope, receive, send)
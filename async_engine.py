@@ -0,0 +1,263 @@
+import os
+import time
+import asyncio
+import threading
+
+from ai_models import create_async_model_function
+from app import (MODEL_NAMES, MODEL_PROVIDERS, delta_event, throttle_event, unavailable_event, quota_event,
+                 record_call, archive_call, remember_probe, timeout_message, conversation_thread)
+from breakers import BREAKERS
+from call_context import CallContext
+from cancellation import CANCELLATIONS, Cancelled
+from dispatcher import Saturated
+from latency import LATENCY, cancel_if_silent, watch_first_token
+from metrics import model_started, model_skipped, async_fanout_started, async_fanout_finished
+from model_registry import api_key_for, error_message
+from runs import RUNS, TIMER, RESUME_GRACE_SECONDS
+from streaming import DeltaBatcher
+from tracing import TRACER
+from usage import USAGE
+
+# Asyncio version of the "all models" fan-out: every model call is a coroutine on the
+# worker's event loop instead of a parked thread, so one worker can hold hundreds of
+# fan-outs while they wait on the network.
+ASYNC_PROVIDER_CONCURRENCY = int(os.getenv('ASYNC_PROVIDER_CONCURRENCY', '200'))
+ASYNC_MAX_INFLIGHT_FANOUTS = int(os.getenv('ASYNC_MAX_INFLIGHT_FANOUTS', '500'))
+
+# Semaphores belong to the loop they were created on
+_semaphores = {}
+# Fan-outs started and not yet over, across every loop in the process
+_inflight_lock = threading.Lock()
+_inflight_fanouts = 0
+_fanout_tasks = set()
+
+def _provider_semaphore(provider):
+    key = (id(asyncio.get_running_loop()), provider)
+    semaphore = _semaphores.get(key)
+    if semaphore is None:
+        semaphore = _semaphores[key] = asyncio.Semaphore(ASYNC_PROVIDER_CONCURRENCY)
+    return semaphore
+
+def _admit():
+    # Checked and counted in one step, so a burst of requests cannot all slip in under the limit
+    global _inflight_fanouts
+    with _inflight_lock:
+        if _inflight_fanouts >= ASYNC_MAX_INFLIGHT_FANOUTS:
+            raise Saturated(1, 'Server is at capacity, please retry shortly')
+        _inflight_fanouts += 1
+    async_fanout_started()
+
+def _fanout_done(task, run):
+    # A done callback rather than the fan-out's finally: it also runs for a task
+    # cancelled before it ever started, whose run would otherwise never end
+    global _inflight_fanouts
+    _fanout_tasks.discard(task)
+    if not run.closed:
+        RUNS.finish(run)
+    with _inflight_lock:
+        _inflight_fanouts -= 1
+    async_fanout_finished()
+
+def _timeout_event(model_id, error):
+    return {
+        'event': 'model_error',
+        'model_id': model_id,
+        'model_name': MODEL_NAMES.get(model_id),
+        'error': error,
+        'status': 'timeout'
+    }
+
+async def _call_model(model_id, model_function, prompt, call):
+    queued_at = time.monotonic()
+    async with _provider_semaphore(MODEL_PROVIDERS[model_id]):
+        # The time to first token counts from here, not from the wait for the semaphore
+        call.mark_running()
+        call.span('queued', queued_at)
+        return await model_function(prompt, call)
+
+async def _run_model(model_id, model_function, prompt, call, budget, user_id=None):
+    # Each model ends itself at its own deadline, so the fan-out is over as soon as every
+    # model has answered or run out of time.
+    # The breaker is asked here, not when the task is created: a task cancelled before it
+    # first runs never gets to its finally, and a half-open trial taken for it would
+    # never be handed back. Nothing below awaits before the try.
+    if not BREAKERS.allow(model_id):
+        model_skipped(model_id, MODEL_PROVIDERS[model_id])
+        return unavailable_event(model_id)
+    watch = watch_first_token(call, budget, lambda: cancel_if_silent(call), asyncio.get_running_loop().call_later)
+    model_started(model_id, MODEL_PROVIDERS[model_id])
+    # Anything that escapes below is the task being cancelled
+    status = 'cancelled'
+    response = None
+    error = None
+    try:
+        response = await asyncio.wait_for(_call_model(model_id, model_function, prompt, call), budget['total'])
+        status = 'success'
+        return {
+            'event': 'model_completed',
+            'model_id': model_id,
+            'model_name': MODEL_NAMES.get(model_id),
+            'response': response,
+            'status': 'success',
+            'cached': call.cache_status == 'hit',
+            'cache': call.cache_status
+        }
+    except asyncio.TimeoutError:
+        call.cancel('timed out')
+        status = 'timeout'
+        return _timeout_event(model_id, timeout_message(budget))
+    except Exception as e:
+        if isinstance(e, Cancelled) and e.reason == 'timed out':
+            status = 'timeout'
+            return _timeout_event(model_id, timeout_message(budget, first_token=True))
+        status = 'error'
+        error = e
+        return {
+            'event': 'model_error',
+            'model_id': model_id,
+            'model_name': MODEL_NAMES.get(model_id),
+            'error': error_message(model_id, e),
+            'status': 'error'
+        }
+    finally:
+        watch[0].cancel()
+        record_call(model_id, call, status, error)
+        archive_call(prompt, model_id, call, status, response, error, user_id)
+
+def start_all_models_async(prompt, api_keys, conversation_id, use_cache=True, deadline=None, wanted=None,
+                           model_ids=None, user_id=None, memory=True, force_trace=False):
+    # Like app.stream_all_models: the fan-out publishes into a Run and outlives the
+    # connection that started it, so a reconnect with Last-Event-ID picks it up again.
+    # Raises Saturated when this process already runs ASYNC_MAX_INFLIGHT_FANOUTS.
+    _admit()
+    run = RUNS.create(len(MODEL_NAMES if model_ids is None else model_ids), user_id)
+    trace = TRACER.start(run.run_id, 'generate all (async)', force=force_trace)
+    task = asyncio.create_task(run_all_models_async(run, prompt, api_keys, conversation_id, use_cache, deadline,
+                                                    wanted, model_ids, user_id, memory, trace))
+    # The loop only keeps weak references to its tasks
+    _fanout_tasks.add(task)
+    task.add_done_callback(lambda task: _fanout_done(task, run))
+    return run
+
+async def run_all_models_async(run, prompt, api_keys, conversation_id, use_cache=True, deadline=None, wanted=None,
+                               model_ids=None, user_id=None, memory=True, trace=None):
+    # model_ids: which models to ask (all of them by default)
+    # wanted: stop once this many models have answered and cancel the rest (race / first_n)
+    # trace: the run's Trace when it is sampled (see tracing.py)
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+    batcher = DeltaBatcher()
+    tasks = {}
+    grace_timer = [None]
+
+    def on_done(model_id, task):
+        if not task.cancelled():
+            events.put_nowait(('done', model_id, task.result()))
+
+    def grace_expired():
+        if run.subscribers == 0 and not run.closed:
+            scope.cancel('disconnected')
+
+    def abandoned(run):
+        # The last listener went away; give the browser a chance to reconnect first
+        TIMER.cancel(grace_timer[0])
+        grace_timer[0] = TIMER.call_later(RESUME_GRACE_SECONDS, grace_expired)
+
+    run.publish({'event': 'run_started', 'run_id': run.run_id, 'wanted': wanted,
+                 'trace_url': f"/debug/trace/{run.run_id}" if trace is not None else None})
+    # /cancel_operations and the grace timer run on other threads, so hop onto this loop
+    scope = CANCELLATIONS.open(user_id, conversation_id)
+    scope.add(lambda: loop.call_soon_threadsafe(events.put_nowait, ('cancelled', None, None)))
+    run.scope = scope
+    run.on_abandoned = abandoned
+    try:
+        for model_id in (MODEL_NAMES if model_ids is None else model_ids):
+            budget = LATENCY.budget(model_id, deadline)
+            if USAGE.quota_wait(model_id, api_key_for(model_id, api_keys)) is not None:
+                # Out of quota: report it at once instead of waiting out its deadline (a model
+                # failing lately is reported by its task, see _run_model)
+                model_skipped(model_id, MODEL_PROVIDERS[model_id])
+                run.publish({
+                    'event': 'model_started',
+                    'model_id': model_id,
+                    'model_name': MODEL_NAMES.get(model_id),
+                    'deadline_seconds': budget['total']
+                })
+                run.publish(quota_event(model_id, api_keys))
+                continue
+            remember_probe(model_id, api_keys)
+            model_function = create_async_model_function(model_id, api_key_for(model_id, api_keys))
+            call = CallContext(on_delta=lambda text, model_id=model_id: events.put_nowait(('delta', model_id, text)),
+                               use_cache=use_cache, deadline=budget['total'],
+                               on_throttle=lambda info, model_id=model_id: events.put_nowait(('throttled', model_id, info)),
+                               history=conversation_thread(user_id, conversation_id, model_id, memory))
+            if trace is not None:
+                # One lane per model in the run's trace, as in app.start_call
+                call.trace = trace
+                call.trace_lane = MODEL_NAMES[model_id]
+            task = asyncio.create_task(_run_model(model_id, model_function, prompt, call, budget, user_id))
+            task.add_done_callback(lambda t, model_id=model_id: on_done(model_id, t))
+            tasks[model_id] = task
+            scope.add(lambda task=task: loop.call_soon_threadsafe(task.cancel))
+            run.publish({
+                'event': 'model_started',
+                'model_id': model_id,
+                'model_name': MODEL_NAMES.get(model_id),
+                'deadline_seconds': budget['total']
+            })
+
+        reported = set()
+        answered = []
+        outpaced = False
+        while len(reported) < len(tasks):
+            flush_in = batcher.next_flush_in()
+            try:
+                kind, model_id, payload = await asyncio.wait_for(events.get(), flush_in)
+            except asyncio.TimeoutError:
+                for model_id, seq, text in batcher.flush_due():
+                    run.publish(delta_event(model_id, seq, text))
+                continue
+            if kind == 'cancelled':
+                break
+            if kind == 'delta':
+                batch = batcher.add(model_id, payload)
+                if batch:
+                    run.publish(delta_event(model_id, *batch))
+                continue
+            if kind == 'throttled':
+                run.publish(throttle_event(model_id, payload))
+                continue
+            batch = batcher.flush(model_id)
+            if batch:
+                run.publish(delta_event(model_id, *batch))
+            reported.add(model_id)
+            run.publish(payload)
+            if payload['status'] == 'success':
+                answered.append(model_id)
+                if wanted is not None and len(answered) >= wanted:
+                    outpaced = True
+                    break
+
+        # Only a cancel, or enough answers, leaves models unreported
+        for model_id, task in tasks.items():
+            if model_id in reported:
+                continue
+            task.cancel()
+            run.publish({
+                'event': 'model_error',
+                'model_id': model_id,
+                'model_name': MODEL_NAMES.get(model_id),
+                'error': 'Not needed, enough models already answered' if outpaced else 'Operation cancelled',
+                'status': 'outpaced' if outpaced else 'cancelled'
+            })
+
+        run.publish({'event': 'all_completed', 'answered': answered})
+    finally:
+        # Timed out and cancelled calls really stop here, unlike threads
+        for task in tasks.values():
+            task.cancel()
+        TIMER.cancel(grace_timer[0])
+        CANCELLATIONS.close(user_id, conversation_id, scope)
+        if trace is not None:
+            TRACER.finish(trace, TIMER.call_later)
+        RUNS.finish(run)
@@ -0,0 +1,340 @@
+import os
+import sys
+import json
+import time
+import shlex
+import socket
+import argparse
+import threading
+import subprocess
+import http.client
+from urllib.parse import urlencode, urlsplit
+
+from bench.mock_providers import PROFILES, start_providers, provider_env
+from latency import percentile
+
+# Load test for the "all models" stream: starts the provider stand-ins and the app,
+# then N concurrent SSE clients each send prompts to /generate?model=all and time them.
+#
+#   python -m bench.load --clients 20 --requests 200
+#   python -m bench.load --profile flaky --save-baseline bench/baseline.json
+#   python -m bench.load --baseline bench/baseline.json   # exits 1 on regression
+
+# Reported keys where a larger number is a regression, and the one where it is better
+LOWER_IS_BETTER = ('latency_p95', 'latency_p99', 'ttft_p95', 'peak_threads', 'peak_rss_mb')
+HIGHER_IS_BETTER = ('requests_per_second',)
+
+
+class Browser:
+    # One user: its own session cookie, one request at a time
+    def __init__(self, host, port, timeout):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.cookie = None
+
+    def _connect(self):
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def _headers(self, extra=None):
+        headers = dict(extra or {})
+        if self.cookie:
+            headers['Cookie'] = self.cookie
+        return headers
+
+    def save_keys(self):
+        conn = self._connect()
+        try:
+            body = json.dumps({'github_token': 'bench-token', 'nvidia_key': 'bench-key'})
+            conn.request('POST', '/save_api_keys', body, self._headers({'Content-Type': 'application/json'}))
+            response = conn.getresponse()
+            response.read()
+            cookie = response.getheader('Set-Cookie')
+            if cookie:
+                self.cookie = cookie.split(';', 1)[0]
+            return response.status
+        finally:
+            conn.close()
+
+    def generate_all(self, prompt, conversation_id):
+        query = urlencode({'prompt': prompt, 'model': 'all', 'conversation_id': conversation_id})
+        result = {'status': None, 'latency': None, 'ttft': None, 'completed': 0, 'errors': 0, 'timeouts': 0}
+        started = time.monotonic()
+        conn = self._connect()
+        try:
+            conn.request('GET', f"/generate?{query}", headers=self._headers({'Accept': 'text/event-stream'}))
+            response = conn.getresponse()
+            result['status'] = response.status
+            if response.status != 200:
+                response.read()
+                return result
+            data = []
+            while True:
+                line = response.readline()
+                if not line:
+                    break
+                line = line.decode('utf-8').rstrip('\r\n')
+                if line.startswith('data:'):
+                    data.append(line[5:].lstrip())
+                    continue
+                if line or not data:
+                    continue
+                event = json.loads('\n'.join(data))
+                data = []
+                kind = event.get('event')
+                if kind == 'model_delta' and result['ttft'] is None:
+                    result['ttft'] = time.monotonic() - started
+                elif kind == 'model_completed':
+                    result['completed'] += 1
+                    if result['ttft'] is None:
+                        result['ttft'] = time.monotonic() - started
+                elif kind == 'model_error':
+                    result['errors'] += 1
+                    if event.get('status') == 'timeout':
+                        result['timeouts'] += 1
+                elif kind == 'all_completed':
+                    result['latency'] = time.monotonic() - started
+                    break
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            result['status'] = f"{type(e).__name__}: {e}"
+        finally:
+            conn.close()
+        return result
+
+
+class ProcessSampler:
+    # Peak threads and resident memory of the server's process tree (Linux /proc)
+    def __init__(self, pid, interval=0.2):
+        self.pid = pid
+        self.interval = interval
+        self.peak_threads = 0
+        self.peak_rss_kb = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+
+    def start(self):
+        if self.pid is not None and os.path.isdir('/proc'):
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _tree(self):
+        children = {}
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+        pids, pending = [], [self.pid]
+        while pending:
+            pid = pending.pop()
+            pids.append(pid)
+            pending.extend(children.get(pid, ()))
+        return pids
+
+    def _sample(self):
+        threads = rss = 0
+        for pid in self._tree():
+            try:
+                with open(f"/proc/{pid}/status") as f:
+                    for line in f:
+                        if line.startswith('Threads:'):
+                            threads += int(line.split()[1])
+                        elif line.startswith('VmRSS:'):
+                            rss += int(line.split()[1])
+            except OSError:
+                continue
+        self.peak_threads = max(self.peak_threads, threads)
+        self.peak_rss_kb = max(self.peak_rss_kb, rss)
+
+    def _loop(self):
+        while not self._stop.is_set():
+            self._sample()
+            self._stop.wait(self.interval)
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _wait_until_up(host, port, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection(host, port, timeout=2)
+            conn.request('GET', '/')
+            conn.getresponse().read()
+            conn.close()
+            return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+def _round(value):
+    return round(value, 4) if value is not None else None
+
+
+def run(args):
+    providers = start_providers(args.profile, _overrides(args))
+    server = None
+    if args.url:
+        parts = urlsplit(args.url)
+        host, port = parts.hostname, parts.port or 80
+        pid = args.pid
+    else:
+        host, port = '127.0.0.1', _free_port()
+        env = dict(os.environ, **provider_env(providers))
+        command = shlex.split(args.server_cmd.format(port=port, python=sys.executable))
+        server = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL,
+                                  stderr=None if args.verbose else subprocess.DEVNULL)
+        pid = server.pid
+        if not _wait_until_up(host, port, args.startup_timeout):
+            server.kill()
+            raise SystemExit(f"Server did not start: {' '.join(command)}")
+
+    results = []
+    lock = threading.Lock()
+    counter = iter(range(args.warmup + args.requests))
+    sampler = ProcessSampler(pid).start()
+
+    def client(index):
+        browser = Browser(host, port, args.request_timeout)
+        browser.save_keys()
+        while True:
+            with lock:
+                n = next(counter, None)
+            if n is None:
+                return
+            # Unique prompts, so the response cache does not answer for the providers
+            result = browser.generate_all(f"bench prompt {n} from client {index}", f"bench-{index}")
+            if n >= args.warmup:
+                with lock:
+                    results.append(result)
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=client, args=(i,), daemon=True) for i in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    sampler.stop()
+
+    if server is not None:
+        server.terminate()
+        try:
+            server.wait(10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+    for provider in providers.values():
+        provider.stop()
+
+    ok = [r for r in results if r['status'] == 200 and r['latency'] is not None]
+    latencies = [r['latency'] for r in ok]
+    ttfts = [r['ttft'] for r in ok if r['ttft'] is not None]
+    return {
+        'profile': args.profile,
+        'clients': args.clients,
+        'requests': len(results),
+        'ok': len(ok),
+        'rejected': sum(1 for r in results if r['status'] == 503),
+        'failed': sum(1 for r in results if r['status'] not in (200, 503) or (r['status'] == 200 and r['latency'] is None)),
+        'duration_seconds': _round(elapsed),
+        'requests_per_second': _round(len(ok) / elapsed) if elapsed else 0.0,
+        'latency_p50': _round(percentile(latencies, 50)) if latencies else None,
+        'latency_p95': _round(percentile(latencies, 95)) if latencies else None,
+        'latency_p99': _round(percentile(latencies, 99)) if latencies else None,
+        'ttft_p50': _round(percentile(ttfts, 50)) if ttfts else None,
+        'ttft_p95': _round(percentile(ttfts, 95)) if ttfts else None,
+        'ttft_p99': _round(percentile(ttfts, 99)) if ttfts else None,
+        'model_completions': sum(r['completed'] for r in results),
+        'model_errors': sum(r['errors'] for r in results),
+        'model_timeouts': sum(r['timeouts'] for r in results),
+        'peak_threads': sampler.peak_threads or None,
+        'peak_rss_mb': _round(sampler.peak_rss_kb / 1024) if sampler.peak_rss_kb else None,
+        'providers': {name: provider.counts for name, provider in providers.items()},
+    }
+
+
+def _overrides(args):
+    overrides = {}
+    for key in ('first_token', 'tokens_per_second', 'tokens', 'error_rate', 'hang_rate', 'hang_seconds'):
+        value = getattr(args, key)
+        if value is not None:
+            overrides[key] = value
+    return overrides
+
+
+def compare(report, baseline, tolerance, max_failures):
+    # Returns a list of regressions against the baseline report
+    regressions = []
+    if report['failed'] > max_failures:
+        regressions.append(f"failed requests: {report['failed']} > {max_failures}")
+    for key in LOWER_IS_BETTER:
+        new, old = report.get(key), baseline.get(key)
+        if new is not None and old and new > old * (1 + tolerance):
+            regressions.append(f"{key}: {new} vs baseline {old} (+{(new / old - 1) * 100:.1f}%)")
+    for key in HIGHER_IS_BETTER:
+        new, old = report.get(key), baseline.get(key)
+        if new is not None and old and new < old * (1 - tolerance):
+            regressions.append(f"{key}: {new} vs baseline {old} ({(new / old - 1) * 100:.1f}%)")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test /generate?model=all against local provider stand-ins')
+    parser.add_argument('--clients', type=int, default=10, help='concurrent SSE clients')
+    parser.add_argument('--requests', type=int, default=100, help='measured requests in total')
+    parser.add_argument('--warmup', type=int, default=0, help='requests sent first and not measured')
+    parser.add_argument('--profile', choices=sorted(PROFILES), default='default')
+    parser.add_argument('--first-token', type=float, help='override the median time to first token (s)')
+    parser.add_argument('--tokens-per-second', type=float)
+    parser.add_argument('--tokens', type=int)
+    parser.add_argument('--error-rate', type=float, help='share of provider calls answered 429')
+    parser.add_argument('--hang-rate', type=float, help='share of provider calls that never answer')
+    parser.add_argument('--hang-seconds', type=float)
+    parser.add_argument('--server-cmd', default='{python} -m bench.serve --port {port}',
+                        help='command that starts the app on {port}, e.g. '
+                             '"gunicorn -w 4 -k gthread --threads 32 -b 127.0.0.1:{port} app:app"')
+    parser.add_argument('--url', help='benchmark an already running server instead (pointed at the stand-ins)')
+    parser.add_argument('--pid', type=int, help='server pid to sample with --url')
+    parser.add_argument('--startup-timeout', type=float, default=30)
+    parser.add_argument('--request-timeout', type=float, default=300)
+    parser.add_argument('--json', help='also write the report to this file')
+    parser.add_argument('--baseline', help='compare against this report and exit 1 on regression')
+    parser.add_argument('--save-baseline', help='write the report here as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='allowed regression, as a fraction')
+    parser.add_argument('--max-failures', type=int, default=0)
+    parser.add_argument('--verbose', action='store_true', help='show the server output')
+    args = parser.parse_args()
+
+    report = run(args)
+    print(json.dumps(report, indent=2))
+    for path in (args.json, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance, args.max_failures)
+        if regressions:
+            print('\nRegressions against baseline:')
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print('\nNo regressions against baseline')
+
+
+if __name__ == '__main__':
+    main()
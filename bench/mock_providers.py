@@ -0,0 +1,221 @@
+import json
+import math
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-ins for the model providers. Every server answers POST .../chat/completions
+# in the shape all three SDKs accept (OpenAI chat completions, Azure AI inference and
+# Mistral share it), streamed as server-sent events over chunked HTTP/1.1 so client
+# keep-alive behaves as it does against the real endpoints.
+
+# first_token: median seconds before the first token (log-normal with the given sigma)
+# tokens_per_second / tokens: how fast and how much each answer streams
+# error_rate: share of requests answered 429 with Retry-After
+# hang_rate: share of requests that never answer (until hang_seconds)
+PROFILES = {
+    'default': {
+        'github': {'first_token': 0.4, 'sigma': 0.4, 'tokens_per_second': 80, 'tokens': 150},
+        'azure': {'first_token': 0.6, 'sigma': 0.5, 'tokens_per_second': 50, 'tokens': 150},
+        'nvidia': {'first_token': 0.5, 'sigma': 0.4, 'tokens_per_second': 60, 'tokens': 150},
+    },
+    # Near-instant providers: measures the app's own overhead
+    'fast': {
+        'github': {'first_token': 0.02, 'sigma': 0.1, 'tokens_per_second': 2000, 'tokens': 50},
+        'azure': {'first_token': 0.02, 'sigma': 0.1, 'tokens_per_second': 2000, 'tokens': 50},
+        'nvidia': {'first_token': 0.02, 'sigma': 0.1, 'tokens_per_second': 2000, 'tokens': 50},
+    },
+    'flaky': {
+        'github': {'first_token': 0.4, 'sigma': 0.8, 'tokens_per_second': 80, 'tokens': 150, 'error_rate': 0.05, 'hang_rate': 0.02},
+        'azure': {'first_token': 0.6, 'sigma': 0.8, 'tokens_per_second': 50, 'tokens': 150, 'error_rate': 0.1, 'hang_rate': 0.02},
+        'nvidia': {'first_token': 0.5, 'sigma': 0.8, 'tokens_per_second': 60, 'tokens': 150, 'error_rate': 0.05, 'hang_rate': 0.05},
+    },
+}
+
+DEFAULT_BEHAVIOUR = {
+    'first_token': 0.5,
+    'sigma': 0.4,
+    'tokens_per_second': 60,
+    'tokens': 150,
+    'error_rate': 0.0,
+    'hang_rate': 0.0,
+    'hang_seconds': 300,
+    'retry_after': 1,
+}
+
+WORDS = ('lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit')
+
+
+def _chunk(model, content=None, finish_reason=None, usage=None):
+    chunk = {
+        'id': f"mock-{uuid.uuid4().hex[:12]}",
+        'object': 'chat.completion.chunk',
+        'created': int(time.time()),
+        'model': model,
+        'choices': [{'index': 0, 'delta': {'role': 'assistant', 'content': content}, 'finish_reason': finish_reason}],
+    }
+    if usage is not None:
+        chunk['usage'] = usage
+    return chunk
+
+
+def _completion(model, content, usage):
+    return {
+        'id': f"mock-{uuid.uuid4().hex[:12]}",
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': model,
+        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+        'usage': usage,
+    }
+
+
+class MockProvider(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, name, behaviour=None, host='127.0.0.1', port=0):
+        super().__init__((host, port), _Handler)
+        self.name = name
+        self.behaviour = dict(DEFAULT_BEHAVIOUR, **(behaviour or {}))
+        self._lock = threading.Lock()
+        self.counts = {'requests': 0, 'streamed': 0, 'rate_limited': 0, 'hung': 0}
+        self._thread = None
+
+    @property
+    def url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    def count(self, key):
+        with self._lock:
+            self.counts[key] += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name=f"mock-{self.name}", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        # Connection pre-warming
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        server = self.server
+        behaviour = server.behaviour
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            body = {}
+        if not self.path.split('?')[0].endswith('/chat/completions'):
+            self._send_json(404, {'error': {'message': f"Unknown path {self.path}"}})
+            return
+        server.count('requests')
+
+        roll = random.random()
+        if roll < behaviour['error_rate']:
+            server.count('rate_limited')
+            self._send_json(429, {'error': {'message': 'Rate limit exceeded', 'code': '429'}},
+                            {'Retry-After': str(behaviour['retry_after'])})
+            return
+        if roll < behaviour['error_rate'] + behaviour['hang_rate']:
+            server.count('hung')
+            time.sleep(behaviour['hang_seconds'])
+            self.close_connection = True
+            return
+
+        model = body.get('model', 'mock')
+        tokens = max(1, int(behaviour['tokens']))
+        first_token = behaviour['first_token'] * math.exp(random.gauss(0, behaviour['sigma']))
+        gap = 1.0 / behaviour['tokens_per_second']
+        usage = {'prompt_tokens': 10, 'completion_tokens': tokens, 'total_tokens': tokens + 10}
+
+        if not body.get('stream'):
+            time.sleep(first_token + gap * tokens)
+            self._send_json(200, _completion(model, ' '.join(WORDS[i % len(WORDS)] for i in range(tokens)), usage))
+            return
+
+        server.count('streamed')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            time.sleep(first_token)
+            started = time.monotonic()
+            for i in range(tokens):
+                self._send_event(_chunk(model, WORDS[i % len(WORDS)] + ' '))
+                # Pace against the start so the rate holds even when writes are slow
+                delay = started + (i + 1) * gap - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            self._send_event(_chunk(model, '', 'stop', usage))
+            self._write_chunk(b'data: [DONE]\n\n')
+            self._write_chunk(b'')
+        except (BrokenPipeError, ConnectionResetError):
+            # The client aborted the stream (cancelled or timed out)
+            self.close_connection = True
+
+    def _send_event(self, data):
+        self._write_chunk(f"data: {json.dumps(data)}\n\n".encode('utf-8'))
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b'\r\n')
+        self.wfile.flush()
+
+    def _send_json(self, status, data, headers=None):
+        payload = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def start_providers(profile='default', overrides=None, host='127.0.0.1'):
+    # One server per provider; returns {provider: MockProvider}
+    providers = {}
+    for name, behaviour in PROFILES[profile].items():
+        providers[name] = MockProvider(name, dict(behaviour, **(overrides or {})), host).start()
+    return providers
+
+
+def provider_env(providers):
+    # Environment that points ai_models.py and rawcode.py at the stand-ins
+    return {
+        'GITHUB_MODELS_ENDPOINT': providers['github'].url,
+        'AZURE_INFERENCE_ENDPOINT': providers['azure'].url,
+        'NVIDIA_ENDPOINT': providers['nvidia'].url + '/v1',
+    }
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Run local stand-ins for the model providers')
+    parser.add_argument('--profile', choices=sorted(PROFILES), default='default')
+    parser.add_argument('--host', default='127.0.0.1')
+    args = parser.parse_args()
+    providers = start_providers(args.profile, host=args.host)
+    for key, value in provider_env(providers).items():
+        print(f"export {key}={value}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
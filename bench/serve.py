@@ -0,0 +1,15 @@
+import argparse
+
+from werkzeug.serving import run_simple
+
+# Runs the web app on a threaded werkzeug server for benchmarks. The provider endpoints
+# come from the environment (see mock_providers.provider_env); use --server-cmd in
+# bench.load to benchmark gunicorn or uvicorn instead.
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve app.py for benchmarking')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5001)
+    args = parser.parse_args()
+
+    from app import app
+    run_simple(args.host, args.port, app, threaded=True, use_reloader=False)
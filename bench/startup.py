@@ -0,0 +1,94 @@
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+# Cold-start cost of each entry point: imports it in fresh interpreters and reports the
+# median wall time and which provider SDKs the import pulled in. None should: they are
+# imported when a model that needs one is first called (see model_registry.py).
+#
+#   python -m bench.startup
+#   python -m bench.startup --runs 20 --importtime 15
+
+ENTRY_POINTS = ('model_registry', 'ai_models', 'app', 'asgi', 'rawcode')
+SDK_MODULES = ('openai', 'azure.ai.inference', 'mistralai', 'httpx')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = """
+import sys, time, json
+started = time.perf_counter()
+try:
+    __import__({module!r})
+    error = None
+except Exception as e:
+    error = f"{{type(e).__name__}}: {{e}}"
+elapsed = time.perf_counter() - started
+print(json.dumps({{'seconds': elapsed, 'error': error, 'sdks': [m for m in {sdks!r} if m in sys.modules]}}))
+"""
+
+
+def _probe(module):
+    code = PROBE.format(module=module, sdks=SDK_MODULES)
+    result = subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True, text=True)
+    lines = result.stdout.strip().splitlines()
+    if not lines:
+        return {'seconds': None, 'error': result.stderr.strip().splitlines()[-1:] or 'no output', 'sdks': []}
+    return json.loads(lines[-1])
+
+
+def _importtime(module, top):
+    # The slowest imports by cumulative time, from python -X importtime
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f"import {module}"],
+                            cwd=ROOT, capture_output=True, text=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = (part.strip() for part in line[len('import time:'):].split('|', 2))
+        rows.append((int(cumulative), name.strip()))
+    rows.sort(reverse=True)
+    return [{'module': name, 'ms': round(us / 1000, 1)} for us, name in rows[:top]]
+
+
+def measure(module, runs, top=0):
+    samples = [_probe(module) for _ in range(runs)]
+    times = [s['seconds'] for s in samples if s['seconds'] is not None]
+    report = {
+        'median_seconds': round(statistics.median(times), 4) if times else None,
+        'min_seconds': round(min(times), 4) if times else None,
+        'sdks_imported': sorted({m for s in samples for m in s['sdks']}),
+        'error': next((s['error'] for s in samples if s['error']), None),
+    }
+    if top:
+        report['slowest_imports'] = _importtime(module, top)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure cold-start import time of each entry point')
+    parser.add_argument('--runs', type=int, default=10, help='fresh interpreters per entry point')
+    parser.add_argument('--importtime', type=int, default=0, metavar='N', help='also list the N slowest imports')
+    parser.add_argument('--json', help='also write the report to this file')
+    parser.add_argument('modules', nargs='*', default=ENTRY_POINTS)
+    args = parser.parse_args()
+
+    report = {module: measure(module, args.runs, args.importtime) for module in args.modules}
+    for module, result in report.items():
+        seconds = f"{result['median_seconds'] * 1000:8.1f} ms" if result['median_seconds'] is not None else '     n/a'
+        sdks = ', '.join(result['sdks_imported']) or 'none'
+        line = f"{module:16} {seconds}   SDKs imported: {sdks}"
+        if result['error']:
+            line += f"   ({result['error']})"
+        print(line)
+        for row in result.get('slowest_imports', ()):
+            print(f"{'':16} {row['ms']:8.1f} ms   {row['module']}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+import os
+import time
+import threading
+from collections import deque
+
+from cancellation import Cancelled
+from metrics import breaker_opened, breaker_closed
+from model_registry import MODEL_NAMES, MODEL_PROVIDERS
+from rate_limits import RateLimited, error_status
+from runs import TIMER
+
+# Per-model circuit breakers. A model whose recent calls mostly fail or time out is
+# opened: requests skip it straight away instead of holding a worker until its
+# deadline. After a cool-down the breaker goes half-open and lets one call through (a
+# background probe, or the next real request); success closes it, failure opens it
+# again for twice as long.
+BREAKER_WINDOW = int(os.getenv('BREAKER_WINDOW', '20'))
+BREAKER_MIN_CALLS = int(os.getenv('BREAKER_MIN_CALLS', '5'))
+BREAKER_FAILURE_RATE = float(os.getenv('BREAKER_FAILURE_RATE', '0.5'))
+BREAKER_OPEN_SECONDS = float(os.getenv('BREAKER_OPEN_SECONDS', '30'))
+BREAKER_MAX_OPEN_SECONDS = float(os.getenv('BREAKER_MAX_OPEN_SECONDS', '300'))
+BREAKER_PROBE_TIMEOUT_SECONDS = float(os.getenv('BREAKER_PROBE_TIMEOUT_SECONDS', '15'))
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+def outcome(status, error=None):
+    # True for a failure of the model, False for a success, None when the call says
+    # nothing about the model: cancelled, a bad key or request, or our own throttling
+    if status == 'success':
+        return False
+    if status == 'timeout':
+        return True
+    if status != 'error':
+        return None
+    if isinstance(error, (RateLimited, Cancelled)):
+        return None
+    code = error_status(error) if error is not None else None
+    if code is not None and code < 500 and code != 408:
+        return None
+    return True
+
+
+class CircuitBreaker:
+    def __init__(self, model_id, window=BREAKER_WINDOW, min_calls=BREAKER_MIN_CALLS,
+                 failure_rate=BREAKER_FAILURE_RATE, open_seconds=BREAKER_OPEN_SECONDS):
+        self.model_id = model_id
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.base_open_seconds = open_seconds
+        self.open_seconds = open_seconds
+        self.state = CLOSED
+        # Recent outcomes while closed, True for a failure
+        self._outcomes = deque(maxlen=window)
+        self.opened_at = None
+        self.trial = False
+        self.last_error = None
+        self.probe = None
+        self._probe_timer = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        # Whether a call may go ahead; in half-open only one at a time (the trial)
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN:
+                if time.monotonic() < self.opened_at + self.open_seconds:
+                    return False
+                self.state = HALF_OPEN
+            if self.trial:
+                return False
+            self.trial = True
+            return True
+
+    def available(self):
+        # Like allow() without taking the half-open trial, for admission control
+        with self._lock:
+            return self.state == CLOSED or (self.state == OPEN and self.retry_in_locked() == 0) or \
+                (self.state == HALF_OPEN and not self.trial)
+
+    def retry_in_locked(self):
+        if self.state != OPEN:
+            return 0
+        return max(0.0, self.opened_at + self.open_seconds - time.monotonic())
+
+    def retry_in(self):
+        with self._lock:
+            return self.retry_in_locked()
+
+    def record(self, failed, error=None):
+        if failed:
+            self.last_error = str(error)[:200] if error is not None else 'timed out'
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self.trial = False
+                if failed is None:
+                    return
+                if failed:
+                    self._open_locked(min(BREAKER_MAX_OPEN_SECONDS, self.open_seconds * 2))
+                else:
+                    self._close_locked()
+                return
+            # Results of calls started before the breaker opened change nothing
+            if self.state == OPEN or failed is None:
+                return
+            self._outcomes.append(failed)
+            failures = sum(self._outcomes)
+            if len(self._outcomes) >= self.min_calls and failures / len(self._outcomes) >= self.failure_rate:
+                self._open_locked(self.base_open_seconds)
+
+    def _open_locked(self, open_seconds):
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+        self.open_seconds = open_seconds
+        self._outcomes.clear()
+        breaker_opened(self.model_id, MODEL_PROVIDERS.get(self.model_id, ''))
+        TIMER.cancel(self._probe_timer)
+        self._probe_timer = TIMER.call_later(open_seconds, self._probe_due)
+
+    def _close_locked(self):
+        self.state = CLOSED
+        self.open_seconds = self.base_open_seconds
+        self._outcomes.clear()
+        breaker_closed(self.model_id, MODEL_PROVIDERS.get(self.model_id, ''))
+        TIMER.cancel(self._probe_timer)
+        self._probe_timer = None
+
+    def _probe_due(self):
+        # Runs on the timer thread: take the trial and probe on a thread of its own
+        with self._lock:
+            self._probe_timer = None
+            probe = self.probe
+            if probe is None or self.state == CLOSED or self.trial:
+                return
+            self.state = HALF_OPEN
+            self.trial = True
+        threading.Thread(target=self._run_probe, args=(probe,), name=f'probe-{self.model_id}', daemon=True).start()
+
+    def _run_probe(self, probe):
+        # A failure that is not the model's fault (e.g. a revoked key) only gives the
+        # trial back, and the next real request decides
+        try:
+            probe()
+        except Exception as e:
+            self.record(outcome('error', e), e)
+        else:
+            self.record(False)
+
+    def recent_failure_rate(self):
+        # Share of recent calls that failed, None before any
+        with self._lock:
+            outcomes = list(self._outcomes)
+        return sum(outcomes) / len(outcomes) if outcomes else None
+
+    def stats(self):
+        with self._lock:
+            outcomes = list(self._outcomes)
+            return {
+                'state': self.state,
+                'recent_calls': len(outcomes),
+                'failure_rate': round(sum(outcomes) / len(outcomes), 3) if outcomes else 0.0,
+                'retry_in_seconds': round(self.retry_in_locked(), 1),
+                'probe_ready': self.probe is not None,
+                'last_error': self.last_error if self.state != CLOSED else None,
+            }
+
+
+class Breakers:
+    def __init__(self, model_ids=MODEL_NAMES):
+        self._breakers = {model_id: CircuitBreaker(model_id) for model_id in model_ids}
+
+    def allow(self, model_id):
+        return self._breakers[model_id].allow()
+
+    def available(self, model_id):
+        return self._breakers[model_id].available()
+
+    def retry_in(self, model_id):
+        return self._breakers[model_id].retry_in()
+
+    def recent_failure_rate(self, model_id):
+        return self._breakers[model_id].recent_failure_rate()
+
+    def record(self, model_id, status, error=None):
+        self._breakers[model_id].record(outcome(status, error), error)
+
+    def set_probe(self, model_id, probe):
+        # probe() makes the cheapest real request the model allows and raises on failure;
+        # the latest one wins, so it always uses credentials that were recently valid
+        self._breakers[model_id].probe = probe
+
+    def unavailable_message(self, model_id):
+        breaker = self._breakers[model_id]
+        retry_in = breaker.retry_in()
+        reason = f": {breaker.last_error}" if breaker.last_error else ''
+        if retry_in:
+            return f"Model is temporarily unavailable after repeated failures{reason} (retrying in {retry_in:.0f}s)"
+        return f"Model is temporarily unavailable after repeated failures{reason} (checking whether it has recovered)"
+
+    def stats(self):
+        return {model_id: breaker.stats() for model_id, breaker in self._breakers.items()}
+
+
+# Shared by every request handled by this process
+BREAKERS = Breakers()
@@ -0,0 +1,136 @@
+import time
+from contextlib import contextmanager
+
+from cancellation import CancelScope
+
+# State for a single model call, handed to the model function by whoever scheduled it.
+# Streaming calls report every text delta through it and it keeps the full text in a
+# list of parts, so the final response is joined once instead of concatenated per chunk.
+# Cancelling it aborts whatever in-flight request the model function has attached.
+class CallContext:
+    def __init__(self, on_delta=None, use_cache=True, deadline=None, on_throttle=None, history=None):
+        self.on_delta = on_delta
+        self.use_cache = use_cache
+        # The model's thread of the conversation (see conversations.py), None for a
+        # one-off prompt; the answer is appended to it
+        self.history = history
+        # Told about every wait for a provider's rate limit, e.g. to show it in the UI
+        self.on_throttle = on_throttle
+        # Set by the response cache: 'hit', 'coalesced', 'miss' or 'bypass'
+        self.cache_status = None
+        # Monotonic times, for deadlines and the latency history. running_at is when a
+        # worker actually picked the call up (see tracing.queued), None while it is queued.
+        self.started_at = time.monotonic()
+        self.running_at = None
+        self.first_delta_at = None
+        self.deadline_at = self.started_at + deadline if deadline else None
+        # Rate limit waits and retries (see rate_limits.py)
+        self.throttle_seconds = 0.0
+        self.throttled_until = None
+        self.retries = 0
+        # Completion and prompt tokens, when the provider reports usage
+        self.output_tokens = None
+        self.input_tokens = None
+        # The run's Trace when it is sampled (see tracing.py), and this call's lane in it
+        self.trace = None
+        self.trace_lane = None
+        self._parts = []
+        self._listeners = []
+        self._scope = CancelScope()
+
+    @property
+    def streaming(self):
+        return self.on_delta is not None
+
+    @property
+    def cancelled(self):
+        return self._scope.cancelled
+
+    def cancel(self, reason='cancelled'):
+        return self._scope.cancel(reason)
+
+    def check(self):
+        self._scope.check()
+
+    @contextmanager
+    def attach(self, abort):
+        # abort() is called from whichever thread cancels the call while the block runs
+        handle = self._scope.add(abort)
+        try:
+            self.check()
+            yield
+        finally:
+            self._scope.remove(handle)
+
+    def tap(self, listener):
+        # Extra receiver for this call's deltas (e.g. requests coalesced onto it)
+        self._listeners.append(listener)
+
+    def emit(self, text):
+        self.check()
+        if not text:
+            return
+        if self.first_delta_at is None:
+            self.first_delta_at = time.monotonic()
+        self._parts.append(text)
+        if self.on_delta is not None:
+            self.on_delta(text)
+        for listener in self._listeners:
+            listener(text)
+
+    def remaining(self):
+        # Seconds left before the call's deadline, None when it has none
+        if self.deadline_at is None:
+            return None
+        return self.deadline_at - time.monotonic()
+
+    def span(self, name, start, end=None, **args):
+        # A phase of this call in the run's trace; nothing when the run is not traced
+        if self.trace is not None:
+            self.trace.span(self.trace_lane, name, start, time.monotonic() if end is None else end, **args)
+
+    def throttled(self, wait, reason, attempt, status=None):
+        self.throttle_seconds += wait
+        self.throttled_until = time.monotonic() + wait
+        self.span(f"rate_limit_{reason}", self.throttled_until - wait, self.throttled_until, status=status)
+        self.retries = attempt
+        if self.on_throttle is not None:
+            self.on_throttle({'wait_seconds': round(wait, 3), 'reason': reason, 'attempt': attempt, 'status': status})
+
+    def mark_running(self):
+        if self.running_at is None:
+            self.running_at = time.monotonic()
+
+    def queued_seconds(self):
+        # Time spent waiting for a worker before the call ran
+        return self.running_at - self.started_at if self.running_at is not None else 0.0
+
+    def running_seconds(self):
+        # Time since the call started running, so time queued is not counted
+        return time.monotonic() - (self.running_at if self.running_at is not None else self.started_at)
+
+    def first_token_left(self, first_token_budget):
+        # Seconds left to start answering, None once it has. Neither time queued for a
+        # worker nor waits for a rate limit count: the request had not been sent yet.
+        if self.first_delta_at is not None:
+            return None
+        if self.running_at is None:
+            return first_token_budget
+        now = time.monotonic()
+        waited = self.throttle_seconds
+        if self.throttled_until is not None and self.throttled_until > now:
+            waited -= self.throttled_until - now
+        return first_token_budget - (now - self.running_at - waited)
+
+    def first_token_seconds(self):
+        # From when the call started running, so time queued is not the model's
+        if self.first_delta_at is None:
+            return None
+        return self.first_delta_at - (self.running_at if self.running_at is not None else self.started_at)
+
+    def text(self):
+        return ''.join(self._parts)
+
+    def reset(self):
+        # Start over, e.g. when the request this call was following got cancelled
+        self._parts = []
@@ -0,0 +1,121 @@
+import os
+import threading
+from collections import OrderedDict
+
+# Cancellation of in-flight model calls, keyed by the user and the browser's
+# conversation_id, so nobody can cancel another user's runs by guessing the id.
+# Every fan-out run opens a scope while it is active and closes it when it ends, so
+# the registry only ever holds live runs (bounded in case a run never closes).
+MAX_TRACKED_CONVERSATIONS = int(os.getenv('MAX_TRACKED_CONVERSATIONS', '4096'))
+
+
+class Cancelled(Exception):
+    def __init__(self, reason='cancelled'):
+        super().__init__(f"Operation {reason}")
+        self.reason = reason
+
+
+class CancelScope:
+    # A set of callbacks run once when the scope is cancelled (abort streams,
+    # drop queued work, wake the stream writer). Callbacks added after the
+    # scope was cancelled run immediately.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._callbacks = {}
+        self._next_handle = 0
+        self.reason = None
+
+    @property
+    def cancelled(self):
+        return self.reason is not None
+
+    def add(self, callback):
+        with self._lock:
+            if self.reason is None:
+                handle = self._next_handle
+                self._next_handle += 1
+                self._callbacks[handle] = callback
+                return handle
+        _run(callback)
+        return None
+
+    def remove(self, handle):
+        if handle is None:
+            return
+        with self._lock:
+            self._callbacks.pop(handle, None)
+
+    def cancel(self, reason='cancelled'):
+        with self._lock:
+            if self.reason is not None:
+                return False
+            self.reason = reason
+            callbacks = list(self._callbacks.values())
+            self._callbacks.clear()
+        for callback in callbacks:
+            _run(callback)
+        return True
+
+    def check(self):
+        if self.reason is not None:
+            raise Cancelled(self.reason)
+
+
+def _run(callback):
+    try:
+        callback()
+    except Exception:
+        pass
+
+
+class CancellationRegistry:
+    def __init__(self, max_conversations=MAX_TRACKED_CONVERSATIONS):
+        self.max_conversations = max_conversations
+        self._lock = threading.Lock()
+        # (user_id, conversation_id) -> set of scopes for runs that are still active
+        self._scopes = OrderedDict()
+        self.dropped = 0
+
+    def open(self, user_id, conversation_id):
+        key = (user_id, conversation_id)
+        scope = CancelScope()
+        with self._lock:
+            scopes = self._scopes.get(key)
+            if scopes is None:
+                scopes = self._scopes[key] = set()
+            self._scopes.move_to_end(key)
+            scopes.add(scope)
+            while len(self._scopes) > self.max_conversations:
+                # Runs that never closed; forget them rather than grow without bound
+                self._scopes.popitem(last=False)
+                self.dropped += 1
+        return scope
+
+    def close(self, user_id, conversation_id, scope):
+        key = (user_id, conversation_id)
+        with self._lock:
+            scopes = self._scopes.get(key)
+            if scopes is None:
+                return
+            scopes.discard(scope)
+            if not scopes:
+                del self._scopes[key]
+
+    def cancel(self, user_id, conversation_id, reason='cancelled'):
+        # Only ever the runs this user started
+        with self._lock:
+            scopes = list(self._scopes.get((user_id, conversation_id), ()))
+        return sum(1 for scope in scopes if scope.cancel(reason))
+
+    def stats(self):
+        with self._lock:
+            return {
+                'conversations': len(self._scopes),
+                'active_runs': sum(len(scopes) for scopes in self._scopes.values()),
+                'max_conversations': self.max_conversations,
+                'dropped': self.dropped,
+            }
+
+
+# Shared by every request handled by this process
+CANCELLATIONS = CancellationRegistry()
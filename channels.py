@@ -0,0 +1,209 @@
+import os
+import json
+import threading
+
+from dispatcher import DISPATCHER, Saturated
+from latency import LATENCY, parse_deadline
+from model_registry import MODEL_SPECS
+from model_selection import select_models, parse_model_list, parse_fastest_k, parse_latency_budget
+from runs import RUNS
+from tracing import TRACER
+
+# One connection per browser tab for every prompt it sends (see asgi.py for the WebSocket
+# it runs on). The browser sends JSON messages:
+#   {"type": "generate", "ref": <its own tag>, "prompt": ..., "model": "all" or a model id, ...}
+#       with the same options as /generate; answered by {"type": "accepted", "ref", "run_id"}
+#   {"type": "cancel", "run_id": ...}
+#   {"type": "resume", "run_id": ..., "after": <seq>} after reconnecting
+# and gets back every event of every run it started, interleaved, each tagged with its
+# run_id and seq. Runs are the same FanOut runs the SSE stream serves, pushed to the
+# connection as they are published, so a prompt costs no request, stream or generator
+# of its own.
+CHANNEL_MAX_RUNS = int(os.getenv('CHANNEL_MAX_RUNS', '8'))
+
+
+class Channel:
+    def __init__(self, api_keys, user_id, send):
+        # send(text) is called from any thread and must not block
+        self.api_keys = api_keys
+        self.user_id = user_id
+        self._send = send
+        self._lock = threading.Lock()
+        # run_id -> (run, listener) for the runs this connection follows
+        self._runs = {}
+        self.closed = False
+
+    def _emit(self, message):
+        if not self.closed:
+            self._send(json.dumps(message))
+
+    def receive(self, text):
+        try:
+            message = json.loads(text)
+        except (TypeError, ValueError):
+            message = None
+        if not isinstance(message, dict):
+            self._emit({'type': 'error', 'error': 'Messages must be JSON objects', 'status': 400})
+            return
+        kind = message.get('type')
+        if kind == 'generate':
+            self._generate(message)
+        elif kind == 'cancel':
+            self._cancel(message.get('run_id'))
+        elif kind == 'resume':
+            self._resume(message.get('run_id'), message.get('after'))
+        else:
+            self._emit({'type': 'error', 'error': f"Unknown message type {kind!r}", 'status': 400})
+
+    def _generate(self, message):
+        # Not imported at the top: app.py serves /channel_stats from this module
+        from app import FanOut, parse_mode, provider_counts
+        ref = message.get('ref')
+
+        def fail(error, status, **extra):
+            self._emit(dict({'type': 'error', 'ref': ref, 'error': error, 'status': status}, **extra))
+
+        prompt = message.get('prompt')
+        model = message.get('model', 'all')
+        if not prompt:
+            return fail('Prompt is required', 400)
+        with self._lock:
+            busy = len(self._runs) >= CHANNEL_MAX_RUNS
+        if busy:
+            return fail(f"At most {CHANNEL_MAX_RUNS} prompts may run at once on a connection", 429)
+        try:
+            deadline = parse_deadline(message.get('deadline'))
+        except (TypeError, ValueError):
+            return fail('deadline must be a positive number of seconds', 400)
+        try:
+            wanted = parse_mode(message.get('mode'), message.get('n'))
+            model_ids = parse_model_list(message.get('models'))
+            fastest_k = parse_fastest_k(message.get('fastest_k'))
+            latency_budget = parse_latency_budget(message.get('latency_budget'))
+        except (TypeError, ValueError) as e:
+            return fail(str(e), 400)
+
+        hedge = message.get('hedge')
+        hedges = None
+        if model == 'all':
+            # Same selection as /generate
+            selected = select_models(model_ids, fastest_k, latency_budget, self.api_keys)
+            if latency_budget is not None:
+                deadline = min(deadline, latency_budget) if deadline is not None else latency_budget
+            if not selected and (model_ids or fastest_k or latency_budget):
+                return fail('No available model matches the selection', 400)
+            admitted = selected
+            if model_ids is None and fastest_k is None and latency_budget is None:
+                selected = None
+            name = 'generate all'
+        elif model not in MODEL_SPECS or (hedge and (hedge not in MODEL_SPECS or hedge == model)):
+            return fail('Invalid model selected' if model not in MODEL_SPECS else 'hedge must be a different, valid model',
+                        400)
+        elif hedge:
+            # Like hedged_response, streamed
+            selected = admitted = [model, hedge]
+            wanted = 1
+            hedges = {hedge: LATENCY.hedge_delay(model)}
+            name = f"generate {model} hedged by {hedge}"
+        else:
+            # A single model streams its answer like the fan-out does
+            selected = admitted = [model]
+            name = f"generate {model}"
+        try:
+            if admitted:
+                DISPATCHER.admit(provider_counts(admitted),
+                                 max(LATENCY.budget(model_id, deadline)['total'] for model_id in admitted))
+        except Saturated as e:
+            return fail(e.reason, 503, retry_after=e.retry_after)
+
+        use_cache = str(message.get('cache', True)).lower() not in ('false', '0', 'no', 'off')
+        memory = str(message.get('memory', True)).lower() not in ('false', '0', 'no', 'off')
+        force_trace = str(message.get('trace')).lower() in ('true', '1', 'yes', 'on')
+        run = RUNS.create(len(MODEL_SPECS if selected is None else selected), self.user_id)
+        fanout = FanOut(run, prompt, self.api_keys, self.user_id, message.get('conversation_id', 'default'),
+                        use_cache, deadline, model_ids=selected, wanted=wanted, hedges=hedges, memory=memory,
+                        trace=TRACER.start(run.run_id, name, force=force_trace))
+        self._emit({'type': 'accepted', 'ref': ref, 'run_id': run.run_id})
+        # Following before starting, so no event is missed
+        self._follow(run, 0)
+        fanout.start()
+
+    def _follow(self, run, after_seq):
+        def listener(seq, event_data):
+            if seq is None:
+                with self._lock:
+                    self._runs.pop(run.run_id, None)
+                return
+            self._emit(dict(event_data, run_id=run.run_id, seq=seq))
+
+        with self._lock:
+            if self.closed or run.run_id in self._runs:
+                return
+            self._runs[run.run_id] = (run, listener)
+        run.subscribe(listener, after_seq)
+
+    def _cancel(self, run_id):
+        with self._lock:
+            entry = self._runs.get(run_id)
+        # Only runs this connection started or resumed are here, and _resume checks the
+        # owner; the check below keeps cancelling to the run's owner whatever put it here
+        if entry is None or entry[0].scope is None or entry[0].user_id != self.user_id:
+            self._emit({'type': 'error', 'run_id': run_id, 'error': 'Unknown or finished run', 'status': 404})
+            return
+        entry[0].scope.cancel('cancelled')
+
+    def _resume(self, run_id, after_seq):
+        # A reconnected tab picks its runs up where it left off, like Last-Event-ID
+        # Someone else's run is as unknown as an expired one, as with /generate
+        run = RUNS.get(run_id, self.user_id) if isinstance(run_id, str) else None
+        if run is None or not isinstance(after_seq, int):
+            self._emit({'type': 'error', 'run_id': run_id, 'error': 'Unknown or expired run', 'status': 404})
+            return
+        self._follow(run, after_seq)
+
+    def close(self):
+        # The connection is gone: its runs carry on for RESUME_GRACE_SECONDS in case the
+        # tab reconnects, as when an EventSource drops
+        with self._lock:
+            self.closed = True
+            entries, self._runs = list(self._runs.values()), {}
+        for run, listener in entries:
+            run.unsubscribe(listener)
+
+
+class ChannelRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._open = set()
+        self.opened = 0
+        self.messages = 0
+
+    def open(self, api_keys, user_id, send):
+        channel = Channel(api_keys, user_id, send)
+        with self._lock:
+            self._open.add(channel)
+            self.opened += 1
+        return channel
+
+    def receive(self, channel, text):
+        with self._lock:
+            self.messages += 1
+        channel.receive(text)
+
+    def close(self, channel):
+        channel.close()
+        with self._lock:
+            self._open.discard(channel)
+
+    def stats(self):
+        with self._lock:
+            channels = list(self._open)
+            stats = {'open': len(channels), 'opened': self.opened, 'messages': self.messages,
+                     'max_runs_per_channel': CHANNEL_MAX_RUNS}
+        stats['runs'] = sum(len(channel._runs) for channel in channels)
+        return stats
+
+
+# Shared by every request handled by this process
+CHANNELS = ChannelRegistry()
+
@@ -0,0 +1,171 @@
+import os
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+# Process-wide pool of provider SDK clients. Building an OpenAI / Azure / Mistral
+# client per prompt means a new connection pool, DNS lookup and TLS handshake for
+# every model call, so clients are kept alive here and reused across requests.
+CLIENT_POOL_MAX_CLIENTS = int(os.getenv('CLIENT_POOL_MAX_CLIENTS', '64'))
+CLIENT_POOL_IDLE_TTL_SECONDS = float(os.getenv('CLIENT_POOL_IDLE_TTL_SECONDS', '900'))
+
+# Connection settings for the keep-alive pools owned by each client
+KEEPALIVE_CONNECTIONS = int(os.getenv('CLIENT_POOL_KEEPALIVE_CONNECTIONS', '20'))
+KEEPALIVE_EXPIRY_SECONDS = float(os.getenv('CLIENT_POOL_KEEPALIVE_EXPIRY_SECONDS', '120'))
+
+
+def credential_fingerprint(credential):
+    # Never keep raw keys in pool keys or stats, only a short stable hash
+    if not credential:
+        return ''
+    return hashlib.sha256(credential.encode('utf-8')).hexdigest()[:16]
+
+
+def close_quietly(closer):
+    if closer is None:
+        return
+    try:
+        closer()
+    except Exception:
+        pass
+
+
+class ClientPool:
+    # Clients are checked out with get() and handed back with release(). One that is
+    # evicted (or expires) while a request or stream is still using it is only closed
+    # when its last user releases it.
+    def __init__(self, max_clients=CLIENT_POOL_MAX_CLIENTS, idle_ttl=CLIENT_POOL_IDLE_TTL_SECONDS):
+        self.max_clients = max_clients
+        self.idle_ttl = idle_ttl
+        self._lock = threading.Lock()
+        # key -> [client, closer, last_used, users, evicted]; ordered from least to most recently used
+        self._entries = OrderedDict()
+        # id(client) -> entry, for every client checked out at least once right now
+        self._checked_out = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, provider, endpoint, credential, builder):
+        # builder() must return (client, closer) and is only called on a miss.
+        # Every get() must be matched by a release(client).
+        key = (provider, endpoint, credential_fingerprint(credential))
+        stale = []
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                # A client in use is not idle, however long its stream has been going
+                if entry[3] or now - entry[2] <= self.idle_ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return self._check_out_locked(entry, now)
+                # Idle for too long, the provider has likely dropped the connections anyway
+                del self._entries[key]
+                self.expirations += 1
+                stale.append(entry[1])
+            self.misses += 1
+
+        for closer in stale:
+            close_quietly(closer)
+
+        # Build outside the lock so a slow SDK constructor does not block other lookups
+        client, closer = builder()
+
+        with self._lock:
+            existing = self._entries.get(key)
+            if existing is not None:
+                # Another thread built the same client concurrently, keep the first one
+                self._entries.move_to_end(key)
+                stale = [closer]
+                client = self._check_out_locked(existing, time.monotonic())
+            else:
+                entry = self._entries[key] = [client, closer, time.monotonic(), 0, False]
+                self._check_out_locked(entry, entry[2])
+                stale = self._evict_locked()
+
+        for closer in stale:
+            close_quietly(closer)
+        return client
+
+    def _check_out_locked(self, entry, now):
+        entry[2] = now
+        entry[3] += 1
+        self._checked_out[id(entry[0])] = entry
+        return entry[0]
+
+    def release(self, client):
+        with self._lock:
+            entry = self._checked_out.get(id(client))
+            if entry is None or entry[0] is not client:
+                return
+            entry[2] = time.monotonic()
+            entry[3] -= 1
+            if entry[3]:
+                return
+            del self._checked_out[id(client)]
+            if not entry[4]:
+                return
+        # Evicted while in use: its last user is done with it
+        close_quietly(entry[1])
+
+    def _retire_locked(self, entry):
+        # The closer to run now, or None when the client is still in use
+        entry[4] = True
+        return None if entry[3] else entry[1]
+
+    def _evict_locked(self):
+        evicted = []
+        now = time.monotonic()
+        for key in list(self._entries):
+            entry = self._entries[key]
+            if not entry[3] and now - entry[2] > self.idle_ttl:
+                evicted.append(self._retire_locked(self._entries.pop(key)))
+                self.expirations += 1
+        while len(self._entries) > self.max_clients:
+            _, entry = self._entries.popitem(last=False)
+            evicted.append(self._retire_locked(entry))
+            self.evictions += 1
+        return [closer for closer in evicted if closer is not None]
+
+    def sweep(self):
+        with self._lock:
+            stale = self._evict_locked()
+        for closer in stale:
+            close_quietly(closer)
+        return len(stale)
+
+    def clear(self):
+        with self._lock:
+            stale = [self._retire_locked(entry) for entry in self._entries.values()]
+            self._entries.clear()
+        for closer in stale:
+            close_quietly(closer)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_clients': self.max_clients,
+                'idle_ttl_seconds': self.idle_ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'in_use': sum(entry[3] for entry in self._checked_out.values()),
+                # Evicted but still serving a request or stream; closed when it ends
+                'draining': sum(1 for entry in self._checked_out.values() if entry[4]),
+                'clients': [
+                    {'provider': key[0], 'endpoint': key[1], 'credential': key[2], 'users': entry[3]}
+                    for key, entry in self._entries.items()
+                ],
+            }
+
+
+# Shared by every request handled by this process
+POOL = ClientPool()
@@ -0,0 +1,243 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict, deque
+
+from model_registry import MODEL_SPECS
+
+# Conversation memory, kept server-side per (user, conversation id). Every model has its
+# own thread of the conversation (the prompts and its own answers), appended to as
+# answers come in, and each call sends as many recent turns as fit the model's history
+# budget. Older turns are dropped and only remembered as a one-line summary of what the
+# user asked, so requests stop growing however long the conversation gets.
+#
+# With CONVERSATION_STORE=shared (the default) each thread is kept in the session store's
+# backend (SQLite or Redis, see session_store.py) and read back for every request, so
+# any worker can carry on any conversation. CONVERSATION_STORE=memory keeps them in this
+# process instead: cheaper, but then every worker has its own memory, and a
+# conversation needs sticky sessions to be remembered.
+CONVERSATION_STORE = os.getenv('CONVERSATION_STORE', 'shared')
+CONVERSATION_MEMORY_ENABLED = os.getenv('CONVERSATION_MEMORY_ENABLED', 'true').lower() == 'true'
+CONVERSATION_HISTORY_TOKENS = int(os.getenv('CONVERSATION_HISTORY_TOKENS', '4000'))
+CONVERSATION_SUMMARY_TOKENS = int(os.getenv('CONVERSATION_SUMMARY_TOKENS', '200'))
+CONVERSATION_MAX_TURNS = int(os.getenv('CONVERSATION_MAX_TURNS', '50'))
+CONVERSATION_MAX_CONVERSATIONS = int(os.getenv('CONVERSATION_MAX_CONVERSATIONS', '1000'))
+
+# Room left for the answer of models that do not set max_tokens
+DEFAULT_OUTPUT_TOKENS = 4096
+CONVERSATION_KEY_PREFIX = 'everyai:conversation:'
+# Dropped prompts remembered for the summary, and how much of each
+SUMMARY_PROMPTS = 20
+SUMMARY_PROMPT_CHARS = 100
+
+
+def estimate_tokens(text):
+    # About four characters per token in English, plus the per-message overhead; close
+    # enough for a budget and it needs no tokenizer
+    return len(text) // 4 + 4
+
+
+def history_budget(model_id):
+    # Never more than the model's context window minus its answer
+    spec = MODEL_SPECS[model_id]
+    output_tokens = spec['params'].get('max_tokens', DEFAULT_OUTPUT_TOKENS)
+    return max(0, min(CONVERSATION_HISTORY_TOKENS, spec['context_tokens'] - output_tokens))
+
+
+def _summary(prompts):
+    # Most recent first until the summary budget is spent, then back in order
+    kept, tokens = [], 0
+    for prompt in reversed(prompts):
+        prompt = ' '.join(prompt.split())
+        if len(prompt) > SUMMARY_PROMPT_CHARS:
+            prompt = prompt[:SUMMARY_PROMPT_CHARS] + '...'
+        tokens += estimate_tokens(prompt)
+        if kept and tokens > CONVERSATION_SUMMARY_TOKENS:
+            break
+        kept.append(prompt)
+    if not kept:
+        return None
+    return "Earlier in this conversation the user asked: " + '; '.join(reversed(kept))
+
+
+class ModelThread:
+    def __init__(self, model_id, budget=None, max_turns=CONVERSATION_MAX_TURNS):
+        self.model_id = model_id
+        self.budget = history_budget(model_id) if budget is None else budget
+        self.max_turns = max_turns
+        self._lock = threading.Lock()
+        # (tokens, user message, assistant message), oldest first. Messages are built
+        # once here and reused by every later request.
+        self._turns = deque()
+        self._tokens = 0
+        self._dropped = deque(maxlen=SUMMARY_PROMPTS)
+        # Hash of everything ever appended, chained turn by turn; part of the cache key
+        self._chain = ''
+        # Called with the thread after every append, to save it (see ConversationStore)
+        self.on_append = None
+
+    def append(self, prompt, response):
+        if not isinstance(response, str):
+            return
+        tokens = estimate_tokens(prompt) + estimate_tokens(response)
+        with self._lock:
+            self._add_locked(tokens, prompt, response)
+            self._chain = hashlib.sha256(f"{self._chain}\0{prompt}\0{response}".encode('utf-8')).hexdigest()
+            # Turns that can never fit the budget again are dropped for good
+            while self._turns and (len(self._turns) > self.max_turns or self._tokens > self.budget):
+                self._drop_locked()
+        if self.on_append is not None:
+            self.on_append(self)
+
+    def _add_locked(self, tokens, prompt, response):
+        self._turns.append((tokens, {"role": "user", "content": prompt},
+                            {"role": "assistant", "content": response}))
+        self._tokens += tokens
+
+    def dump(self):
+        with self._lock:
+            return json.dumps({
+                'turns': [[tokens, user_message['content'], assistant_message['content']]
+                          for tokens, user_message, assistant_message in self._turns],
+                'dropped': list(self._dropped),
+                'chain': self._chain,
+            })
+
+    def restore(self, raw):
+        # The state dump() saved, into a new thread
+        state = json.loads(raw)
+        with self._lock:
+            for tokens, prompt, response in state['turns']:
+                self._add_locked(tokens, prompt, response)
+            self._dropped.extend(state['dropped'])
+            self._chain = state['chain']
+            # The budget may have shrunk since it was saved
+            while self._turns and (len(self._turns) > self.max_turns or self._tokens > self.budget):
+                self._drop_locked()
+
+    def _drop_locked(self):
+        tokens, user_message, _ = self._turns.popleft()
+        self._tokens -= tokens
+        self._dropped.append(user_message['content'])
+
+    def context(self, prompt):
+        # What to send before `prompt`, or None for a new conversation: the most recent
+        # turns that fit the budget together with the prompt, and a summary of the rest
+        room = self.budget - estimate_tokens(prompt)
+        with self._lock:
+            if not self._turns and not self._dropped:
+                return None
+            turns = list(self._turns)
+            total = self._tokens
+            dropped = list(self._dropped)
+            chain = self._chain
+        skip = 0
+        while skip < len(turns) and total > room:
+            total -= turns[skip][0]
+            dropped.append(turns[skip][1]['content'])
+            skip += 1
+        messages = []
+        for _, user_message, assistant_message in turns[skip:]:
+            messages.append(user_message)
+            messages.append(assistant_message)
+        return {'messages': messages, 'summary': _summary(dropped), 'key': chain, 'tokens': total}
+
+    def __len__(self):
+        return len(self._turns)
+
+
+class ConversationStore:
+    def __init__(self, max_conversations=CONVERSATION_MAX_CONVERSATIONS):
+        self.max_conversations = max_conversations
+        self._lock = threading.Lock()
+        # (user_id, conversation_id) -> {model_id: ModelThread}, least recently used first
+        self._conversations = OrderedDict()
+        self.evictions = 0
+        # The SessionStore whose backend holds the threads, once share() is called
+        self._sessions = None
+        self.loads = 0
+        self.saves = 0
+
+    def share(self, sessions):
+        # Keep threads in the backend of `sessions` (a session_store.SessionStore), which
+        # every worker reads, instead of in this process
+        self._sessions = sessions
+
+    @staticmethod
+    def _key(user_id, conversation_id, model_id):
+        # Hashed, so ids from the browser cannot collide with other keys
+        name = json.dumps([user_id, conversation_id, model_id])
+        return CONVERSATION_KEY_PREFIX + hashlib.sha256(name.encode('utf-8')).hexdigest()
+
+    def _shared_thread(self, user_id, conversation_id, model_id):
+        # Read afresh every time, since another worker may have answered since. Two
+        # requests answering for the same model of the same conversation at once each
+        # save their own turn, and the later save wins.
+        sessions = self._sessions
+        key = self._key(user_id, conversation_id, model_id)
+        thread = ModelThread(model_id)
+        raw = sessions.backend.get(key)
+        if raw is not None:
+            thread.restore(raw)
+        thread.on_append = lambda thread: self._save(key, thread)
+        with self._lock:
+            self.loads += 1
+        return thread
+
+    def _save(self, key, thread):
+        # Kept as long as a session is
+        self._sessions.backend.setex(key, self._sessions.ttl, thread.dump())
+        with self._lock:
+            self.saves += 1
+
+    def thread(self, user_id, conversation_id, model_id):
+        if self._sessions is not None:
+            return self._shared_thread(user_id, conversation_id, model_id)
+        key = (user_id, conversation_id)
+        with self._lock:
+            threads = self._conversations.get(key)
+            if threads is None:
+                threads = self._conversations[key] = {}
+            self._conversations.move_to_end(key)
+            thread = threads.get(model_id)
+            if thread is None:
+                thread = threads[model_id] = ModelThread(model_id)
+            while len(self._conversations) > self.max_conversations:
+                self._conversations.popitem(last=False)
+                self.evictions += 1
+            return thread
+
+    def forget(self, user_id, conversation_id):
+        if self._sessions is not None:
+            backend = self._sessions.backend
+            forgotten = False
+            for model_id in MODEL_SPECS:
+                key = self._key(user_id, conversation_id, model_id)
+                if backend.get(key) is not None:
+                    backend.delete(key)
+                    forgotten = True
+            return forgotten
+        with self._lock:
+            return self._conversations.pop((user_id, conversation_id), None) is not None
+
+    def stats(self):
+        with self._lock:
+            conversations = list(self._conversations.values())
+            stats = {
+                'enabled': CONVERSATION_MEMORY_ENABLED,
+                'store': 'shared' if self._sessions is not None else 'memory',
+                # Threads read from and saved to the shared store by this process
+                'loads': self.loads,
+                'saves': self.saves,
+                'conversations': len(conversations),
+                'max_conversations': self.max_conversations,
+                'evictions': self.evictions,
+            }
+        stats['threads'] = sum(len(threads) for threads in conversations)
+        stats['turns'] = sum(len(thread) for threads in conversations for thread in threads.values())
+        return stats
+
+
+# Shared by every request handled by this process
+CONVERSATIONS = ConversationStore()
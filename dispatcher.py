@@ -0,0 +1,222 @@
+import os
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+from model_registry import PROVIDER_GITHUB, PROVIDER_AZURE, PROVIDER_NVIDIA
+
+# Single process-wide scheduler for every model call. Work is queued per user and
+# served round-robin so one user's eight-way fan-out cannot starve another, and each
+# provider has its own concurrency cap so a slow vendor cannot occupy every worker.
+DISPATCHER_WORKERS = int(os.getenv('DISPATCHER_WORKERS', '32'))
+DISPATCHER_MAX_QUEUE = int(os.getenv('DISPATCHER_MAX_QUEUE', '256'))
+
+PROVIDER_CONCURRENCY = {
+    PROVIDER_GITHUB: int(os.getenv('PROVIDER_CONCURRENCY_GITHUB', '12')),
+    PROVIDER_AZURE: int(os.getenv('PROVIDER_CONCURRENCY_AZURE', '12')),
+    PROVIDER_NVIDIA: int(os.getenv('PROVIDER_CONCURRENCY_NVIDIA', '6')),
+}
+
+# Smoothing factor for the service/wait time averages used by admission control
+EWMA_ALPHA = 0.2
+RECENT_WAITS = 256
+
+
+class Saturated(Exception):
+    def __init__(self, retry_after, reason):
+        super().__init__(reason)
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class _Task:
+    __slots__ = ('future', 'provider', 'fn', 'args', 'kwargs', 'enqueued_at')
+
+    def __init__(self, future, provider, fn, args, kwargs):
+        self.future = future
+        self.provider = provider
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.enqueued_at = time.monotonic()
+
+
+class Dispatcher:
+    def __init__(self, workers=DISPATCHER_WORKERS, provider_limits=None, max_queue=DISPATCHER_MAX_QUEUE):
+        self.workers = workers
+        self.provider_limits = dict(provider_limits or PROVIDER_CONCURRENCY)
+        self.max_queue = max_queue
+        self._cond = threading.Condition()
+        # user_id -> deque of tasks; the order of keys is the round-robin order
+        self._queues = OrderedDict()
+        self._queued = 0
+        self._queued_by_provider = {}
+        self._running_by_provider = {}
+        self._threads = []
+        self._idle_workers = 0
+        # Gauges
+        self._service_ewma = {}
+        self._wait_ewma = 0.0
+        self._recent_waits = deque(maxlen=RECENT_WAITS)
+        self.completed = 0
+        self.rejected = 0
+        self.cancelled = 0
+
+    def admit(self, provider_counts, budget_seconds):
+        # Reject work up front when the queue ahead of it means it could not finish in time
+        with self._cond:
+            if self._queued + sum(provider_counts.values()) > self.max_queue:
+                self.rejected += 1
+                raise Saturated(self._retry_after_locked(), 'Server is at capacity, please retry shortly')
+            for provider, count in provider_counts.items():
+                expected = self._expected_wait_locked(provider, count)
+                if expected > budget_seconds:
+                    self.rejected += 1
+                    retry_after = max(1, math.ceil(expected - budget_seconds))
+                    raise Saturated(retry_after, f'{provider} models are saturated, please retry shortly')
+
+    def _expected_wait_locked(self, provider, count):
+        service = self._service_ewma.get(provider)
+        if service is None:
+            return 0.0
+        limit = max(1, min(self.provider_limits.get(provider, self.workers), self.workers))
+        ahead = self._queued_by_provider.get(provider, 0) + self._running_by_provider.get(provider, 0)
+        # Batches of `limit` calls drain every `service` seconds; the last of ours also has to run
+        return math.floor((ahead + count - 1) / limit) * service + service
+
+    def _retry_after_locked(self):
+        if not self._service_ewma:
+            return 1
+        service = max(self._service_ewma.values())
+        return max(1, math.ceil(self._queued * service / self.workers))
+
+    def submit(self, user_id, provider, fn, *args, **kwargs):
+        future = Future()
+        task = _Task(future, provider, fn, args, kwargs)
+        with self._cond:
+            queue = self._queues.get(user_id)
+            if queue is None:
+                queue = self._queues[user_id] = deque()
+            queue.append(task)
+            self._queued += 1
+            self._queued_by_provider[provider] = self._queued_by_provider.get(provider, 0) + 1
+            self._ensure_worker_locked()
+            self._cond.notify()
+        future.add_done_callback(lambda future: self._cancelled(user_id, task))
+        return future
+
+    def _cancelled(self, user_id, task):
+        # A task cancelled while still queued leaves the queue straight away, so it stops
+        # counting against admission and the expected wait of everything behind it
+        if not task.future.cancelled():
+            return
+        with self._cond:
+            queue = self._queues.get(user_id)
+            if queue is None or task not in queue:
+                # A worker took it first and will find it cancelled
+                return
+            queue.remove(task)
+            if not queue:
+                del self._queues[user_id]
+            self._queued -= 1
+            self._queued_by_provider[task.provider] -= 1
+            self.cancelled += 1
+
+    def _ensure_worker_locked(self):
+        # Workers are started lazily so gunicorn's fork happens before any thread exists
+        if self._queued > self._idle_workers and len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._worker, name=f'dispatcher-{len(self._threads)}', daemon=True)
+            self._threads.append(thread)
+            self._idle_workers += 1
+            thread.start()
+
+    def _next_task_locked(self):
+        for user_id in list(self._queues):
+            queue = self._queues[user_id]
+            for index, task in enumerate(queue):
+                if task.future.cancelled():
+                    # Its done callback is about to take it out (see _cancelled)
+                    continue
+                running = self._running_by_provider.get(task.provider, 0)
+                if running >= self.provider_limits.get(task.provider, self.workers):
+                    continue
+                del queue[index]
+                if queue:
+                    # Served this user, move them to the back of the round-robin
+                    self._queues.move_to_end(user_id)
+                else:
+                    del self._queues[user_id]
+                self._queued -= 1
+                self._queued_by_provider[task.provider] -= 1
+                self._running_by_provider[task.provider] = running + 1
+                return task
+        return None
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                task = self._next_task_locked()
+                while task is None:
+                    self._cond.wait()
+                    task = self._next_task_locked()
+                self._idle_workers -= 1
+
+            started = time.monotonic()
+            waited = started - task.enqueued_at
+            ran = False
+            try:
+                if task.future.set_running_or_notify_cancel():
+                    ran = True
+                    try:
+                        result = task.fn(*task.args, **task.kwargs)
+                    except BaseException as e:
+                        task.future.set_exception(e)
+                    else:
+                        task.future.set_result(result)
+            finally:
+                finished = time.monotonic()
+                with self._cond:
+                    self._running_by_provider[task.provider] -= 1
+                    self._idle_workers += 1
+                    if ran:
+                        self.completed += 1
+                        self._record_locked(task.provider, waited, finished - started)
+                    # A provider slot was freed, tasks that were blocked on it may now run
+                    self._cond.notify_all()
+
+    def _record_locked(self, provider, waited, service):
+        self._recent_waits.append(waited)
+        self._wait_ewma += EWMA_ALPHA * (waited - self._wait_ewma)
+        previous = self._service_ewma.get(provider)
+        if previous is None:
+            self._service_ewma[provider] = service
+        else:
+            self._service_ewma[provider] = previous + EWMA_ALPHA * (service - previous)
+
+    def stats(self):
+        with self._cond:
+            waits = sorted(self._recent_waits)
+            p95 = waits[int(len(waits) * 0.95) - 1] if waits else 0.0
+            return {
+                'workers': len(self._threads),
+                'max_workers': self.workers,
+                'idle_workers': self._idle_workers,
+                'queue_depth': self._queued,
+                'queue_depth_by_provider': dict(self._queued_by_provider),
+                'running_by_provider': dict(self._running_by_provider),
+                'provider_limits': dict(self.provider_limits),
+                'queued_users': len(self._queues),
+                'wait_seconds_ewma': round(self._wait_ewma, 4),
+                'wait_seconds_p95': round(p95, 4),
+                'wait_seconds_max': round(waits[-1], 4) if waits else 0.0,
+                'service_seconds_ewma': {k: round(v, 4) for k, v in self._service_ewma.items()},
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'cancelled': self.cancelled,
+            }
+
+
+# Shared by every request handled by this process
+DISPATCHER = Dispatcher()
@@ -0,0 +1,5 @@
+# Read by gunicorn from the directory it is started in
+def post_worker_init(worker):
+    # Each worker runs its own job runner once it has loaded the app (see app.start_job_runner)
+    from app import start_job_runner
+    start_job_runner()
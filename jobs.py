@@ -0,0 +1,351 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+
+from model_registry import MODEL_NAMES
+from runs import SSE_HEARTBEAT_SECONDS, SSE_RETRY_MS
+
+# Batch jobs: many prompts x many models, run in the background and kept in a local
+# SQLite file so they outlive the browser tab and the worker process. Each prompt/model
+# pair is a task. A runner thread per process claims tasks and hands them to the shared
+# dispatcher, so jobs take their turn with interactive requests and go through the same
+# rate limits. A claimed task holds a lease; if its worker dies, another process (or the
+# same one restarted) takes it over once the lease runs out.
+JOBS_DB = os.getenv('JOBS_DB', 'jobs.db')
+# Job calls in flight per process, so a big job cannot fill the dispatcher queue
+JOBS_CONCURRENCY = int(os.getenv('JOBS_CONCURRENCY', '8'))
+JOBS_MAX_TASKS = int(os.getenv('JOBS_MAX_TASKS', '10000'))
+JOBS_MAX_ATTEMPTS = int(os.getenv('JOBS_MAX_ATTEMPTS', '3'))
+# Longer than any call may take (MODEL_TIMEOUT_CEILING_SECONDS plus rate limit waits)
+JOBS_LEASE_SECONDS = float(os.getenv('JOBS_LEASE_SECONDS', '300'))
+# How often an idle runner looks for work other processes may have queued
+JOBS_POLL_SECONDS = float(os.getenv('JOBS_POLL_SECONDS', '2'))
+# Finished jobs are deleted after this long
+JOBS_RETENTION_SECONDS = float(os.getenv('JOBS_RETENTION_SECONDS', str(7 * 24 * 3600)))
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+CANCELLED = 'cancelled'
+
+
+def parse_prompts(value):
+    # ["text", ...] or [{"id": ..., "prompt": ...}, ...]; ValueError when invalid
+    if not isinstance(value, list) or not value:
+        raise ValueError('prompts must be a non-empty list')
+    prompts, seen = [], set()
+    for number, item in enumerate(value, 1):
+        if isinstance(item, dict):
+            prompt_id, prompt = str(item.get('id', number)), item.get('prompt')
+        else:
+            prompt_id, prompt = str(number), item
+        if not isinstance(prompt, str) or not prompt:
+            raise ValueError(f"prompt {prompt_id} is empty")
+        if prompt_id in seen:
+            raise ValueError(f"duplicate prompt id {prompt_id!r}")
+        seen.add(prompt_id)
+        prompts.append((prompt_id, prompt))
+    return prompts
+
+
+class JobQueue:
+    def __init__(self, path=JOBS_DB, concurrency=JOBS_CONCURRENCY):
+        self.path = path
+        self.concurrency = concurrency
+        self._db = None
+        self._lock = threading.Lock()
+        # Wakes the runner (a slot or new work) and anyone streaming results
+        self._cond = threading.Condition()
+        self._execute = None
+        self._thread = None
+        # task id -> handle returned by execute(), for cancelling
+        self._inflight = {}
+        self._owner = uuid.uuid4().hex
+        self.claimed = 0
+        self.finished = 0
+
+    def _connect_locked(self):
+        # Opened on first use, by whichever thread gets there first
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                'id TEXT PRIMARY KEY, user_id TEXT NOT NULL, status TEXT NOT NULL, models TEXT NOT NULL, '
+                'api_keys TEXT, use_cache INTEGER NOT NULL, total INTEGER NOT NULL, '
+                'created_at REAL NOT NULL, finished_at REAL)'
+            )
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS tasks ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, job_id TEXT NOT NULL, prompt_id TEXT NOT NULL, '
+                'prompt TEXT NOT NULL, model_id TEXT NOT NULL, status TEXT NOT NULL, '
+                'not_before REAL NOT NULL DEFAULT 0, lease_until REAL, owner TEXT, '
+                'attempts INTEGER NOT NULL DEFAULT 0, seq INTEGER, result TEXT)'
+            )
+            self._db.execute('CREATE INDEX IF NOT EXISTS tasks_claim ON tasks (status, not_before)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS tasks_results ON tasks (job_id, seq)')
+            try:
+                # Queued jobs keep their API keys until they finish
+                os.chmod(self.path, 0o600)
+            except OSError:
+                pass
+        return self._db
+
+    def _after_fork_in_child(self):
+        # Only the forking thread survives a fork: the runner thread, the connection (which
+        # SQLite must not share across processes) and the locks stay behind with the parent,
+        # and the tasks it leased are its own, not this process's
+        self._db = None
+        self._lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._inflight = {}
+        self._owner = uuid.uuid4().hex
+
+    def _write(self, fn):
+        # fn(db) inside one IMMEDIATE transaction, so claims are atomic across processes
+        with self._lock:
+            db = self._connect_locked()
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                result = fn(db)
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+            return result
+
+    def _read(self, sql, args=()):
+        with self._lock:
+            return self._connect_locked().execute(sql, args).fetchall()
+
+    def start(self, execute):
+        # execute(task, done) starts a task and returns something with cancel(); it must
+        # call done(task, record, retry_in=None, attempted=True) exactly once, from any thread
+        with self._cond:
+            self._execute = execute
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='jobs', daemon=True)
+                self._thread.start()
+
+    def create(self, user_id, prompts, model_ids, api_keys, use_cache=True):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+
+        def insert(db):
+            db.execute('INSERT INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, NULL)',
+                       (job_id, user_id, QUEUED, json.dumps(model_ids), json.dumps(api_keys), int(use_cache),
+                        len(prompts) * len(model_ids), now))
+            # Prompt-major, so early prompts are answered by every model first
+            db.executemany('INSERT INTO tasks (job_id, prompt_id, prompt, model_id, status) VALUES (?, ?, ?, ?, ?)',
+                           [(job_id, prompt_id, prompt, model_id, QUEUED)
+                            for prompt_id, prompt in prompts for model_id in model_ids])
+            # Old finished jobs go as new ones come in
+            expired = [row[0] for row in db.execute(
+                'SELECT id FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?',
+                (now - JOBS_RETENTION_SECONDS,))]
+            for old_id in expired:
+                db.execute('DELETE FROM tasks WHERE job_id = ?', (old_id,))
+                db.execute('DELETE FROM jobs WHERE id = ?', (old_id,))
+
+        self._write(insert)
+        with self._cond:
+            self._cond.notify_all()
+        return self.get(job_id)
+
+    def get(self, job_id):
+        rows = self._read('SELECT id, user_id, status, models, total, created_at, finished_at FROM jobs WHERE id = ?',
+                          (job_id,))
+        if not rows:
+            return None
+        job_id, user_id, status, models, total, created_at, finished_at = rows[0]
+        counts = dict(self._read('SELECT status, COUNT(*) FROM tasks WHERE job_id = ? GROUP BY status', (job_id,)))
+        by_model = {}
+        for model_id, task_status, count in self._read(
+                'SELECT model_id, status, COUNT(*) FROM tasks WHERE job_id = ? GROUP BY model_id, status', (job_id,)):
+            by_model.setdefault(model_id, {})[task_status] = count
+        completed = counts.get('success', 0) + counts.get('error', 0)
+        return {
+            'job_id': job_id,
+            'user_id': user_id,
+            'status': status,
+            'models': json.loads(models),
+            'total': total,
+            'completed': completed,
+            'succeeded': counts.get('success', 0),
+            'failed': counts.get('error', 0),
+            'queued': counts.get(QUEUED, 0),
+            'running': counts.get(RUNNING, 0),
+            'cancelled': counts.get(CANCELLED, 0),
+            'progress': round(completed / total, 4) if total else 1.0,
+            'by_model': by_model,
+            'created_at': created_at,
+            'finished_at': finished_at,
+        }
+
+    def list(self, user_id, limit=50):
+        rows = self._read('SELECT id FROM jobs WHERE user_id = ? ORDER BY created_at DESC LIMIT ?', (user_id, limit))
+        return [self.get(row[0]) for row in rows]
+
+    def results(self, job_id, after=0, limit=500):
+        rows = self._read('SELECT seq, result FROM tasks WHERE job_id = ? AND seq > ? ORDER BY seq LIMIT ?',
+                          (job_id, after, limit))
+        return [dict(json.loads(result), seq=seq) for seq, result in rows]
+
+    def follow(self, job_id, after=0, sse=True, heartbeat=SSE_HEARTBEAT_SECONDS):
+        # Generator of every result after `after` as SSE events or NDJSON lines, live until
+        # the job is over. Results finished by other processes are found by re-reading
+        # the table at least every heartbeat.
+        if sse:
+            yield f"retry: {SSE_RETRY_MS}\n\n"
+        while True:
+            # Status first: a job seen as over has no results left to appear after this read
+            job = self.get(job_id)
+            over = job is None or job['status'] in (DONE, CANCELLED)
+            records = self.results(job_id, after)
+            for record in records:
+                after = record['seq']
+                if sse:
+                    yield f"id: {record['seq']}\ndata: {json.dumps(record)}\n\n"
+                else:
+                    yield json.dumps(record) + '\n'
+            if records:
+                continue
+            if over:
+                if sse:
+                    if job is not None:
+                        job.pop('user_id')
+                    yield f"data: {json.dumps({'event': 'job_completed', 'job': job})}\n\n"
+                return
+            with self._cond:
+                self._cond.wait(heartbeat)
+            if sse:
+                yield ": heartbeat\n\n"
+
+    def cancel(self, job_id):
+        def mark(db):
+            changed = db.execute('UPDATE jobs SET status = ?, finished_at = ?, api_keys = NULL '
+                                 'WHERE id = ? AND status IN (?, ?)',
+                                 (CANCELLED, time.time(), job_id, QUEUED, RUNNING)).rowcount
+            if changed:
+                db.execute('UPDATE tasks SET status = ? WHERE job_id = ? AND status = ?', (CANCELLED, job_id, QUEUED))
+                return [row[0] for row in db.execute(
+                    'SELECT id FROM tasks WHERE job_id = ? AND status = ? AND owner = ?',
+                    (job_id, RUNNING, self._owner))]
+            return None
+
+        running = self._write(mark)
+        if running is None:
+            return False
+        # Calls this process is making are aborted; the results they get are dropped
+        with self._cond:
+            handles = [self._inflight.get(task_id) for task_id in running]
+            self._cond.notify_all()
+        for handle in handles:
+            if handle is not None:
+                handle.cancel()
+        return True
+
+    def _claim(self):
+        now = time.time()
+
+        def claim(db):
+            # Queued work, or work whose lease ran out because its process died mid-call
+            row = db.execute(
+                'SELECT tasks.id, tasks.job_id, prompt_id, prompt, model_id, attempts, api_keys, use_cache, user_id '
+                'FROM tasks JOIN jobs ON jobs.id = tasks.job_id '
+                'WHERE (tasks.status = ? AND not_before <= ?) OR (tasks.status = ? AND lease_until < ?) '
+                'ORDER BY tasks.id LIMIT 1',
+                (QUEUED, now, RUNNING, now)).fetchone()
+            if row is None:
+                return None
+            task_id, job_id, prompt_id, prompt, model_id, attempts, api_keys, use_cache, user_id = row
+            db.execute('UPDATE tasks SET status = ?, lease_until = ?, owner = ?, attempts = ? WHERE id = ?',
+                       (RUNNING, now + JOBS_LEASE_SECONDS, self._owner, attempts + 1, task_id))
+            db.execute('UPDATE jobs SET status = ? WHERE id = ? AND status = ?', (RUNNING, job_id, QUEUED))
+            return {
+                'task_id': task_id, 'job_id': job_id, 'prompt_id': prompt_id, 'prompt': prompt,
+                'model_id': model_id, 'attempt': attempts + 1,
+                'api_keys': json.loads(api_keys or '{}'), 'use_cache': bool(use_cache), 'user_id': user_id,
+            }
+
+        return self._write(claim)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while len(self._inflight) >= self.concurrency:
+                    self._cond.wait()
+            try:
+                task = self._claim()
+            except sqlite3.Error:
+                task = None
+            if task is None:
+                with self._cond:
+                    self._cond.wait(JOBS_POLL_SECONDS)
+                continue
+            self.claimed += 1
+            with self._cond:
+                # Reserve the slot before starting: done() may run before execute returns
+                self._inflight[task['task_id']] = None
+            try:
+                handle = self._execute(task, self._done)
+            except Exception as e:
+                self._done(task, {'status': 'error', 'error': f"{type(e).__name__}: {e}"})
+                continue
+            with self._cond:
+                if task['task_id'] in self._inflight:
+                    self._inflight[task['task_id']] = handle
+
+    def _done(self, task, record, retry_in=None, attempted=True):
+        # retry_in: put the task back in the queue for that many seconds (timed out, rate
+        # limited, model unavailable) while it has attempts left. A call that never
+        # reached the provider (attempted=False) does not use up an attempt.
+        now = time.time()
+        retry = retry_in is not None and (not attempted or task['attempt'] < JOBS_MAX_ATTEMPTS)
+        record = dict(record, id=task['prompt_id'], model=task['model_id'],
+                      model_name=MODEL_NAMES.get(task['model_id']), attempts=task['attempt'])
+
+        def finish(db):
+            status = db.execute('SELECT status FROM jobs WHERE id = ?', (task['job_id'],)).fetchone()
+            if status is None or status[0] == CANCELLED:
+                db.execute('UPDATE tasks SET status = ? WHERE id = ?', (CANCELLED, task['task_id']))
+                return
+            if retry:
+                db.execute('UPDATE tasks SET status = ?, not_before = ?, lease_until = NULL, owner = NULL, '
+                           'attempts = attempts - ? WHERE id = ? AND owner = ?',
+                           (QUEUED, now + retry_in, 0 if attempted else 1, task['task_id'], self._owner))
+                return
+            db.execute(
+                'UPDATE tasks SET status = ?, result = ?, lease_until = NULL, '
+                'seq = (SELECT COALESCE(MAX(seq), 0) + 1 FROM tasks WHERE job_id = ?) WHERE id = ? AND owner = ?',
+                ('success' if record['status'] == 'success' else 'error', json.dumps(record), task['job_id'], task['task_id'], self._owner))
+            left = db.execute('SELECT COUNT(*) FROM tasks WHERE job_id = ? AND status IN (?, ?)',
+                              (task['job_id'], QUEUED, RUNNING)).fetchone()[0]
+            if not left:
+                # The keys are only needed while there is work left
+                db.execute('UPDATE jobs SET status = ?, finished_at = ?, api_keys = NULL WHERE id = ?',
+                           (DONE, now, task['job_id']))
+
+        try:
+            self._write(finish)
+        finally:
+            with self._cond:
+                self._inflight.pop(task['task_id'], None)
+                self.finished += 1
+                self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            stats = {'inflight': len(self._inflight), 'concurrency': self.concurrency,
+                     'claimed': self.claimed, 'finished': self.finished, 'running': self._thread is not None}
+        stats['tasks'] = dict(self._read('SELECT status, COUNT(*) FROM tasks GROUP BY status'))
+        return stats
+
+
+# Shared by every request handled by this process
+JOBS = JobQueue()
+os.register_at_fork(after_in_child=JOBS._after_fork_in_child)
@@ -0,0 +1,137 @@
+import os
+import math
+import threading
+from collections import deque
+
+from runs import TIMER
+
+# Per-model time budgets learnt from recent calls. A fast model gets a short leash and a
+# slow reasoning model a long one: each budget is a high percentile of that model's
+# recent successful calls plus headroom, kept between a floor and a ceiling. Until a
+# model has enough history it gets MODEL_TIMEOUT_SECONDS.
+MODEL_TIMEOUT_SECONDS = float(os.getenv('MODEL_TIMEOUT_SECONDS', '60'))
+MODEL_TIMEOUT_FLOOR_SECONDS = float(os.getenv('MODEL_TIMEOUT_FLOOR_SECONDS', '10'))
+MODEL_TIMEOUT_CEILING_SECONDS = float(os.getenv('MODEL_TIMEOUT_CEILING_SECONDS', '120'))
+# Time to first token has its own, shorter, deadline once it has been learnt
+FIRST_TOKEN_FLOOR_SECONDS = float(os.getenv('FIRST_TOKEN_FLOOR_SECONDS', '5'))
+LATENCY_PERCENTILE = float(os.getenv('LATENCY_PERCENTILE', '95'))
+LATENCY_HEADROOM = float(os.getenv('LATENCY_HEADROOM', '1.5'))
+LATENCY_WINDOW = int(os.getenv('LATENCY_WINDOW', '200'))
+LATENCY_MIN_SAMPLES = int(os.getenv('LATENCY_MIN_SAMPLES', '5'))
+# A hedged call sends the fallback request once the primary is slower to its first
+# token than this percentile of its recent calls (HEDGE_DELAY_SECONDS until learnt)
+HEDGE_PERCENTILE = float(os.getenv('HEDGE_PERCENTILE', '90'))
+HEDGE_DELAY_SECONDS = float(os.getenv('HEDGE_DELAY_SECONDS', '3'))
+
+
+def percentile(values, pct):
+    # Nearest-rank percentile of an unsorted sequence
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def parse_deadline(value):
+    # Request-level deadline in seconds; None when not given, ValueError when invalid
+    if value is None or value == '':
+        return None
+    deadline = float(value)
+    if not deadline > 0:
+        raise ValueError('deadline must be a positive number of seconds')
+    return min(deadline, MODEL_TIMEOUT_CEILING_SECONDS)
+
+
+def _clamp(value, floor, ceiling):
+    return max(floor, min(ceiling, value))
+
+
+class LatencyTracker:
+    def __init__(self, window=LATENCY_WINDOW, min_samples=LATENCY_MIN_SAMPLES):
+        self.window = window
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+        # model_id -> (recent total durations, recent times to first token)
+        self._samples = {}
+
+    def record(self, model_id, total, first_token=None):
+        # Only successful, uncached calls should be recorded
+        with self._lock:
+            samples = self._samples.get(model_id)
+            if samples is None:
+                samples = self._samples[model_id] = (deque(maxlen=self.window), deque(maxlen=self.window))
+            samples[0].append(total)
+            if first_token is not None:
+                samples[1].append(first_token)
+
+    def budget(self, model_id, deadline=None):
+        # {'total': seconds, 'first_token': seconds}, never beyond the request's deadline
+        with self._lock:
+            totals, first_tokens = self._samples.get(model_id, ((), ()))
+            totals, first_tokens = list(totals), list(first_tokens)
+        if len(totals) >= self.min_samples:
+            total = _clamp(percentile(totals, LATENCY_PERCENTILE) * LATENCY_HEADROOM,
+                           MODEL_TIMEOUT_FLOOR_SECONDS, MODEL_TIMEOUT_CEILING_SECONDS)
+        else:
+            total = MODEL_TIMEOUT_SECONDS
+        if deadline is not None:
+            total = min(total, deadline)
+        if len(first_tokens) >= self.min_samples:
+            first_token = min(total, max(FIRST_TOKEN_FLOOR_SECONDS,
+                                         percentile(first_tokens, LATENCY_PERCENTILE) * LATENCY_HEADROOM))
+        else:
+            first_token = total
+        return {'total': round(total, 3), 'first_token': round(first_token, 3)}
+
+    def hedge_delay(self, model_id):
+        # How long to give the primary of a hedged call before asking the fallback too
+        with self._lock:
+            first_tokens = list(self._samples.get(model_id, ((), ()))[1])
+        if len(first_tokens) >= self.min_samples:
+            return round(percentile(first_tokens, HEDGE_PERCENTILE), 3)
+        return HEDGE_DELAY_SECONDS
+
+    def summary(self, model_id):
+        # Recent latency of one model; None values until it has been called
+        with self._lock:
+            totals, first_tokens = self._samples.get(model_id, ((), ()))
+            totals, first_tokens = list(totals), list(first_tokens)
+        return {
+            'samples': len(totals),
+            'p50_seconds': round(percentile(totals, 50), 3) if totals else None,
+            'p95_seconds': round(percentile(totals, 95), 3) if totals else None,
+            'first_token_p50_seconds': round(percentile(first_tokens, 50), 3) if first_tokens else None,
+            'first_token_p95_seconds': round(percentile(first_tokens, 95), 3) if first_tokens else None,
+        }
+
+    def stats(self):
+        with self._lock:
+            model_ids = list(self._samples)
+        return {model_id: dict(self.summary(model_id), budget=self.budget(model_id)) for model_id in model_ids}
+
+
+def cancel_if_silent(call):
+    # Time-to-first-token deadline: give up on a model that has not started answering
+    if call.first_delta_at is None:
+        call.cancel('timed out')
+
+
+def watch_first_token(call, budget, on_silent, call_later=TIMER.call_later):
+    # Runs on_silent() once the call has had budget['first_token'] seconds to start
+    # answering. Time queued in the dispatcher and waits for a rate limit slot do not
+    # count, so the check re-arms itself until the call has been running, unthrottled,
+    # for that long. Returns [handle] of the pending check.
+    handle = [None]
+    def check():
+        left = call.first_token_left(budget['first_token'])
+        if left is None:
+            return
+        if left > 0:
+            handle[0] = call_later(left, check)
+        else:
+            on_silent()
+    handle[0] = call_later(budget['first_token'], check)
+    return handle
+
+
+# Shared by every request handled by this process
+LATENCY = LatencyTracker()
@@ -0,0 +1,367 @@
+import os
+import glob
+import json
+import math
+import time
+import bisect
+import threading
+
+# Prometheus text-format metrics without a client library. Histograms have fixed buckets
+# so recording is a bisect and two increments under a per-metric lock. With several
+# gunicorn workers, set METRICS_DIR to a directory shared by them (emptied before the
+# server starts): every worker writes its own snapshot there and /metrics, whichever
+# worker answers it, adds them all up.
+METRICS_DIR = os.getenv('METRICS_DIR', '')
+METRICS_FLUSH_SECONDS = float(os.getenv('METRICS_FLUSH_SECONDS', '5'))
+
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 45, 60, 90, 120)
+TOKENS_PER_SECOND_BUCKETS = (1, 5, 10, 20, 40, 60, 80, 100, 150, 200, 300, 500)
+STREAM_BUCKETS = (0.5, 1, 5, 10, 30, 60, 120, 300, 600)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels_text(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        # label values tuple -> value
+        self._values = {}
+
+    def snapshot(self):
+        with self._lock:
+            return {json.dumps(labels): _copy(value) for labels, value in self._values.items()}
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+def _copy(value):
+    return [list(value[0]), value[1], value[2]] if isinstance(value, list) else value
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self, samples):
+        lines = self.header()
+        for labels, value in samples.items():
+            lines.append(f"{self.name}{_labels_text(self.labelnames, labels)} {_number(value)}")
+        return lines
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, labels=(), amount=1):
+        self.inc(labels, -amount)
+
+    def set(self, labels, value):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def observe(self, labels, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                # [per-bucket counts (not cumulative), sum, count]
+                entry = self._values[labels] = [[0] * len(self.buckets), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self, samples):
+        lines = self.header()
+        for labels, (counts, total, count) in samples.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_labels_text(self.labelnames, labels, ('le', _number(bound)))} {cumulative}")
+            label_text = _labels_text(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {round(total, 6)}")
+            lines.append(f"{self.name}_count{label_text} {count}")
+        return lines
+
+
+def _merge(kind, target, labels, value):
+    current = target.get(labels)
+    if current is None:
+        target[labels] = _copy(value)
+    elif kind == 'histogram':
+        current[0] = [a + b for a, b in zip(current[0], value[0])]
+        current[1] += value[1]
+        current[2] += value[2]
+    else:
+        target[labels] = current + value
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+class Registry:
+    def __init__(self, directory=METRICS_DIR, flush_interval=METRICS_FLUSH_SECONDS):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._metrics = []
+        self._flusher = None
+        self._flusher_pid = None
+
+    def add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self.add(Counter(name, help_text, labelnames))
+
+    def gauge(self, name, help_text, labelnames=()):
+        return self.add(Gauge(name, help_text, labelnames))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.add(Histogram(name, help_text, labelnames, buckets))
+
+    def snapshot(self):
+        return {metric.name: metric.snapshot() for metric in self._metrics}
+
+    def _path(self, pid):
+        return os.path.join(self.directory, f"metrics-{pid}.json")
+
+    def flush(self):
+        if not self.directory:
+            return
+        pid = os.getpid()
+        path = self._path(pid)
+        tmp = f"{path}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump({'pid': pid, 'metrics': self.snapshot()}, f)
+        os.replace(tmp, path)
+
+    def ensure_flusher(self):
+        # Started lazily (and again after a fork) so every worker keeps its file fresh
+        if not self.directory or self._flusher_pid == os.getpid():
+            return
+        self._flusher_pid = os.getpid()
+        self._flusher = threading.Thread(target=self._flush_loop, name='metrics-flush', daemon=True)
+        self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except OSError:
+                pass
+
+    def collect(self):
+        # name -> merged samples, across every worker when METRICS_DIR is set
+        merged = {metric.name: {} for metric in self._metrics}
+        kinds = {metric.name: metric.kind for metric in self._metrics}
+        snapshots = [(True, self.snapshot())]
+        if self.directory:
+            own = self._path(os.getpid())
+            for path in glob.glob(os.path.join(self.directory, 'metrics-*.json')):
+                if path == own:
+                    continue
+                try:
+                    with open(path) as f:
+                        data = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                snapshots.append((_pid_alive(data.get('pid', 0)), data.get('metrics', {})))
+        for alive, snapshot in snapshots:
+            for name, samples in snapshot.items():
+                kind = kinds.get(name)
+                if kind is None or (kind == 'gauge' and not alive):
+                    # A dead worker's counts still happened; its in-flight gauges did not
+                    continue
+                for labels, value in samples.items():
+                    _merge(kind, merged[name], labels, value)
+        return merged
+
+    def render(self):
+        merged = self.collect()
+        lines = []
+        for metric in self._metrics:
+            samples = {tuple(json.loads(labels)): value for labels, value in sorted(merged[metric.name].items())}
+            lines.extend(metric.render(samples))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+MODEL_LABELS = ('model', 'provider')
+MODEL_CALLS = REGISTRY.counter(
+    'everyai_model_calls_total', 'Finished model calls by outcome (success, error, timeout, cancelled)',
+    MODEL_LABELS + ('status',))
+MODEL_CACHE_HITS = REGISTRY.counter(
+    'everyai_model_cache_hits_total', 'Model calls answered from the response cache', MODEL_LABELS)
+MODEL_LATENCY = REGISTRY.histogram(
+    'everyai_model_latency_seconds',
+    'Time successful, uncached model calls ran, from when a worker picked them up and without rate limit waits',
+    MODEL_LABELS)
+MODEL_QUEUE_WAIT = REGISTRY.histogram(
+    'everyai_model_queue_wait_seconds', 'Time uncached model calls waited for a worker before running', MODEL_LABELS)
+MODEL_FIRST_TOKEN = REGISTRY.histogram(
+    'everyai_model_first_token_seconds', 'Time to the first streamed token of uncached model calls', MODEL_LABELS)
+MODEL_TOKENS = REGISTRY.counter(
+    'everyai_model_output_tokens_total', 'Completion tokens reported by providers', MODEL_LABELS)
+MODEL_TOKENS_PER_SECOND = REGISTRY.histogram(
+    'everyai_model_tokens_per_second', 'Completion tokens per second after the first token, where usage is reported',
+    MODEL_LABELS, TOKENS_PER_SECOND_BUCKETS)
+MODEL_IN_FLIGHT = REGISTRY.gauge(
+    'everyai_model_calls_in_flight', 'Model calls queued or running', MODEL_LABELS)
+PROVIDER_LABELS = ('provider',)
+RATE_LIMITED = REGISTRY.counter(
+    'everyai_provider_rate_limited_total', 'Provider responses with status 429', PROVIDER_LABELS)
+RETRIES = REGISTRY.counter(
+    'everyai_provider_retries_total', 'Provider requests retried, by the status that caused it',
+    PROVIDER_LABELS + ('status',))
+THROTTLE_WAIT = REGISTRY.histogram(
+    'everyai_provider_throttle_wait_seconds',
+    'Time requests waited for a rate limit slot (queued) or before a retry (retry)', PROVIDER_LABELS + ('reason',))
+THROTTLE_REJECTED = REGISTRY.counter(
+    'everyai_provider_throttle_rejections_total', 'Requests failed because no rate limit slot came before the deadline',
+    PROVIDER_LABELS)
+BREAKERS_OPEN = REGISTRY.gauge(
+    'everyai_model_breaker_open', 'Workers whose circuit breaker for the model is open or half-open', MODEL_LABELS)
+BREAKER_OPENED = REGISTRY.counter(
+    'everyai_model_breaker_opened_total', 'Times a model was cut off after repeated failures', MODEL_LABELS)
+MODEL_SKIPPED = REGISTRY.counter(
+    'everyai_model_skipped_total', 'Model calls not made because the model was unavailable', MODEL_LABELS)
+STREAMS_ACTIVE = REGISTRY.gauge('everyai_sse_streams_active', 'Open SSE connections')
+ASYNC_FANOUTS_ACTIVE = REGISTRY.gauge(
+    'everyai_async_fanouts_in_flight', 'All-models fan-outs running on the asyncio engine (asgi.py)')
+STREAMS = REGISTRY.counter('everyai_sse_streams_total', 'SSE connections opened')
+STREAM_DURATION = REGISTRY.histogram(
+    'everyai_sse_stream_duration_seconds', 'How long SSE connections stayed open', (), STREAM_BUCKETS)
+
+
+def model_started(model_id, provider):
+    REGISTRY.ensure_flusher()
+    MODEL_IN_FLIGHT.inc((model_id, provider))
+
+
+def model_finished(model_id, provider, status, call):
+    labels = (model_id, provider)
+    MODEL_IN_FLIGHT.dec(labels)
+    MODEL_CALLS.inc(labels + (status,))
+    if call.cache_status == 'hit':
+        MODEL_CACHE_HITS.inc(labels)
+        return
+    if call.cache_status is None:
+        # Never got as far as the cache, let alone the provider (e.g. no API key saved):
+        # its instant "answer" says nothing about the model's latency
+        return
+    # Queueing and rate limit waits have their own histograms (MODEL_QUEUE_WAIT and
+    # THROTTLE_WAIT), so neither is blamed on the model
+    running = call.running_seconds()
+    MODEL_QUEUE_WAIT.observe(labels, call.queued_seconds())
+    first_token = call.first_token_seconds()
+    if first_token is not None:
+        MODEL_FIRST_TOKEN.observe(labels, first_token)
+    if status != 'success':
+        return
+    MODEL_LATENCY.observe(labels, max(0.0, running - call.throttle_seconds))
+    if call.output_tokens:
+        MODEL_TOKENS.inc(labels, call.output_tokens)
+        generating = running - (first_token or 0)
+        if generating > 0:
+            MODEL_TOKENS_PER_SECOND.observe(labels, call.output_tokens / generating)
+
+
+def model_skipped(model_id, provider):
+    MODEL_SKIPPED.inc((model_id, provider))
+
+
+def breaker_opened(model_id, provider):
+    REGISTRY.ensure_flusher()
+    BREAKER_OPENED.inc((model_id, provider))
+    BREAKERS_OPEN.set((model_id, provider), 1)
+
+
+def breaker_closed(model_id, provider):
+    BREAKERS_OPEN.set((model_id, provider), 0)
+
+
+def rate_limited(provider):
+    RATE_LIMITED.inc((provider,))
+
+
+def retry_scheduled(provider, status):
+    RETRIES.inc((provider, str(status)))
+
+
+def throttle_waited(provider, reason, seconds):
+    THROTTLE_WAIT.observe((provider, reason), seconds)
+
+
+def throttle_rejected(provider):
+    THROTTLE_REJECTED.inc((provider,))
+
+
+def stream_opened():
+    REGISTRY.ensure_flusher()
+    STREAMS.inc()
+    STREAMS_ACTIVE.inc()
+    return time.monotonic()
+
+
+def async_fanout_started():
+    REGISTRY.ensure_flusher()
+    ASYNC_FANOUTS_ACTIVE.inc()
+
+
+def async_fanout_finished():
+    ASYNC_FANOUTS_ACTIVE.dec()
+
+
+def stream_closed(opened_at):
+    STREAMS_ACTIVE.dec()
+    STREAM_DURATION.observe((), time.monotonic() - opened_at)
+
+
+def tracked_stream(events):
+    # Wraps an SSE generator so the connection shows up in the stream metrics
+    opened_at = stream_opened()
+    try:
+        yield from events
+    finally:
+        stream_closed(opened_at)
@@ -0,0 +1,135 @@
+import os
+
+# Every model the web app and rawcode.py offer, in display order. This module is pure
+# data: the provider SDKs are only imported by ai_models.py when a model that needs one
+# is first called, so importing the registry costs nothing.
+
+# Overridable so the app can be pointed at local stand-ins (see bench/)
+GITHUB_MODELS_ENDPOINT = os.getenv('GITHUB_MODELS_ENDPOINT', "https://models.github.ai/inference")
+AZURE_INFERENCE_ENDPOINT = os.getenv('AZURE_INFERENCE_ENDPOINT', "https://models.inference.ai.azure.com")
+NVIDIA_ENDPOINT = os.getenv('NVIDIA_ENDPOINT', "https://integrate.api.nvidia.com/v1")
+
+# Which client library speaks to the model
+SDK_OPENAI = 'openai'
+SDK_AZURE = 'azure'
+SDK_MISTRAL = 'mistral'
+
+# Whose capacity (and rate limits) a call counts against
+PROVIDER_GITHUB = 'github'
+PROVIDER_AZURE = 'azure'
+PROVIDER_NVIDIA = 'nvidia'
+
+SYSTEM_PROMPT = "You are a helpful assistant."
+
+# For each model: display name, provider, SDK and endpoint, model name, which key it
+# uses, the system prompt role (None for models that only get the user message), the
+# context window in tokens (bounds how much conversation history is sent) and the
+# sampling parameters
+MODEL_SPECS = {
+    'gpt41': {
+        'name': 'GPT-4.1',
+        'provider': PROVIDER_GITHUB,
+        'sdk': SDK_OPENAI,
+        'endpoint': GITHUB_MODELS_ENDPOINT,
+        'model_name': "openai/gpt-4.1",
+        'key': 'github_token',
+        'system_role': "system",
+        'context_tokens': 1047576,
+        'params': {'temperature': 1.0, 'top_p': 1.0, 'max_tokens': 1024},
+    },
+    'o3': {
+        'name': 'O3',
+        'provider': PROVIDER_GITHUB,
+        'sdk': SDK_OPENAI,
+        'endpoint': GITHUB_MODELS_ENDPOINT,
+        'model_name': "openai/o3",
+        'key': 'github_token',
+        'system_role': "developer",
+        'context_tokens': 200000,
+        'params': {},
+    },
+    'o4preview': {
+        'name': 'O4-Mini (Preview)',
+        'provider': PROVIDER_GITHUB,
+        'sdk': SDK_OPENAI,
+        'endpoint': GITHUB_MODELS_ENDPOINT,
+        'model_name': "openai/o4-mini",
+        'key': 'github_token',
+        'system_role': "developer",
+        'context_tokens': 200000,
+        'params': {},
+    },
+    'phi4': {
+        'name': 'Phi-4',
+        'provider': PROVIDER_AZURE,
+        'sdk': SDK_AZURE,
+        'endpoint': AZURE_INFERENCE_ENDPOINT,
+        'model_name': "Phi-4",
+        'key': 'github_token',
+        'system_role': None,
+        'context_tokens': 16384,
+        'params': {'temperature': 0.7, 'top_p': 0.8, 'max_tokens': 1024},
+    },
+    'deepseekv30324': {
+        'name': 'DeepSeek-V3-0324',
+        'provider': PROVIDER_GITHUB,
+        'sdk': SDK_AZURE,
+        'endpoint': GITHUB_MODELS_ENDPOINT,
+        'model_name': "deepseek/DeepSeek-V3-0324",
+        'key': 'github_token',
+        'system_role': "system",
+        'context_tokens': 128000,
+        'params': {'temperature': 1.0, 'top_p': 1.0, 'max_tokens': 1000},
+    },
+    'metallama': {
+        'name': 'Meta Llama-3.2-90B',
+        'provider': PROVIDER_AZURE,
+        'sdk': SDK_AZURE,
+        'endpoint': AZURE_INFERENCE_ENDPOINT,
+        'model_name': "Llama-3.2-90B-Vision-Instruct",
+        'key': 'github_token',
+        'system_role': "system",
+        'context_tokens': 128000,
+        'params': {'temperature': 0.7, 'top_p': 0.8, 'max_tokens': 1024},
+    },
+    'mistral': {
+        'name': 'Mistral-Large',
+        'provider': PROVIDER_AZURE,
+        'sdk': SDK_MISTRAL,
+        'endpoint': AZURE_INFERENCE_ENDPOINT,
+        'model_name': "Mistral-Large-2411",
+        'key': 'github_token',
+        'system_role': "system",
+        'context_tokens': 128000,
+        'params': {'temperature': 0.7, 'top_p': 0.8, 'max_tokens': 1024},
+    },
+    'nemotron': {
+        'name': 'Nvidia Nemotron-70B',
+        'provider': PROVIDER_NVIDIA,
+        'sdk': SDK_OPENAI,
+        'endpoint': NVIDIA_ENDPOINT,
+        'model_name': "nvidia/llama-3.1-nemotron-70b-instruct",
+        'key': 'nvidia_key',
+        'system_role': None,
+        'context_tokens': 128000,
+        'params': {'temperature': 0.7, 'top_p': 0.8, 'max_tokens': 1024},
+        # The web app has always shown Nvidia failures with this prefix (see error_message)
+        'error_prefix': "Error with Nvidia API",
+    },
+}
+
+MODEL_NAMES = {model_id: spec['name'] for model_id, spec in MODEL_SPECS.items()}
+MODEL_PROVIDERS = {model_id: spec['provider'] for model_id, spec in MODEL_SPECS.items()}
+
+
+def api_key_for(model_id, api_keys):
+    return api_keys.get(MODEL_SPECS[model_id]['key'], '')
+
+
+def error_message(model_id, error, with_type=False):
+    # What the user sees for a failed call. The call itself still fails (so breakers,
+    # metrics and latency see an error); only the text carries the model's error_prefix.
+    prefix = MODEL_SPECS[model_id].get('error_prefix')
+    if prefix:
+        return f"{prefix}: {error}"
+    return f"{type(error).__name__}: {error}" if with_type else str(error)
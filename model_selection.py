@@ -0,0 +1,93 @@
+import json
+
+from breakers import BREAKERS
+from latency import LATENCY, MODEL_TIMEOUT_SECONDS
+from model_registry import MODEL_NAMES, api_key_for
+from usage import USAGE, USAGE_DEPRIORITIZE_AT
+
+# Choosing which models an "all models" request fans out to. Besides an explicit list,
+# fastest_k picks the k models expected to answer soonest and latency_budget the models
+# whose recent p95 fits the budget. Expectations come from each model's recent
+# successful calls (latency.py) and how many of its recent calls failed (breakers.py);
+# a model that fails half the time is expected to take twice as long to give an answer.
+# Models without history rank after every model that has some.
+
+# Never treat a model as more than 20x slower for failing, or it could not recover its rank
+MIN_SUCCESS_RATE = 0.05
+
+
+def parse_model_list(value):
+    # "gpt41,o3" or ["gpt41", "o3"]; None when not given, ValueError for unknown ids
+    if value is None or value == '' or value == []:
+        return None
+    if isinstance(value, str):
+        value = value.strip()
+        value = json.loads(value) if value.startswith('[') else value.split(',')
+    model_ids = [str(model_id).strip() for model_id in value if str(model_id).strip()]
+    unknown = [model_id for model_id in model_ids if model_id not in MODEL_NAMES]
+    if unknown:
+        raise ValueError(f"unknown model(s): {', '.join(unknown)}")
+    # Keep the registry's order and drop duplicates
+    return [model_id for model_id in MODEL_NAMES if model_id in model_ids]
+
+
+def parse_fastest_k(value):
+    if value is None or value == '':
+        return None
+    fastest_k = int(value)
+    if fastest_k < 1:
+        raise ValueError('fastest_k must be at least 1')
+    return fastest_k
+
+
+def parse_latency_budget(value):
+    if value is None or value == '':
+        return None
+    budget = float(value)
+    if not budget > 0:
+        raise ValueError('latency_budget must be a positive number of seconds')
+    return budget
+
+
+def outlook(model_id):
+    # What to expect from a model right now; the sidebar shows expected_seconds
+    summary = LATENCY.summary(model_id)
+    failure_rate = BREAKERS.recent_failure_rate(model_id)
+    success_rate = 1 - failure_rate if failure_rate is not None else None
+    expected = summary['p50_seconds']
+    return {
+        'name': MODEL_NAMES[model_id],
+        'available': BREAKERS.available(model_id),
+        'samples': summary['samples'],
+        'expected_seconds': expected,
+        'p95_seconds': summary['p95_seconds'],
+        'first_token_seconds': summary['first_token_p50_seconds'],
+        'success_rate': round(success_rate, 3) if success_rate is not None else None,
+        # Expected time to a successful answer, what fastest_k ranks by
+        'score': round(expected / max(MIN_SUCCESS_RATE, success_rate if success_rate is not None else 1.0), 3)
+        if expected is not None else None,
+    }
+
+
+def select_models(model_ids=None, fastest_k=None, latency_budget=None, api_keys=None):
+    # Available models to fan out to, in registry order; the filters narrow each other.
+    # With api_keys, models whose key is out of quota are left out as well, and models
+    # close to their quota are the last picked by fastest_k.
+    candidates = [model_id for model_id in (model_ids or MODEL_NAMES) if BREAKERS.available(model_id)]
+    pressure = {}
+    if api_keys is not None:
+        candidates = [model_id for model_id in candidates
+                      if USAGE.quota_wait(model_id, api_key_for(model_id, api_keys)) is None]
+        pressure = {model_id: USAGE.pressure(model_id, api_key_for(model_id, api_keys)) for model_id in candidates}
+    outlooks = {model_id: outlook(model_id) for model_id in candidates}
+    if latency_budget is not None:
+        # Without history a model gets MODEL_TIMEOUT_SECONDS, so only a generous budget fits it
+        candidates = [model_id for model_id in candidates
+                      if (outlooks[model_id]['p95_seconds'] or MODEL_TIMEOUT_SECONDS) <= latency_budget]
+    if fastest_k is not None:
+        ranked = sorted(candidates, key=lambda model_id: (pressure.get(model_id, 0.0) >= USAGE_DEPRIORITIZE_AT,
+                                                         outlooks[model_id]['score'] is None,
+                                                         outlooks[model_id]['score'] or 0))
+        fastest = set(ranked[:fastest_k])
+        candidates = [model_id for model_id in candidates if model_id in fastest]
+    return candidates
@@ -0,0 +1,328 @@
+import os
+import time
+import random
+import asyncio
+import threading
+from email.utils import parsedate_to_datetime
+
+from client_pool import credential_fingerprint
+from metrics import throttle_waited, retry_scheduled, rate_limited, throttle_rejected
+from model_registry import PROVIDER_GITHUB, PROVIDER_AZURE, PROVIDER_NVIDIA
+
+# Client-side rate limiting per (provider, API key). Each pair has a token bucket that
+# learns its rate from the provider's x-ratelimit-* headers; a request that would be
+# rejected waits for its slot instead of being sent, and 429s / overloaded responses
+# are retried with jittered exponential backoff that honours Retry-After. Nothing
+# waits past the call's deadline: if the slot (or the retry) would come too late, the
+# call fails straight away.
+RATE_LIMIT_MAX_RETRIES = int(os.getenv('RATE_LIMIT_MAX_RETRIES', '3'))
+RATE_LIMIT_BACKOFF_SECONDS = float(os.getenv('RATE_LIMIT_BACKOFF_SECONDS', '0.5'))
+RATE_LIMIT_BACKOFF_MAX_SECONDS = float(os.getenv('RATE_LIMIT_BACKOFF_MAX_SECONDS', '20'))
+
+# Requests per minute per key until the provider's headers say otherwise; 0 = no limit
+# until one has been learnt
+RATE_LIMIT_DEFAULT_RPM = {
+    PROVIDER_GITHUB: float(os.getenv('RATE_LIMIT_RPM_GITHUB', '0')),
+    PROVIDER_AZURE: float(os.getenv('RATE_LIMIT_RPM_AZURE', '0')),
+    PROVIDER_NVIDIA: float(os.getenv('RATE_LIMIT_RPM_NVIDIA', '0')),
+}
+
+# Rate limited, or the provider is overloaded; anything else is not worth repeating
+RETRYABLE_STATUSES = (429, 502, 503, 504)
+
+
+class RateLimited(Exception):
+    def __init__(self, provider, wait):
+        super().__init__(f"{provider} rate limit: no capacity before the deadline (next slot in {wait:.1f}s)")
+        self.provider = provider
+        self.wait = wait
+
+
+def parse_duration(value):
+    # Seconds from "30", "1.5", "20ms", "1s" or "6m0s"; None when absent or unreadable
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    total, number = 0.0, ''
+    index = 0
+    while index < len(value):
+        char = value[index]
+        if char.isdigit() or char == '.':
+            number += char
+        elif number:
+            unit = 'ms' if value.startswith('ms', index) else char
+            scale = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}.get(unit)
+            if scale is None:
+                return None
+            total += float(number) * scale
+            number = ''
+            index += len(unit) - 1
+        else:
+            return None
+        index += 1
+    return total if not number else None
+
+
+def retry_after_seconds(headers):
+    # Retry-After-Ms, then Retry-After in seconds or as an HTTP date
+    if not headers:
+        return None
+    milliseconds = parse_duration(headers.get('retry-after-ms'))
+    if milliseconds is not None:
+        return milliseconds / 1000
+    value = headers.get('retry-after')
+    seconds = parse_duration(value)
+    if seconds is not None or value is None:
+        return seconds
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def error_status(error):
+    # HTTP status of an SDK error: openai and mistralai use status_code, azure-core too
+    status = getattr(error, 'status_code', None)
+    if isinstance(status, int):
+        return status
+    response = getattr(error, 'response', None) or getattr(error, 'raw_response', None)
+    status = getattr(response, 'status_code', None)
+    return status if isinstance(status, int) else None
+
+
+def error_headers(error):
+    response = getattr(error, 'response', None) or getattr(error, 'raw_response', None)
+    return getattr(response, 'headers', None) or {}
+
+
+def _number(value):
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class TokenBucket:
+    # tokens may go negative: every reservation takes one, so callers line up behind
+    # each other in time instead of all waking up at the same moment
+    def __init__(self, rate=None, capacity=None):
+        # Tokens per second, None until known
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else (max(1.0, rate * 60) if rate else None)
+        self.tokens = self.capacity or 0.0
+        self.blocked_until = 0.0
+        self.updated_at = time.monotonic()
+        self.waiting = 0
+        self._lock = threading.Lock()
+
+    def _refill_locked(self, now):
+        if self.rate:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def reserve(self, min_wait=0.0, max_wait=None):
+        # Takes a slot and returns (wait, wait) with how long to wait before using it,
+        # or (None, wait) without taking one when the slot is further off than max_wait
+        now = time.monotonic()
+        with self._lock:
+            self._refill_locked(now)
+            wait = max(min_wait, self.blocked_until - now)
+            if self.rate and self.tokens < 1:
+                wait = max(wait, (1 - self.tokens) / self.rate)
+            if max_wait is not None and wait >= max_wait:
+                return None, wait
+            if self.rate:
+                self.tokens -= 1
+            return wait, wait
+
+    def learn(self, status, headers):
+        # Requests-per-window limits: GitHub Models and Azure send the renewal period,
+        # OpenAI-style endpoints the time until the window is full again
+        limit = _number(headers.get('x-ratelimit-limit-requests'))
+        remaining = _number(headers.get('x-ratelimit-remaining-requests'))
+        window = parse_duration(headers.get('x-ratelimit-renewalperiod-requests'))
+        reset = parse_duration(headers.get('x-ratelimit-reset-requests'))
+        retry_after = retry_after_seconds(headers)
+        now = time.monotonic()
+        with self._lock:
+            self._refill_locked(now)
+            known = self.rate is not None
+            if limit and window:
+                self.rate, self.capacity = limit / window, limit
+            elif limit and reset and remaining is not None and limit > remaining:
+                # What has been used comes back by the reset time
+                self.rate, self.capacity = (limit - remaining) / max(reset, 0.001), limit
+            if self.rate and not known:
+                # First limit learnt: start from what the provider says is left
+                self.tokens = remaining if remaining is not None else self.capacity
+            elif self.rate and remaining is not None:
+                self.tokens = min(self.tokens, remaining)
+            if remaining == 0 and reset:
+                self.blocked_until = max(self.blocked_until, now + reset)
+            if status == 429:
+                self.blocked_until = max(self.blocked_until, now + (retry_after or reset or 0))
+                if self.rate:
+                    self.tokens = min(self.tokens, 0.0)
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            self._refill_locked(now)
+            return {
+                'requests_per_minute': round(self.rate * 60, 2) if self.rate else None,
+                'capacity': self.capacity,
+                'tokens': round(self.tokens, 2) if self.rate else None,
+                'blocked_for_seconds': round(max(0.0, self.blocked_until - now), 3),
+                'waiting': self.waiting,
+            }
+
+
+class RateLimiter:
+    def __init__(self, default_rpm=None, max_retries=RATE_LIMIT_MAX_RETRIES,
+                 backoff=RATE_LIMIT_BACKOFF_SECONDS, backoff_max=RATE_LIMIT_BACKOFF_MAX_SECONDS):
+        self.default_rpm = dict(default_rpm if default_rpm is not None else RATE_LIMIT_DEFAULT_RPM)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self._lock = threading.Lock()
+        # (provider, credential fingerprint) -> TokenBucket
+        self._buckets = {}
+        self.retries = 0
+        self.rejected = 0
+
+    def bucket(self, provider, credential):
+        key = (provider, credential_fingerprint(credential))
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                rpm = self.default_rpm.get(provider) or 0
+                bucket = self._buckets[key] = TokenBucket(rpm / 60 if rpm else None)
+            return bucket
+
+    def observe(self, provider, credential, status, headers):
+        # Called with every provider response (see the client hooks in ai_models.py)
+        if status == 429:
+            rate_limited(provider)
+        self.bucket(provider, credential).learn(status, headers)
+
+    def _backoff(self, attempt, retry_after):
+        # Equal jitter: half the exponential step is fixed, the other half random, so
+        # retries from a burst spread out. Retry-After is a floor, with jitter on top so
+        # everything told to come back at the same moment does not.
+        step = min(self.backoff_max, self.backoff * (2 ** attempt))
+        jitter = random.uniform(0, step / 2)
+        if retry_after is not None:
+            return max(step / 2, retry_after) + jitter
+        return step / 2 + jitter
+
+    def _retry_delay(self, provider, error, call, attempt):
+        status = error_status(error)
+        if status not in RETRYABLE_STATUSES or attempt >= self.max_retries:
+            return None
+        # Text has already reached the user; a retry would repeat it
+        if call is not None and call.first_delta_at is not None:
+            return None
+        delay = self._backoff(attempt, retry_after_seconds(error_headers(error)))
+        remaining = call.remaining() if call is not None else None
+        if remaining is not None and delay >= remaining:
+            # The retry could not finish in time; the provider's error is the answer
+            return None
+        return status, delay
+
+    def _reserve(self, provider, bucket, call, min_wait):
+        remaining = call.remaining() if call is not None else None
+        wait, needed = bucket.reserve(min_wait, remaining)
+        if wait is None:
+            with self._lock:
+                self.rejected += 1
+            throttle_rejected(provider)
+            raise RateLimited(provider, needed)
+        return wait
+
+    def _report(self, provider, call, wait, reason, attempt, status=None):
+        throttle_waited(provider, reason, wait)
+        if call is not None:
+            call.throttled(wait, reason, attempt, status)
+
+    def call(self, provider, credential, fn, call=None):
+        bucket = self.bucket(provider, credential)
+        attempt, min_wait, reason, status = 0, 0.0, 'queued', None
+        while True:
+            wait = self._reserve(provider, bucket, call, min_wait)
+            if wait > 0:
+                self._report(provider, call, wait, reason, attempt, status)
+                self._sleep(bucket, wait, call)
+            try:
+                return fn()
+            except Exception as e:
+                retry = self._retry_delay(provider, e, call, attempt)
+                if retry is None:
+                    raise
+                status, min_wait = retry
+            attempt += 1
+            reason = 'retry'
+            self._count_retry(provider, status)
+
+    async def call_async(self, provider, credential, fn, call=None):
+        bucket = self.bucket(provider, credential)
+        attempt, min_wait, reason, status = 0, 0.0, 'queued', None
+        while True:
+            wait = self._reserve(provider, bucket, call, min_wait)
+            if wait > 0:
+                self._report(provider, call, wait, reason, attempt, status)
+                with self._lock:
+                    bucket.waiting += 1
+                try:
+                    # Cancelling the task (see complete_async) ends the wait
+                    await asyncio.sleep(wait)
+                finally:
+                    with self._lock:
+                        bucket.waiting -= 1
+            try:
+                return await fn()
+            except Exception as e:
+                retry = self._retry_delay(provider, e, call, attempt)
+                if retry is None:
+                    raise
+                status, min_wait = retry
+            attempt += 1
+            reason = 'retry'
+            self._count_retry(provider, status)
+
+    def _count_retry(self, provider, status):
+        with self._lock:
+            self.retries += 1
+        retry_scheduled(provider, status)
+
+    def _sleep(self, bucket, wait, call):
+        with self._lock:
+            bucket.waiting += 1
+        try:
+            if call is None:
+                time.sleep(wait)
+                return
+            # Cancelling the call wakes the wait up
+            woken = threading.Event()
+            with call.attach(woken.set):
+                woken.wait(wait)
+            call.check()
+        finally:
+            with self._lock:
+                bucket.waiting -= 1
+
+    def stats(self):
+        with self._lock:
+            buckets = list(self._buckets.items())
+            totals = {'retries': self.retries, 'rejected': self.rejected}
+        return dict(totals, buckets=[
+            dict(bucket.stats(), provider=provider, credential=fingerprint)
+            for (provider, fingerprint), bucket in buckets
+        ])
+
+
+# Shared by every request handled by this process
+RATE_LIMITS = RateLimiter()
@@ -1,242 +1,388 @@
 import os
+import sys
+import json
+import time
+import argparse
+import threading
 from dotenv import load_dotenv
-from openai import OpenAI
-from azure.ai.inference import ChatCompletionsClient
-from azure.ai.inference.models import SystemMessage, UserMessage
-from azure.core.credentials import AzureKeyCredential
-from mistralai import Mistral, UserMessage, SystemMessage
 import concurrent.futures
 
-# Load environment variables
+# Load environment variables (before the registry reads its endpoint overrides)
 load_dotenv()
 token = os.getenv('GIT_HUB_TOKEN')
 nvkey = os.getenv('NVIDIA_KEY')
 
-def openAIo3mini(prompt):
-    endpoint = "https://models.inference.ai.azure.com"
-    model_name = "o3-mini"
-
-    client = OpenAI(
-        base_url=endpoint,
-        api_key=token,
-    )
-
-    response = client.chat.completions.create(
-        messages=[
-            {
-                "role": "developer",
-                "content": "You are a helpful assistant.",
-            },
-            {
-                "role": "user",
-                "content": prompt,
-            }
-        ],
-        model=model_name
-    )    
-    return response.choices[0].message.content
-
-def openAIo1preview(prompt):
-    endpoint = "https://models.inference.ai.azure.com"
-    model_name = "o1-preview"
-
-    client = OpenAI(
-        base_url=endpoint,
-        api_key=token,
-    )
-
-    response = client.chat.completions.create(
-        messages=[
-            {
-                "role": "user",
-                "content": prompt,
-            }
-        ],
-        model=model_name
-    )
-
-    return response.choices[0].message.content
-
-
-def chatgpt4o(prompt):
-    endpoint = "https://models.inference.ai.azure.com"
-    model_name = "gpt-4o"
-
-    client = OpenAI(
-        base_url=endpoint,
-        api_key=token,
-    )
-
-    response = client.chat.completions.create(
-        messages=[
-            {
-                "role": "system",
-                "content": "You are a helpful assistant.",
-            },
-            {
-                "role": "user",
-                "content": prompt,
-            }
-        ],
-        temperature=0.7, #balanced mode. lower values give more factual responses, higher give more creative responses
-        top_p=0.8, #to control randomness. lower values give less random responses
-        max_tokens=1024, #optimal response length. increase or decrease depending on need [ and your quota limit :( ]
-        model=model_name
-    )
-
-    return response.choices[0].message.content
-
-def phi4(prompt):
-    endpoint = "https://models.inference.ai.azure.com"
-    model_name = "Phi-4"
-        
-    client = ChatCompletionsClient(
-    endpoint=endpoint,
-    credential=AzureKeyCredential(token),
-    )
-
-    response = client.complete(
-    messages=[
-            {"role": "user", "content": prompt}
-        ],
-        temperature=0.7, #balanced mode. lower values give more factual responses, higher give more creative responses
-        top_p=0.8, #to control randomness. lower values give less random responses
-        max_tokens=1024, #optimal response length. increase or decrease depending on need [ and your quota limit :( ]
-        model=model_name
-    )
-
-    return response.choices[0].message.content
-
-def deepseekv3(prompt):
-    endpoint = "https://models.inference.ai.azure.com"
-    model_name = "DeepSeek-V3"
-    client = ChatCompletionsClient(
-    endpoint=endpoint,
-    credential=AzureKeyCredential(token),
-    )
-
-    response = client.complete(
-        messages=[
-            {"role": "user", "content": prompt}
-        ],
-        max_tokens=1024,
-        model=model_name
-    )
-
-    return response.choices[0].message.content
-
-def metallama(prompt):
-    endpoint = "https://models.inference.ai.azure.com"
-    model_name = "Llama-3.2-90B-Vision-Instruct"
-    client = ChatCompletionsClient(
-    endpoint=endpoint,
-    credential=AzureKeyCredential(token),
-    )
-
-    response = client.complete(
-        messages=[
-            {"role": "system", "content": "You are a helpful assistant."},
-            {"role": "user", "content": prompt}
-        ],
-        temperature=0.7, #balanced mode. lower values give more factual responses, higher give more creative responses
-        top_p=0.8, #to control randomness. lower values give less random responses
-        max_tokens=1024, #optimal response length. increase or decrease depending on need [ and your quota limit :( ]
-        model=model_name
-    )
-
-    return response.choices[0].message.content
-
-def mistral(prompt):
-    endpoint = "https://models.inference.ai.azure.com"
-    model_name = "Mistral-Large-2411"
-
-    client = Mistral(api_key=token, server_url=endpoint)
-
-    response = client.chat.complete(
-    model=model_name,
-    messages=[
-        SystemMessage(content="You are a helpful assistant."),
-        UserMessage(content=prompt),
-    ],
-    temperature=0.7, #balanced mode. lower values give more factual responses, higher give more creative responses
-    top_p=0.8, #to control randomness. lower values give less random responses
-    max_tokens=1024, #optimal response length. increase or decrease depending on need [ and your quota limit :( ]
-    )
-
-    return response.choices[0].message.content
-
-#claude was meant to go here but API isn't free :(
-
-def nvidia_nemotron(prompt):
-    client = OpenAI(
-        base_url="https://integrate.api.nvidia.com/v1",
-        api_key=nvkey
-    )
-
-    completion = client.chat.completions.create(
-        model="nvidia/llama-3.1-nemotron-70b-instruct",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.7,
-        top_p=0.8,
-        max_tokens=1024,
-        stream=True  # Streaming enabled
-    )
-
-    full_response = ""  # Store the full output
-    for chunk in completion:
-        if chunk.choices[0].delta.content is not None:
-            full_response += chunk.choices[0].delta.content
-
-    return full_response
-
-
-def main():
+from ai_models import create_model_function
+from archive import ARCHIVE
+from call_context import CallContext
+from cancellation import Cancelled
+from dispatcher import Dispatcher, PROVIDER_CONCURRENCY
+from latency import LATENCY, percentile, parse_deadline, cancel_if_silent, watch_first_token
+from model_registry import (MODEL_SPECS, MODEL_NAMES, PROVIDER_GITHUB, PROVIDER_AZURE, PROVIDER_NVIDIA, api_key_for,
+                            error_message)
+from runs import TIMER
+from terminal_view import LiveView
+
+API_KEYS = {'github_token': token or '', 'nvidia_key': nvkey or ''}
+
+PROVIDER_LABELS = {
+    PROVIDER_GITHUB: 'GitHub Models',
+    PROVIDER_AZURE: 'Azure',
+    PROVIDER_NVIDIA: 'Nvidia API',
+}
+
+def get_model_function(model_id):
+    # Same models, endpoints and response cache as the web app
+    return create_model_function(model_id, api_key_for(model_id, API_KEYS))
+
+def archive(prompt, model_id, call, status, response=None, error=None):
+    # Into the same local archive as the web app's answers (see archive.py)
+    ARCHIVE.record(prompt, model_id, status, response, error, time.monotonic() - call.started_at,
+                   call.output_tokens, call.cache_status == 'hit', 'cli')
+
+def ask(model_id, prompt, call, view):
+    # Streams one model's answer into the view and archives it; never raises
+    status, response, error = 'error', None, None
+    try:
+        response = get_model_function(model_id)(prompt, call)
+        status = 'success'
+    except Cancelled:
+        status = 'cancelled'
+    except Exception as e:
+        error = error_message(model_id, e, with_type=True)
+    view.finish(model_id, call, response, error, 'cancelled' if status == 'cancelled' else None)
+    archive(prompt, model_id, call, status, response, error)
+
+def run_live(prompt, model_ids, mode=None):
+    # Every model at once, each token shown the moment it arrives (see terminal_view.py)
+    view = LiveView(model_ids, 'plain' if len(model_ids) == 1 else mode)
+    calls = {model_id: CallContext(on_delta=lambda text, model_id=model_id: view.delta(model_id, text))
+             for model_id in model_ids}
+    view.start()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(model_ids)) as executor:
+            futures = [executor.submit(ask, model_id, prompt, calls[model_id], view) for model_id in model_ids]
+            try:
+                concurrent.futures.wait(futures)
+            except KeyboardInterrupt:
+                # Abort the requests still streaming; what arrived so far stays on screen
+                for call in calls.values():
+                    call.cancel()
+                concurrent.futures.wait(futures)
+    finally:
+        view.close()
+
+def interactive(view=None):
     prompt = input("Enter the prompt: ")
     print("\nAvailable Models:")
-    print("[1] GPT-4o (OpenAI)")
-    print("[2] O3-Mini (Azure)")
-    print("[3] O1-Preview (Azure)")
-    print("[4] Phi-4 (Azure)")
-    print("[5] DeepSeek-V3 (Azure)")
-    print("[6] Meta Llama-3.2-90B (Azure)")
-    print("[7] Mistral-Large (Azure)")
-    print("[8] Nvidia Nemotron-70B (Nvidia API)")
-    print("[9] Run ALL models in parallel")
-
-    choice = int(input("\nChoose an option (1-9): "))
-
-    models = {
-        1: chatgpt4o,
-        2: openAIo3mini,
-        3: openAIo1preview,
-        4: phi4,
-        5: deepseekv3,
-        6: metallama,
-        7: mistral,
-        8: nvidia_nemotron
-    }
+    models = dict(enumerate(MODEL_SPECS, 1))
+    for number, model_id in models.items():
+        print(f"[{number}] {MODEL_NAMES[model_id]} ({PROVIDER_LABELS[MODEL_SPECS[model_id]['provider']]})")
+    all_option = len(models) + 1
+    print(f"[{all_option}] Run ALL models in parallel")
+
+    choice = int(input(f"\nChoose an option (1-{all_option}): "))
 
     if choice in models:
+        model_id = models[choice]
         print("\n" + "="*80)
-        print(f"\n🔹 Response from {models[choice].__name__}:\n")
-        print(models[choice](prompt))
+        print(f"\n🔹 Response from {MODEL_NAMES[model_id]}:\n")
+        run_live(prompt, [model_id])
         print("\n" + "="*80)
-    
-    elif choice == 9:
+
+    elif choice == all_option:
         print("\n🔹 Running all models in parallel...\n" + "="*80 + "\n")
+        run_live(prompt, list(models.values()), view)
+
+# Batch mode: every prompt in a file against every chosen model, one JSONL record per
+# answer written as soon as it arrives. Calls go through a Dispatcher like the web app's,
+# so both the total and each provider's concurrency are capped.
+#
+#   python rawcode.py --batch prompts.jsonl --out results.jsonl
+#   python rawcode.py --batch prompts.txt --models gpt41,o3 --concurrency 16 --provider-concurrency nvidia=2
+#   cat prompts.txt | python rawcode.py --batch - --out results.jsonl
+#
+# Run the same command again to resume: prompt/model pairs already in the output are skipped.
+
+def read_prompts(path):
+    # JSONL lines ({"id": ..., "prompt": ...}) or plain text, one prompt per line;
+    # prompts without an id are numbered by line
+    source = sys.stdin if path == '-' else open(path, encoding='utf-8')
+    prompts, seen = [], set()
+    try:
+        for number, line in enumerate(source, 1):
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('{'):
+                record = json.loads(line)
+                prompt_id, prompt = str(record.get('id', number)), record['prompt']
+            else:
+                prompt_id, prompt = str(number), line
+            if prompt_id in seen:
+                raise ValueError(f"duplicate prompt id {prompt_id!r} on line {number}")
+            seen.add(prompt_id)
+            prompts.append((prompt_id, prompt))
+    finally:
+        if source is not sys.stdin:
+            source.close()
+    return prompts
+
+def load_done(path, retry_errors=False):
+    # (prompt id, model id) pairs already in the output; a line cut short by a kill is ignored
+    done = set()
+    if path == '-' or not os.path.exists(path):
+        return done
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if retry_errors and record.get('status') != 'success':
+                continue
+            done.add((record['id'], record['model']))
+    return done
+
+def _open_output(path):
+    if path == '-':
+        return sys.stdout
+    # A run killed mid-write leaves a partial last line; start on a fresh one
+    needs_newline = False
+    if os.path.exists(path) and os.path.getsize(path):
+        with open(path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            needs_newline = f.read(1) != b'\n'
+    out = open(path, 'a', encoding='utf-8')
+    if needs_newline:
+        out.write('\n')
+    return out
+
+def _run_one(model_id, model_function, prompt_id, prompt, use_cache, deadline=None, calls=None):
+    # Never raises: failures are records too. Each call gets a latency budget as in the
+    # web app (learnt from the batch's own calls, capped by --deadline), so a provider
+    # that hangs costs one deadline instead of the whole run. calls: the set of calls in
+    # flight, for Ctrl-C to abort.
+    budget = LATENCY.budget(model_id, deadline)
+    # Streamed (deltas discarded) so a deadline or Ctrl-C can abort it mid-answer
+    call = CallContext(on_delta=lambda text: None, use_cache=use_cache, deadline=budget['total'])
+    call.mark_running()
+    watch = watch_first_token(call, budget, lambda: cancel_if_silent(call))
+    timeout = TIMER.call_later(budget['total'], lambda: call.cancel('timed out'))
+    if calls is not None:
+        calls.add(call)
+    record = {'id': prompt_id, 'model': model_id, 'model_name': MODEL_NAMES[model_id]}
+    try:
+        response = model_function(prompt, call)
+        record.update(status='success', response=response)
+    except Cancelled as e:
+        if e.reason != 'timed out':
+            record.update(status='cancelled', error='Operation cancelled')
+        elif call.first_delta_at is None:
+            record.update(status='timeout', error=f"Model sent no response within {budget['first_token']:g} seconds")
+        else:
+            record.update(status='timeout', error=f"Model response timed out after {budget['total']:g} seconds")
+    except Exception as e:
+        record.update(status='error', error=error_message(model_id, e, with_type=True))
+    finally:
+        TIMER.cancel(watch[0])
+        TIMER.cancel(timeout)
+        if calls is not None:
+            calls.discard(call)
+    if record['status'] == 'success' and call.cache_status in ('miss', 'bypass'):
+        # Later calls of the batch get budgets from how this model has been doing
+        first_token = call.first_token_seconds()
+        LATENCY.record(model_id, time.monotonic() - call.started_at - call.throttle_seconds,
+                       first_token - call.throttle_seconds if first_token is not None else None)
+    archive(prompt, model_id, call, record['status'], record.get('response'), record.get('error'))
+    record['latency_seconds'] = round(time.monotonic() - call.started_at, 3)
+    record['output_tokens'] = call.output_tokens
+    record['cached'] = call.cache_status == 'hit'
+    return record
+
+def batch_report(records, wall_seconds):
+    ok = [r for r in records if r['status'] == 'success']
+    tokens = sum(r['output_tokens'] or 0 for r in ok)
+    lines = [f"{len(records)} calls in {wall_seconds:.1f}s: {len(records) / max(wall_seconds, 1e-9):.2f} calls/s, "
+             f"{len(ok)} succeeded, {tokens / max(wall_seconds, 1e-9):.1f} output tokens/s"]
+    by_model = {}
+    for record in records:
+        by_model.setdefault(record['model'], []).append(record)
+    lines.append(f"{'model':28} {'ok':>5} {'errors':>6} {'p50 s':>8} {'p95 s':>8} {'max s':>8} {'tokens':>8}")
+    column = lambda value: f"{value:8.2f}" if value is not None else f"{'-':>8}"
+    for model_id, model_records in by_model.items():
+        latencies = [r['latency_seconds'] for r in model_records if r['status'] == 'success']
+        p50, p95, slowest = (percentile(latencies, 50), percentile(latencies, 95), max(latencies)) if latencies \
+            else (None, None, None)
+        model_tokens = sum(r['output_tokens'] or 0 for r in model_records)
+        lines.append(f"{MODEL_NAMES[model_id]:28} {len(latencies):5} {len(model_records) - len(latencies):6} "
+                     f"{column(p50)} {column(p95)} {column(slowest)} {model_tokens:8}")
+    return '\n'.join(lines)
+
+def run_batch(args):
+    prompts = read_prompts(args.batch)
+    model_ids = args.models.split(',') if args.models else list(MODEL_SPECS)
+    unknown = [model_id for model_id in model_ids if model_id not in MODEL_SPECS]
+    if unknown:
+        sys.exit(f"Unknown model(s): {', '.join(unknown)}")
+    missing = [model_id for model_id in model_ids if not api_key_for(model_id, API_KEYS)]
+    if missing:
+        print(f"Skipping models without an API key: {', '.join(missing)}", file=sys.stderr)
+        model_ids = [model_id for model_id in model_ids if model_id not in missing]
+
+    limits = dict(PROVIDER_CONCURRENCY)
+    for limit in args.provider_concurrency:
+        provider, _, value = limit.partition('=')
+        if provider not in PROVIDER_LABELS or not value.isdigit() or int(value) < 1:
+            sys.exit(f"--provider-concurrency expects PROVIDER=N with a provider among {', '.join(PROVIDER_LABELS)}")
+        limits[provider] = int(value)
+    dispatcher = Dispatcher(workers=args.concurrency, provider_limits=limits)
+    try:
+        deadline = parse_deadline(args.deadline)
+    except ValueError:
+        sys.exit("--deadline must be a positive number of seconds")
+
+    done = load_done(args.out, args.retry_errors)
+    jobs = {}
+    for prompt_id, prompt in prompts:
+        for model_id in model_ids:
+            if (prompt_id, model_id) not in done:
+                jobs.setdefault(MODEL_SPECS[model_id]['provider'], []).append((prompt_id, prompt, model_id))
+    total = sum(len(provider_jobs) for provider_jobs in jobs.values())
+    print(f"{len(prompts)} prompts x {len(model_ids)} models: {total} calls to make, "
+          f"{len(done)} already in {args.out}", file=sys.stderr)
+
+    functions = {model_id: get_model_function(model_id) for model_id in model_ids}
+    out = _open_output(args.out)
+    write_lock = threading.Lock()
+    records = []
+    remaining = threading.Semaphore(0)
+    # Submitted futures and the calls running, so Ctrl-C can stop them all
+    submit_lock = threading.Lock()
+    futures = []
+    calls = set()
+
+    def write(future, window):
+        if future.cancelled():
+            return
+        record = future.result()
+        with write_lock:
+            if record['status'] == 'cancelled' or out.closed:
+                # Interrupted: left out, so the next run makes this call again
+                return
+            out.write(json.dumps(record, ensure_ascii=False) + '\n')
+            out.flush()
+            records.append(record)
+            if args.progress:
+                print(f"[{len(records)}/{total}] {record['id']} {record['model']} {record['status']} "
+                      f"{record['latency_seconds']:.2f}s", file=sys.stderr)
+        window.release()
+        remaining.release()
+
+    def feed(provider, provider_jobs):
+        # Only as many calls per provider are queued as it may run, so a slow provider
+        # never holds up the others and the queue stays small however long the batch is
+        window = threading.Semaphore(max(1, limits.get(provider, args.concurrency)))
+        for prompt_id, prompt, model_id in provider_jobs:
+            window.acquire()
+            with submit_lock:
+                if stopping.is_set():
+                    return
+                # One round-robin queue per model, so the models take turns
+                future = dispatcher.submit(model_id, provider, _run_one, model_id, functions[model_id],
+                                           prompt_id, prompt, not args.no_cache, deadline, calls)
+                futures.append(future)
+            future.add_done_callback(lambda f: write(f, window))
+
+    stopping = threading.Event()
+    started = time.monotonic()
+    feeders = [threading.Thread(target=feed, args=item, daemon=True) for item in jobs.items()]
+    for feeder in feeders:
+        feeder.start()
+    try:
+        for _ in range(total):
+            remaining.acquire()
+    except KeyboardInterrupt:
+        # What has been written stays written; run again to pick up the rest. Queued
+        # calls are dropped and running ones aborted, and the output is only closed
+        # once they have all ended.
+        with submit_lock:
+            stopping.set()
+            pending = list(futures)
+        for future in pending:
+            future.cancel()
+        for call in list(calls):
+            call.cancel()
+        concurrent.futures.wait(pending)
+        print("\nInterrupted, run the same command again to resume", file=sys.stderr)
+    wall_seconds = time.monotonic() - started
+    with write_lock:
+        if out is not sys.stdout:
+            out.close()
+        print(batch_report(list(records), wall_seconds), file=sys.stderr)
+
+# Earlier answers, from here and from the web app, are kept in the local archive:
+#
+#   python rawcode.py --search "binary search tree" --models gpt41 --limit 5
+#   python rawcode.py --same-prompt "Explain CRDTs in one paragraph"
+
+def run_search(args):
+    # Newest first, one JSON line per archived answer
+    model_ids = args.models.split(',') if args.models else [None]
+    unknown = [model_id for model_id in model_ids if model_id is not None and model_id not in MODEL_SPECS]
+    if unknown:
+        sys.exit(f"Unknown model(s): {', '.join(unknown)}")
+    started = time.monotonic()
+    results = []
+    try:
+        for model_id in model_ids:
+            results += ARCHIVE.search(args.search, args.same_prompt, model_id=model_id, limit=args.limit)
+    except ValueError as e:
+        sys.exit(str(e))
+    results = sorted(results, key=lambda result: result['id'], reverse=True)[:args.limit]
+    elapsed = time.monotonic() - started
+    out = _open_output(args.out)
+    for result in results:
+        out.write(json.dumps(result, ensure_ascii=False) + '\n')
+    if out is not sys.stdout:
+        out.close()
+    print(f"{len(results)} archived answers in {elapsed * 1000:.1f}ms", file=sys.stderr)
 
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            future_to_model = {executor.submit(model, prompt): model.__name__ for model in models.values()}
-
-            for future in concurrent.futures.as_completed(future_to_model):
-                model_name = future_to_model[future]
-                try:
-                    response = future.result()
-                    print(f"\n📌 Response from **{model_name}**:\n")
-                    print(response)
-                    print("\n" + "="*80 + "\n")
-                except Exception as e:
-                    print(f"\n❌ Error in {model_name}: {e}\n" + "="*80 + "\n")
+def main():
+    parser = argparse.ArgumentParser(description='Ask the EveryAI models from the terminal')
+    parser.add_argument('--batch', metavar='FILE', help='prompts to run, JSONL or one per line ("-" for stdin)')
+    parser.add_argument('--out', default='-', help='JSONL file to append results to, also what --batch resumes from')
+    parser.add_argument('--models', help='comma-separated model ids (default: all)')
+    parser.add_argument('--concurrency', type=int, default=8, help='calls in flight at once')
+    parser.add_argument('--provider-concurrency', action='append', default=[], metavar='PROVIDER=N',
+                        help='cap for one provider (github, azure, nvidia); repeatable')
+    parser.add_argument('--deadline', metavar='SECONDS',
+                        help='longest any one --batch call may take (default: learnt from recent calls)')
+    parser.add_argument('--retry-errors', action='store_true', help='when resuming, redo calls that failed')
+    parser.add_argument('--no-cache', action='store_true', help='skip the response cache')
+    parser.add_argument('--progress', action='store_true', help='print a line per finished call')
+    parser.add_argument('--view', choices=('panes', 'lines'),
+                        help='how all models stream at once: a pane each, or interleaved lines '
+                             '(default: panes in a terminal)')
+    parser.add_argument('--search', metavar='WORDS', help='archived answers whose prompt or text has all these words')
+    parser.add_argument('--same-prompt', metavar='PROMPT', help='every archived answer to exactly this prompt')
+    parser.add_argument('--limit', type=int, default=20, help='most archived answers to show')
+    parser.add_argument('--no-archive', action='store_true', help='do not keep the answers in the local archive')
+    args = parser.parse_args()
+
+    if args.no_archive:
+        ARCHIVE.enabled = False
+    if args.search is not None or args.same_prompt is not None:
+        run_search(args)
+        return
+    try:
+        if args.batch:
+            run_batch(args)
+        else:
+            interactive(args.view)
+    finally:
+        # The archive writes in the background; let it finish before exiting
+        ARCHIVE.flush()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,395 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, CancelledError
+
+from cancellation import Cancelled
+
+# Cache in front of the provider calls. Identical requests (same model, system prompt,
+# sampling parameters and prompt) are answered from memory, then from an optional
+# SQLite file, and concurrent identical requests share a single upstream call.
+RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE_ENABLED', 'true').lower() == 'true'
+RESPONSE_CACHE_TTL_SECONDS = float(os.getenv('RESPONSE_CACHE_TTL_SECONDS', '3600'))
+RESPONSE_CACHE_MEMORY_ENTRIES = int(os.getenv('RESPONSE_CACHE_MEMORY_ENTRIES', '512'))
+# Empty disables the on-disk tier
+RESPONSE_CACHE_DB = os.getenv('RESPONSE_CACHE_DB', '')
+RESPONSE_CACHE_DB_MAX_BYTES = int(os.getenv('RESPONSE_CACHE_DB_MAX_BYTES', str(64 * 1024 * 1024)))
+
+
+def cache_key(model_id, spec, system_prompt, prompt, context=None):
+    prompt_hash = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+    material = {
+        'model_id': model_id,
+        'model_name': spec['model_name'],
+        'system_role': spec['system_role'],
+        'system_prompt': system_prompt if spec['system_role'] else None,
+        'params': spec['params'],
+        'prompt': prompt_hash,
+    }
+    if context is not None:
+        # The same prompt later in a conversation is a different request
+        material['history'] = context['key']
+        material['history_tokens'] = context['tokens']
+    material = json.dumps(material, sort_keys=True)
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+
+class MemoryTier:
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # key -> (response, expires_at), least recently used first
+        self._entries = OrderedDict()
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, response, expires_at):
+        with self._lock:
+            self._entries[key] = (response, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DiskTier:
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, '
+            'expires_at REAL NOT NULL, last_access REAL NOT NULL)'
+        )
+        self._db.execute('CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)')
+        self._size = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        self.evictions = 0
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._db.execute('SELECT response, expires_at FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] < now:
+                self._delete_locked(key)
+                return None
+            self._db.execute('UPDATE responses SET last_access = ? WHERE key = ?', (now, key))
+            return row[0], row[1]
+
+    def put(self, key, response, expires_at):
+        size = len(response.encode('utf-8'))
+        now = time.time()
+        with self._lock:
+            self._delete_locked(key)
+            self._db.execute('INSERT INTO responses VALUES (?, ?, ?, ?, ?)', (key, response, size, expires_at, now))
+            self._size += size
+            if self._size > self.max_bytes:
+                self._evict_locked(now)
+
+    def _delete_locked(self, key):
+        row = self._db.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+        if row is not None:
+            self._db.execute('DELETE FROM responses WHERE key = ?', (key,))
+            self._size -= row[0]
+
+    def _evict_locked(self, now):
+        expired = self._db.execute('SELECT COALESCE(SUM(size), 0), COUNT(*) FROM responses WHERE expires_at < ?', (now,)).fetchone()
+        self._db.execute('DELETE FROM responses WHERE expires_at < ?', (now,))
+        self._size -= expired[0]
+        self.evictions += expired[1]
+        # Then least recently used until we are back under 90% of the budget
+        target = self.max_bytes * 0.9
+        while self._size > target:
+            rows = self._db.execute('SELECT key, size FROM responses ORDER BY last_access LIMIT 64').fetchall()
+            if not rows:
+                self._size = 0
+                break
+            for key, size in rows:
+                self._db.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self._size -= size
+                self.evictions += 1
+                if self._size <= target:
+                    break
+
+    def stats(self):
+        with self._lock:
+            count = self._db.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+        return {'path': self.path, 'entries': count, 'bytes': self._size, 'max_bytes': self.max_bytes, 'evictions': self.evictions}
+
+
+class _Flight:
+    # One upstream call that identical concurrent requests wait on
+    def __init__(self):
+        self.future = Future()
+        # Running futures cannot be cancelled by a waiter going away
+        self.future.set_running_or_notify_cancel()
+        self._lock = threading.Lock()
+        self._parts = []
+        self._listeners = []
+
+    def publish(self, text):
+        with self._lock:
+            self._parts.append(text)
+            for listener in self._listeners:
+                _deliver(listener, text)
+
+    def subscribe(self, listener):
+        # Replay what the leader has streamed so far, then follow it live
+        with self._lock:
+            if self._parts:
+                _deliver(listener, ''.join(self._parts))
+            self._listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        with self._lock:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+
+
+def _deliver(listener, text):
+    try:
+        listener(text)
+    except Exception:
+        # A follower that was cancelled must not break the leader's stream
+        pass
+
+
+def _leader_cancelled(error):
+    return isinstance(error, (Cancelled, CancelledError, asyncio.CancelledError))
+
+
+class ResponseCache:
+    def __init__(self, enabled=RESPONSE_CACHE_ENABLED, ttl=RESPONSE_CACHE_TTL_SECONDS,
+                 memory_entries=RESPONSE_CACHE_MEMORY_ENTRIES, db_path=RESPONSE_CACHE_DB,
+                 db_max_bytes=RESPONSE_CACHE_DB_MAX_BYTES):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.memory = MemoryTier(memory_entries, ttl)
+        self.disk = DiskTier(db_path, db_max_bytes) if enabled and db_path else None
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.bypassed = 0
+
+    def lookup(self, key):
+        response = self.memory.get(key)
+        if response is not None:
+            return response
+        if self.disk is None:
+            return None
+        try:
+            row = self.disk.get(key)
+        except sqlite3.Error:
+            return None
+        if row is None:
+            return None
+        self.disk_hits += 1
+        self.memory.put(key, row[0], row[1])
+        return row[0]
+
+    def store(self, key, response):
+        if not isinstance(response, str):
+            return
+        expires_at = time.time() + self.ttl
+        self.memory.put(key, response, expires_at)
+        if self.disk is not None:
+            try:
+                self.disk.put(key, response, expires_at)
+            except sqlite3.Error:
+                pass
+
+    def _begin(self, key, call):
+        # Returns (cached_response, flight, is_leader)
+        if not self.enabled or (call is not None and not call.use_cache):
+            self.bypassed += 1
+            _set_status(call, 'bypass')
+            return None, None, None
+        response = self.lookup(key)
+        if response is not None:
+            self.hits += 1
+            _set_status(call, 'hit')
+            return response, None, None
+        with self._lock:
+            flight = self._inflight.get(key)
+            if flight is not None:
+                self.coalesced += 1
+                _set_status(call, 'coalesced')
+                return None, flight, False
+            flight = self._inflight[key] = _Flight()
+        self.misses += 1
+        _set_status(call, 'miss')
+        return None, flight, True
+
+    def _finish(self, key, flight, response=None, error=None):
+        with self._lock:
+            self._inflight.pop(key, None)
+        if error is not None:
+            flight.future.set_exception(error)
+        else:
+            self.store(key, response)
+            flight.future.set_result(response)
+
+    def call(self, key, fn, call=None):
+        # fn(call) performs the upstream request; call may be None
+        while True:
+            response, flight, leader = self._begin(key, call)
+            if response is not None:
+                if call is not None:
+                    call.emit(response)
+                return response
+            if flight is None:
+                return fn(call)
+            if leader:
+                if call is not None:
+                    call.tap(flight.publish)
+                try:
+                    response = fn(call)
+                except BaseException as e:
+                    self._finish(key, flight, error=e)
+                    raise
+                self._finish(key, flight, response)
+                return response
+
+            waiter = Future()
+            flight.future.add_done_callback(lambda f: _copy_result(f, waiter))
+            listener = call.emit if call is not None and call.streaming else None
+            if listener is not None:
+                flight.subscribe(listener)
+            try:
+                if call is None:
+                    response = waiter.result()
+                else:
+                    with call.attach(lambda: waiter.cancel()):
+                        response = waiter.result()
+            except BaseException as e:
+                if call is not None and call.cancelled:
+                    call.check()
+                if _leader_cancelled(e):
+                    # The leader's own request was cancelled, not ours: retry
+                    if call is not None:
+                        call.reset()
+                    continue
+                raise
+            finally:
+                if listener is not None:
+                    flight.unsubscribe(listener)
+            return _catch_up(call, response)
+
+    async def call_async(self, key, fn, call=None):
+        # Same as call() for coroutine functions; waiting never blocks the event loop
+        loop = asyncio.get_running_loop()
+        while True:
+            response, flight, leader = self._begin(key, call)
+            if response is not None:
+                if call is not None:
+                    call.emit(response)
+                return response
+            if flight is None:
+                return await fn(call)
+            if leader:
+                if call is not None:
+                    call.tap(flight.publish)
+                try:
+                    response = await fn(call)
+                except BaseException as e:
+                    self._finish(key, flight, error=e)
+                    raise
+                self._finish(key, flight, response)
+                return response
+
+            listener = None
+            if call is not None and call.streaming:
+                listener = lambda text: loop.call_soon_threadsafe(_deliver, call.emit, text)
+                flight.subscribe(listener)
+            try:
+                response = await asyncio.shield(asyncio.wrap_future(flight.future))
+            except asyncio.CancelledError:
+                raise
+            except BaseException as e:
+                if _leader_cancelled(e):
+                    if call is not None:
+                        call.reset()
+                    continue
+                raise
+            finally:
+                if listener is not None:
+                    flight.unsubscribe(listener)
+            return _catch_up(call, response)
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.coalesced
+        stats = {
+            'enabled': self.enabled,
+            'ttl_seconds': self.ttl,
+            'memory_entries': len(self.memory),
+            'memory_max_entries': self.memory.max_entries,
+            'memory_evictions': self.memory.evictions,
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'bypassed': self.bypassed,
+            'hit_ratio': round((self.hits + self.coalesced) / lookups, 4) if lookups else 0.0,
+            'inflight': len(self._inflight),
+        }
+        if self.disk is not None:
+            stats['disk'] = self.disk.stats()
+        return stats
+
+
+def _set_status(call, status):
+    if call is not None:
+        call.cache_status = status
+
+
+def _copy_result(source, target):
+    if target.done():
+        return
+    error = source.exception()
+    try:
+        if error is not None:
+            target.set_exception(error)
+        else:
+            target.set_result(source.result())
+    except Exception:
+        # The waiter was cancelled in the meantime
+        pass
+
+
+def _catch_up(call, response):
+    # A follower subscribed to a non-streaming leader only sees the final text
+    if call is not None and isinstance(response, str):
+        seen = call.text()
+        if response.startswith(seen) and len(response) > len(seen):
+            call.emit(response[len(seen):])
+    return response
+
+
+# Shared by every request handled by this process
+RESPONSE_CACHE = ResponseCache()
@@ -0,0 +1,278 @@
+import os
+import json
+import heapq
+import itertools
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+
+# Fan-out runs outlive the SSE connection that started them. Every event a run
+# publishes gets an SSE id ("<run_id>:<seq>") and is kept in a bounded replay buffer,
+# so a browser that reconnects with Last-Event-ID picks up where it left off instead
+# of starting all models again. The buffer holds this many events per model in the
+# run; a client that has fallen further behind gets a snapshot instead (see _snapshot_locked).
+RUN_REPLAY_EVENTS_PER_MODEL = int(os.getenv('RUN_REPLAY_EVENTS_PER_MODEL', '1024'))
+RUN_RETENTION_SECONDS = float(os.getenv('RUN_RETENTION_SECONDS', '120'))
+MAX_RUNS = int(os.getenv('MAX_RUNS', '1024'))
+SSE_HEARTBEAT_SECONDS = float(os.getenv('SSE_HEARTBEAT_SECONDS', '15'))
+# How long a run keeps going with nobody listening before it is cancelled
+RESUME_GRACE_SECONDS = float(os.getenv('RESUME_GRACE_SECONDS', '20'))
+# Reconnect delay suggested to EventSource, in milliseconds
+SSE_RETRY_MS = int(os.getenv('SSE_RETRY_MS', '2000'))
+
+
+class Timer:
+    # One thread for every delayed action in the process (delta flushes, deadlines,
+    # grace periods), instead of a timer thread or polling loop per stream
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._heap = []
+        self._counter = itertools.count()
+        self._thread = None
+
+    def call_later(self, delay, fn):
+        entry = [time.monotonic() + delay, next(self._counter), fn]
+        with self._cond:
+            heapq.heappush(self._heap, entry)
+            if self._thread is None:
+                # Started lazily so gunicorn's fork happens before any thread exists
+                self._thread = threading.Thread(target=self._loop, name='run-timer', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return entry
+
+    @staticmethod
+    def cancel(entry):
+        if entry is not None:
+            entry[2] = None
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    self._cond.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+                fn = heapq.heappop(self._heap)[2]
+            if fn is not None:
+                try:
+                    fn()
+                except Exception:
+                    pass
+
+
+TIMER = Timer()
+
+
+def parse_last_event_id(value):
+    # "<run_id>:<seq>" -> (run_id, seq); anything else -> (None, 0)
+    run_id, _, seq = (value or '').rpartition(':')
+    if not run_id or not seq.isdigit():
+        return None, 0
+    return run_id, int(seq)
+
+
+def sse_text(run_id, seq, event_data):
+    return f"id: {run_id}:{seq}\ndata: {json.dumps(event_data)}\n\n"
+
+
+class Run:
+    def __init__(self, run_id, replay_limit=RUN_REPLAY_EVENTS_PER_MODEL, user_id=None):
+        self.run_id = run_id
+        # Who started it: only they may follow or cancel it
+        self.user_id = user_id
+        self.created_at = time.time()
+        self._cond = threading.Condition()
+        self._events = deque(maxlen=replay_limit)
+        self._seq = 0
+        # What a snapshot is made of: every event but the model_delta ones, as (seq,
+        # event_data), and each model still streaming's text so far and next delta seq
+        self._milestones = []
+        self._texts = {}
+        self.snapshots = 0
+        self.closed = False
+        self.subscribers = 0
+        # Called (outside the lock) when the last subscriber leaves an open run
+        self.on_abandoned = None
+        # Pushed every event as it is published (see subscribe)
+        self._listeners = []
+        # The run's CancelScope once it has started, so it can be cancelled by id
+        self.scope = None
+
+    def publish(self, event_data):
+        with self._cond:
+            if self.closed:
+                return None
+            self._seq += 1
+            text = sse_text(self.run_id, self._seq, event_data)
+            self._events.append((self._seq, text, event_data))
+            self._remember_locked(event_data)
+            for listener in self._listeners:
+                listener(self._seq, event_data)
+            self._cond.notify_all()
+            return self._seq
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            listeners, self._listeners = self._listeners, []
+            self.subscribers -= len(listeners)
+            for listener in listeners:
+                listener(None, None)
+            self._cond.notify_all()
+
+    def _remember_locked(self, event_data):
+        model_id = event_data.get('model_id')
+        if event_data.get('event') != 'model_delta':
+            self._milestones.append((self._seq, event_data))
+            if event_data.get('event') in ('model_completed', 'model_error'):
+                # Its final event carries everything the client still needs
+                self._texts.pop(model_id, None)
+            return
+        state = self._texts.setdefault(model_id, [[], 0])
+        state[0].append(event_data['delta'])
+        state[1] = event_data['seq'] + 1
+
+    def _gap_locked(self, seq):
+        # Events after seq have already left the replay buffer
+        return bool(self._events) and seq < self._events[0][0] - 1
+
+    def _snapshot_locked(self, seq):
+        # Everything a client that last saw seq needs, as of now, in a single event: the
+        # other events it missed, and the text streamed so far by each model still
+        # answering. Without it the client would be replayed only what the buffer still
+        # holds and silently lose the text in between.
+        self.snapshots += 1
+        return {
+            'event': 'run_snapshot',
+            'events': [event_data for event_seq, event_data in self._milestones if event_seq > seq],
+            'texts': {model_id: {'text': ''.join(parts), 'next_seq': next_seq}
+                      for model_id, (parts, next_seq) in self._texts.items()}
+        }
+
+    def _after_locked(self, seq):
+        if not self._events:
+            return []
+        if self._gap_locked(seq):
+            snapshot = self._snapshot_locked(seq)
+            return [sse_text(self.run_id, self._seq, snapshot)]
+        first = self._events[0][0]
+        start = max(0, seq - first + 1)
+        return [text for _, text, _ in itertools.islice(self._events, start, None)]
+
+    def subscribe(self, listener, after_seq=0):
+        # Push instead of follow()'s pull, for connections that carry many runs (see
+        # channels.py): listener(seq, event_data) gets every event after after_seq, the
+        # buffered ones first, then each one as it is published, under the run's lock so
+        # they arrive in order; it must not block. listener(None, None) marks the end.
+        with self._cond:
+            if self._gap_locked(after_seq):
+                listener(self._seq, self._snapshot_locked(after_seq))
+            else:
+                for seq, _, event_data in self._events:
+                    if seq > after_seq:
+                        listener(seq, event_data)
+            if self.closed:
+                listener(None, None)
+                return
+            self._listeners.append(listener)
+            self.subscribers += 1
+
+    def unsubscribe(self, listener):
+        with self._cond:
+            if listener not in self._listeners:
+                return
+            self._listeners.remove(listener)
+            self.subscribers -= 1
+            abandoned = self.subscribers == 0 and not self.closed
+        if abandoned and self.on_abandoned is not None:
+            self.on_abandoned(self)
+
+    def follow(self, after_seq=0, heartbeat=SSE_HEARTBEAT_SECONDS):
+        # Generator of SSE text: everything after after_seq, then live events, with a
+        # comment line as heartbeat whenever the run has been quiet for a while
+        with self._cond:
+            self.subscribers += 1
+        try:
+            yield f"retry: {SSE_RETRY_MS}\n\n"
+            while True:
+                with self._cond:
+                    pending = self._after_locked(after_seq)
+                    if not pending and not self.closed:
+                        self._cond.wait(heartbeat)
+                        pending = self._after_locked(after_seq)
+                    closed = self.closed
+                    last = self._seq
+                if pending:
+                    after_seq = last
+                    yield ''.join(pending)
+                elif closed:
+                    return
+                else:
+                    yield ": heartbeat\n\n"
+        finally:
+            with self._cond:
+                self.subscribers -= 1
+                abandoned = self.subscribers == 0 and not self.closed
+            if abandoned and self.on_abandoned is not None:
+                self.on_abandoned(self)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'run_id': self.run_id,
+                'events': self._seq,
+                'buffered': len(self._events),
+                'replay_limit': self._events.maxlen,
+                'snapshots': self.snapshots,
+                'subscribers': self.subscribers,
+                'closed': self.closed,
+            }
+
+
+class RunRegistry:
+    def __init__(self, max_runs=MAX_RUNS, retention=RUN_RETENTION_SECONDS):
+        self.max_runs = max_runs
+        self.retention = retention
+        self._lock = threading.Lock()
+        self._runs = OrderedDict()
+
+    def create(self, models=1, user_id=None):
+        # The replay buffer grows with the number of models streaming into the run
+        run = Run(uuid.uuid4().hex, RUN_REPLAY_EVENTS_PER_MODEL * max(1, models), user_id)
+        with self._lock:
+            self._runs[run.run_id] = run
+            while len(self._runs) > self.max_runs:
+                _, oldest = self._runs.popitem(last=False)
+                oldest.close()
+        return run
+
+    def get(self, run_id, user_id=None):
+        # None for an unknown or expired run, and for someone else's when user_id is given
+        with self._lock:
+            run = self._runs.get(run_id)
+        if run is not None and user_id is not None and run.user_id != user_id:
+            return None
+        return run
+
+    def finish(self, run):
+        # Closed runs stay around briefly so a late reconnect can still replay the end
+        run.close()
+        TIMER.call_later(self.retention, lambda: self._drop(run.run_id))
+
+    def _drop(self, run_id):
+        with self._lock:
+            self._runs.pop(run_id, None)
+
+    def stats(self):
+        with self._lock:
+            runs = list(self._runs.values())
+        return {
+            'runs': len(runs),
+            'open': sum(1 for run in runs if not run.closed),
+            'subscribers': sum(run.subscribers for run in runs),
+            'max_runs': self.max_runs,
+        }
+
+
+# Shared by every request handled by this process
+RUNS = RunRegistry()
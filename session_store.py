@@ -0,0 +1,247 @@
+import os
+import json
+import time
+import secrets
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import Signer, BadSignature
+from werkzeug.datastructures import CallbackDict
+
+# Server-side sessions. The cookie only carries a signed, opaque session id (and the
+# version of the session it was issued with); the API keys and everything else stay in
+# a store every worker can reach, so any gunicorn worker or node can serve any request.
+#
+# The store is a local SQLite file by default. Anything with Redis's get / setex /
+# delete works as well: SESSION_BACKEND=redis uses SESSION_REDIS_URL (needs the redis
+# package). Reads go through an in-process cache that is checked against the version in
+# the cookie, so a request whose session has not changed costs no I/O at all.
+SESSION_BACKEND = os.getenv('SESSION_BACKEND', 'sqlite')
+SESSION_DB = os.getenv('SESSION_DB', 'sessions.db')
+SESSION_REDIS_URL = os.getenv('SESSION_REDIS_URL', 'redis://localhost:6379/0')
+SESSION_TTL_SECONDS = int(os.getenv('SESSION_TTL_SECONDS', str(30 * 24 * 3600)))
+SESSION_CACHE_ENTRIES = int(os.getenv('SESSION_CACHE_ENTRIES', '4096'))
+# Shared by every worker and node; without it one is generated into SECRET_KEY_FILE,
+# which only workers on the same machine share
+SECRET_KEY_FILE = os.getenv('SECRET_KEY_FILE', '.secret_key')
+
+SESSION_KEY_PREFIX = 'everyai:session:'
+SESSION_SALT = 'everyai-session'
+
+
+def load_secret_key():
+    secret = os.getenv('SECRET_KEY')
+    if secret:
+        return secret
+    # The first worker to start writes the file; the others read what it wrote
+    try:
+        fd = os.open(SECRET_KEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        for _ in range(50):
+            with open(SECRET_KEY_FILE) as f:
+                secret = f.read().strip()
+            if secret:
+                return secret
+            time.sleep(0.01)
+        raise RuntimeError(f"{SECRET_KEY_FILE} is empty; set SECRET_KEY or delete the file")
+    secret = secrets.token_hex(32)
+    with os.fdopen(fd, 'w') as f:
+        f.write(secret)
+    return secret
+
+
+class SQLiteBackend:
+    # The subset of the Redis API the session store uses, on a local SQLite file
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS sessions ('
+            'key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL NOT NULL)'
+        )
+        self._db.execute('CREATE INDEX IF NOT EXISTS sessions_expires_at ON sessions (expires_at)')
+        try:
+            # It holds API keys
+            os.chmod(path, 0o600)
+        except OSError:
+            pass
+        self._writes = 0
+
+    def get(self, key):
+        with self._lock:
+            row = self._db.execute('SELECT value, expires_at FROM sessions WHERE key = ?', (key,)).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        return row[0]
+
+    def setex(self, key, seconds, value):
+        now = time.time()
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)', (key, value, now + seconds))
+            # Expired sessions are swept now and then instead of on every read
+            self._writes += 1
+            if self._writes % 100 == 0:
+                self._db.execute('DELETE FROM sessions WHERE expires_at < ?', (now,))
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            self._db.execute('DELETE FROM sessions WHERE key = ?', (key,))
+
+    def dbsize(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM sessions WHERE expires_at >= ?', (time.time(),)).fetchone()[0]
+
+
+def create_backend(name=SESSION_BACKEND):
+    if name == 'sqlite':
+        return SQLiteBackend(SESSION_DB)
+    if name == 'redis':
+        import redis
+        return redis.Redis.from_url(SESSION_REDIS_URL)
+    raise ValueError(f"Unknown SESSION_BACKEND: {name}")
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, version=None, expires_at=None, new=False):
+        def on_update(session):
+            session.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.version = version
+        self.expires_at = expires_at
+        self.new = new
+        self.modified = False
+
+
+class SessionStore:
+    def __init__(self, backend=None, ttl=SESSION_TTL_SECONDS, cache_entries=SESSION_CACHE_ENTRIES):
+        self._backend = backend
+        self.ttl = ttl
+        self.cache_entries = cache_entries
+        self._lock = threading.Lock()
+        # sid -> (version, data, expires_at), least recently used first
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+
+    @property
+    def backend(self):
+        # Opened on first use, so importing the app touches no file or socket
+        if self._backend is None:
+            with self._lock:
+                if self._backend is None:
+                    self._backend = create_backend()
+        return self._backend
+
+    def load(self, sid, version):
+        # (data, version, expires_at) of the session, None if it is gone. The cache only
+        # answers for the version in the cookie; anything else reads the store
+        now = time.time()
+        with self._lock:
+            entry = self._cache.get(sid)
+            if entry is not None and entry[0] == version and entry[2] > now:
+                self._cache.move_to_end(sid)
+                self.hits += 1
+                return entry[1], entry[0], entry[2]
+            self.misses += 1
+        raw = self.backend.get(SESSION_KEY_PREFIX + sid)
+        if raw is None:
+            return None
+        stored = json.loads(raw)
+        # A newer version saved by another worker is what counts, whatever the cookie says
+        self._remember(sid, stored['version'], stored['data'], stored['expires_at'])
+        return stored['data'], stored['version'], stored['expires_at']
+
+    def save(self, sid, version, data):
+        expires_at = time.time() + self.ttl
+        value = json.dumps({'version': version, 'data': data, 'expires_at': expires_at})
+        self.backend.setex(SESSION_KEY_PREFIX + sid, self.ttl, value)
+        self._remember(sid, version, data, expires_at)
+        with self._lock:
+            self.writes += 1
+        return expires_at
+
+    def delete(self, sid):
+        self.backend.delete(SESSION_KEY_PREFIX + sid)
+        with self._lock:
+            self._cache.pop(sid, None)
+
+    def _remember(self, sid, version, data, expires_at):
+        with self._lock:
+            self._cache[sid] = (version, data, expires_at)
+            self._cache.move_to_end(sid)
+            while len(self._cache) > self.cache_entries:
+                self._cache.popitem(last=False)
+
+    def stats(self):
+        backend = self.backend
+        with self._lock:
+            lookups = self.hits + self.misses
+            stats = {
+                'backend': type(backend).__name__,
+                'ttl_seconds': self.ttl,
+                'cached': len(self._cache),
+                'cache_max_entries': self.cache_entries,
+                'cache_hits': self.hits,
+                'cache_misses': self.misses,
+                'cache_hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+                'writes': self.writes,
+            }
+        try:
+            stats['sessions'] = backend.dbsize()
+        except Exception:
+            stats['sessions'] = None
+        return stats
+
+
+class ServerSessionInterface(SessionInterface):
+    # Flask session interface on top of a SessionStore. The cookie value is
+    # "<sid>.<version>" signed with the app's secret key; every save picks a new random
+    # version, so two workers saving the same session never end up with the same one.
+    def __init__(self, store):
+        self.store = store
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt=SESSION_SALT)
+
+    def open_session(self, app, request):
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if cookie:
+            try:
+                sid, _, version = self._signer(app).unsign(cookie).decode('ascii').partition('.')
+                loaded = self.store.load(sid, version)
+            except (BadSignature, ValueError):
+                loaded = None
+            if loaded is not None:
+                return ServerSession(loaded[0], sid, loaded[1], loaded[2])
+        return ServerSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session:
+            if session.modified and not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        if not session.modified:
+            # Keep active sessions alive: refresh the TTL once half of it has gone
+            if session.expires_at is None or session.expires_at - time.time() > self.store.ttl / 2:
+                return
+        session.version = secrets.token_urlsafe(6)
+        session.expires_at = self.store.save(session.sid, session.version, dict(session))
+        value = self._signer(app).sign(f"{session.sid}.{session.version}").decode('ascii')
+        response.set_cookie(name, value, expires=session.expires_at, httponly=self.get_cookie_httponly(app),
+                            domain=domain, path=path, secure=self.get_cookie_secure(app),
+                            samesite=self.get_cookie_samesite(app))
+
+
+# Shared by every request handled by this process
+SESSIONS = SessionStore()
@@ -0,0 +1,54 @@
+// Parses markdown off the page's main thread for long answers (see renderMarkdownInto in
+// script.js). Same libraries and renderer overrides as the page; code blocks come back
+// already highlighted.
+importScripts(
+    'https://cdnjs.cloudflare.com/ajax/libs/marked/9.1.6/marked.min.js',
+    'https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.9.0/highlight.min.js'
+);
+
+marked.setOptions({
+    breaks: true,
+    gfm: true,
+    pedantic: false,
+    smartypants: true
+});
+
+function escapeHtml(text) {
+    return text.replace(/&/g, '&amp;').replace(/</g, '&lt;').replace(/>/g, '&gt;')
+        .replace(/"/g, '&quot;').replace(/'/g, '&#39;');
+}
+
+const renderer = new marked.Renderer();
+const originalInlineCode = renderer.codespan;
+
+renderer.code = function(code, language) {
+    // Math blocks are left for MathJax, as on the page
+    if (language === 'math' || language === 'latex') {
+        return `<div class="math-block">\\[${code}\\]</div>`;
+    }
+    const lang = (language || '').match(/^\S*/)[0];
+    let highlighted;
+    try {
+        highlighted = lang && hljs.getLanguage(lang) ? hljs.highlight(code, { language: lang }).value
+                                                     : hljs.highlightAuto(code).value;
+    } catch (error) {
+        highlighted = escapeHtml(code);
+    }
+    const className = lang ? `hljs language-${escapeHtml(lang)}` : 'hljs';
+    return `<pre><code class="${className}">${highlighted}</code></pre>\n`;
+};
+
+renderer.codespan = function(code) {
+    if (code.startsWith('$') && code.endsWith('$')) {
+        return `<span class="math-inline">\\(${code.slice(1, -1)}\\)</span>`;
+    }
+    return originalInlineCode.call(this, code);
+};
+
+marked.use({ renderer });
+
+self.addEventListener('message', (event) => {
+    const started = performance.now();
+    const html = marked.parse(event.data.markdown);
+    self.postMessage({ id: event.data.id, html: html, parseMs: performance.now() - started });
+});
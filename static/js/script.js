@@ -10,10 +10,13 @@ document.addEventListener('DOMContentLoaded', () => {
     const saveApiKeysBtn = document.getElementById('save-api-keys');
     const githubTokenInput = document.getElementById('github-token');
     const nvidiaKeyInput = document.getElementById('nvidia-key');
+    const usageTable = document.getElementById('usage-table');
+    const usageEmpty = document.getElementById('usage-empty');
     const clearChatBtn = document.getElementById('new-chat-btn');
     const abortButton = document.getElementById('abort-button');
     let currentConversationId = null;
     let eventSource = null;
+    let currentRunId = null;
     let activeModelResponses = {};
     let operationInProgress = false;
 
@@ -65,6 +68,8 @@ document.addEventListener('DOMContentLoaded', () => {
 
     // Initialize app 
     loadingIndicator.classList.add('hidden');
+    const runChannel = createRunChannel();
+    const perf = createPerfReadout();
     currentConversationId = 'conv_' + Date.now();
 
     // Replace the existing autoResizeTextarea function with this improved version
@@ -172,6 +177,7 @@ document.addEventListener('DOMContentLoaded', () => {
         
         settingsModal.style.display = 'block';
         loadApiKeys();
+        loadUsage();
     });
 
     closeModalBtn.addEventListener('click', () => {
@@ -337,6 +343,43 @@ document.addEventListener('DOMContentLoaded', () => {
     // Initialize API key status
     checkApiKeys();
 
+    // Show each model's expected latency and grey out models whose circuit breaker
+    // is open (see /models)
+    const HEALTH_REFRESH_MS = 30000;
+    
+    async function refreshModelHealth() {
+        try {
+            const response = await fetch('/models');
+            const health = await response.json();
+            
+            Array.from(modelSelect.options).forEach(option => {
+                const model = health.models[option.value];
+                if (!model) return;
+                if (!option.dataset.name) {
+                    option.dataset.name = option.textContent;
+                }
+                option.classList.toggle('unavailable', !model.available);
+                if (!model.available) {
+                    option.textContent = `${option.dataset.name} (unavailable)`;
+                    option.title = model.last_error || 'Failing repeatedly, skipped for now';
+                    return;
+                }
+                // Median of recent answers; nothing until the model has been used
+                option.textContent = model.expected_seconds !== null
+                    ? `${option.dataset.name} · ~${model.expected_seconds.toFixed(1)}s`
+                    : option.dataset.name;
+                option.title = model.success_rate !== null && model.success_rate < 1
+                    ? `${Math.round(model.success_rate * 100)}% of recent calls succeeded`
+                    : '';
+            });
+        } catch (error) {
+            // Health is informational; the next refresh tries again
+        }
+    }
+    
+    refreshModelHealth();
+    setInterval(refreshModelHealth, HEALTH_REFRESH_MS);
+
     // Add this function to process MathJax after rendering content
     function processMathJax(element) {
         if (window.MathJax) {
@@ -476,7 +519,7 @@ document.addEventListener('DOMContentLoaded', () => {
         try {
             const selectedModel = modelSelect.value;
             
-            if (selectedModel === 'all') {
+            if (selectedModel === 'all' || runChannel.available()) {
                 // Close previous EventSource if exists
                 if (eventSource) {
                     eventSource.close();
@@ -485,100 +528,57 @@ document.addEventListener('DOMContentLoaded', () => {
                 // Reset active models tracking
                 activeModelResponses = {};
                 
-                // Create new EventSource connection for streaming
-                eventSource = new EventSource(`/generate?prompt=${encodeURIComponent(prompt)}&model=all&conversation_id=${currentConversationId}`);
-                
-                // Handle SSE events
-                eventSource.addEventListener('message', function(event) {
-                    const data = JSON.parse(event.data);
-                    
-                    if (data.event === 'model_started') {
-                        // Create placeholder for streaming response
-                        const modelId = data.model_id;
-                        const modelName = data.model_name;
-                        
-                        // Track this model
-                        activeModelResponses[modelId] = { 
-                            elementId: `response-${modelId}-${Date.now()}`,
-                            name: modelName,
-                            hasTimedOut: false // Add flag to track timeout state
-                        };
-                        
-                        // Create placeholder with typing indicator
-                        createResponsePlaceholder(modelId, modelName);
-                        scrollToBottom();
-                    }
-                    else if (data.event === 'model_completed') {
-                        // Update with completed response
-                        const modelId = data.model_id;
-                        const response = data.response;
-                        
-                        if (activeModelResponses[modelId]) {
-                            // Even if timed out before, replace with the actual response
-                            // and remove error styling
-                            updateModelResponse(modelId, response, true, false);
-                            scrollToBottom();
-                            
-                            // Clear the timeout flag since we now have a proper response
-                            activeModelResponses[modelId].hasTimedOut = false;
-                        }
-                    }
-                    else if (data.event === 'model_error') {
-                        // Handle error
-                        const modelId = data.model_id;
-                        const error = data.error;
-                        
-                        if (activeModelResponses[modelId]) {
-                            updateModelResponse(modelId, `**Error:** ${error}`, false, true);
-                            activeModelResponses[modelId].hasTimedOut = true;
-                            scrollToBottom();
+                const params = {
+                    prompt: prompt,
+                    model: selectedModel,
+                    conversation_id: currentConversationId
+                };
+                if (selectedModel === 'all') {
+                    // "First answer" / "First 3 answers" stop the other models once enough have answered,
+                    // "Fastest 3" only asks the models expected to answer soonest
+                    const option = modelSelect.options[modelSelect.selectedIndex];
+                    if (option.dataset.mode) {
+                        params.mode = option.dataset.mode;
+                        if (option.dataset.n) {
+                            params.n = option.dataset.n;
                         }
                     }
-                    else if (data.event === 'all_completed') {
-                        // Cleanup
-                        eventSource.close();
-                        eventSource = null;
-                        loadingIndicator.classList.add('hidden');
-                        
-                        // Return to slow spin if keys are valid
-                        settingsBtn.classList.remove('fast-spin');
-                        checkApiKeys(); // This will add slow-spin if keys are valid
-                        
-                        submitBtn.disabled = false;
-                        
-                        // Hide abort button
-                        abortButton.classList.remove('active');
-                        
-                        // Reset operation status
-                        operationInProgress = false;
+                    if (option.dataset.fastestK) {
+                        params.fastest_k = option.dataset.fastestK;
                     }
-                });
+                }
                 
-                eventSource.addEventListener('error', function() {
-                    console.error('EventSource connection error');
-                    eventSource.close();
-                    eventSource = null;
-                    loadingIndicator.classList.add('hidden');
-                    submitBtn.disabled = false;
-                    
-                    // Show error for incomplete responses
-                    for (const [modelId, info] of Object.entries(activeModelResponses)) {
-                        const responseElement = document.getElementById(info.elementId);
-                        if (responseElement && responseElement.querySelector('.typing-indicator')) {
-                            updateModelResponse(modelId, '**Error:** Connection lost', false, true);
+                if (runChannel.available()) {
+                    // Over the tab's WebSocket: no new request, and no URL length limit
+                    runChannel.generate(params, handleRunEvent, failRun, (runId) => {
+                        if (!operationInProgress) {
+                            // Aborted before the server named the run
+                            runChannel.cancel(runId);
+                            return;
                         }
-                    }
-                    
-                    // Return to slow spin if keys are valid
-                    settingsBtn.classList.remove('fast-spin');
-                    checkApiKeys(); // This will add slow-spin if keys are valid
-                    
-                    // Hide abort button
-                    abortButton.classList.remove('active');
-                    
-                    // Reset operation status
-                    operationInProgress = false;
-                });
+                        currentRunId = runId;
+                    });
+                } else {
+                    // Create new EventSource connection for streaming
+                    eventSource = new EventSource(`/generate?${new URLSearchParams(params)}`);
+                    eventSource.addEventListener('message', (event) => handleRunEvent(JSON.parse(event.data)));
+                    eventSource.addEventListener('error', function() {
+                        // The browser reconnects by itself and the server resumes the run from
+                        // the last event id, so only give up once it has stopped retrying
+                        if (eventSource && eventSource.readyState === EventSource.CONNECTING) {
+                            console.warn('EventSource connection lost, reconnecting');
+                            return;
+                        }
+
+                        console.error('EventSource connection error');
+                        if (!eventSource) {
+                            return;
+                        }
+                        eventSource.close();
+                        eventSource = null;
+                        failRun('Connection lost');
+                    });
+                }
             } else {
                 // Single model request
                 const response = await fetch('/generate', {
@@ -632,8 +632,243 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
+    // One event of the running prompt, from the channel or the EventSource
+    function handleRunEvent(data) {
+        if (data.event === 'model_started') {
+            // Create placeholder for streaming response
+            const modelId = data.model_id;
+            const modelName = data.model_name;
+            
+            // Track this model
+            activeModelResponses[modelId] = { 
+                elementId: `response-${modelId}-${Date.now()}`,
+                name: modelName,
+                hasTimedOut: false, // Add flag to track timeout state
+                streamedText: '',
+                nextSeq: 0
+            };
+            
+            // Create placeholder with typing indicator
+            createResponsePlaceholder(modelId, modelName, data.deadline_seconds);
+            scrollToBottom();
+        }
+        else if (data.event === 'model_delta') {
+            // Append streamed tokens; sequence numbers guard against duplicates
+            const info = activeModelResponses[data.model_id];
+            
+            if (info && data.seq === info.nextSeq) {
+                info.nextSeq += 1;
+                info.streamedText += data.delta;
+                queueStreamingRender(data.model_id);
+            }
+        }
+        else if (data.event === 'run_snapshot') {
+            // Reconnected after more than the server keeps for replay: the events missed
+            // in between, then the text each model still answering has streamed so far
+            data.events.forEach(handleRunEvent);
+            for (const [modelId, state] of Object.entries(data.texts)) {
+                const info = activeModelResponses[modelId];
+                if (info && state.next_seq > info.nextSeq) {
+                    info.streamedText = state.text;
+                    info.nextSeq = state.next_seq;
+                    queueStreamingRender(modelId);
+                }
+            }
+        }
+        else if (data.event === 'model_throttled') {
+            // Waiting for the provider's rate limit; the text goes once the model answers
+            showThrottleNote(data.model_id, data.reason, data.wait_seconds, data.attempt);
+        }
+        else if (data.event === 'model_completed') {
+            // Update with completed response
+            const modelId = data.model_id;
+            const response = data.response;
+            
+            if (activeModelResponses[modelId]) {
+                // Even if timed out before, replace with the actual response
+                // and remove error styling
+                updateModelResponse(modelId, response, true, false);
+                scrollToBottom();
+                
+                // Clear the timeout flag since we now have a proper response
+                activeModelResponses[modelId].hasTimedOut = false;
+            }
+        }
+        else if (data.event === 'model_error') {
+            // Handle error
+            const modelId = data.model_id;
+            const error = data.error;
+            
+            if (data.status === 'outpaced') {
+                // Another model answered first; this one was stopped, not broken
+                removeResponsePlaceholder(modelId);
+            }
+            else if (activeModelResponses[modelId]) {
+                updateModelResponse(modelId, `**Error:** ${error}`, false, true);
+                activeModelResponses[modelId].hasTimedOut = true;
+                scrollToBottom();
+            }
+        }
+        else if (data.event === 'all_completed') {
+            // Cleanup
+            if (eventSource) {
+                eventSource.close();
+                eventSource = null;
+            }
+            currentRunId = null;
+            loadingIndicator.classList.add('hidden');
+            
+            // Return to slow spin if keys are valid
+            settingsBtn.classList.remove('fast-spin');
+            checkApiKeys(); // This will add slow-spin if keys are valid
+            refreshModelHealth();
+            
+            submitBtn.disabled = false;
+            
+            // Hide abort button
+            abortButton.classList.remove('active');
+            
+            // Reset operation status
+            operationInProgress = false;
+        }
+    }
+
+    // The running prompt ended without finishing: the stream dropped for good, or the
+    // server turned it down
+    function failRun(message) {
+        currentRunId = null;
+        loadingIndicator.classList.add('hidden');
+        submitBtn.disabled = false;
+        
+        // Show error for incomplete responses
+        const models = Object.entries(activeModelResponses);
+        for (const [modelId, info] of models) {
+            const responseElement = document.getElementById(info.elementId);
+            if (isResponsePending(responseElement)) {
+                updateModelResponse(modelId, `**Error:** ${message}`, false, true);
+            }
+        }
+        if (models.length === 0) {
+            addMessageToChat('assistant', `**Error:** ${message}`, 'System');
+        }
+        
+        // Return to slow spin if keys are valid
+        settingsBtn.classList.remove('fast-spin');
+        checkApiKeys(); // This will add slow-spin if keys are valid
+        
+        // Hide abort button
+        abortButton.classList.remove('active');
+        
+        // Reset operation status
+        operationInProgress = false;
+    }
+
+    // Every prompt of this tab over one WebSocket, when the server offers one (asgi.py):
+    // runs are tagged with their run_id, so several can stream at once, and a dropped
+    // connection resumes them where they left off. Where there is no WebSocket (the plain
+    // WSGI app) it never opens, and prompts go over EventSource and fetch instead.
+    function createRunChannel() {
+        const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
+        const url = `${protocol}//${window.location.host}/channel`;
+        // ref -> handlers until the server names the run, then run_id -> handlers and last seq
+        const waiting = {};
+        const runs = {};
+        let socket = null;
+        let open = false;
+        let unsupported = !('WebSocket' in window);
+        let nextRef = 1;
+        let retryDelay = 1000;
+
+        function connect() {
+            if (unsupported) {
+                return;
+            }
+            let opened = false;
+            socket = new WebSocket(url);
+            socket.addEventListener('open', () => {
+                opened = true;
+                open = true;
+                retryDelay = 1000;
+                // Pick up the runs that were streaming when the connection dropped
+                for (const [runId, run] of Object.entries(runs)) {
+                    socket.send(JSON.stringify({ type: 'resume', run_id: runId, after: run.lastSeq }));
+                }
+            });
+            socket.addEventListener('message', (event) => {
+                const data = JSON.parse(event.data);
+                if (data.type === 'accepted') {
+                    const handlers = waiting[data.ref];
+                    delete waiting[data.ref];
+                    if (handlers) {
+                        runs[data.run_id] = { onEvent: handlers.onEvent, onError: handlers.onError, lastSeq: 0 };
+                        handlers.onAccepted(data.run_id);
+                    }
+                }
+                else if (data.type === 'error') {
+                    const handlers = data.ref !== undefined ? waiting[data.ref] : runs[data.run_id];
+                    delete waiting[data.ref];
+                    delete runs[data.run_id];
+                    if (handlers) {
+                        handlers.onError(data.error);
+                    }
+                }
+                else if (runs[data.run_id]) {
+                    const run = runs[data.run_id];
+                    if (data.seq <= run.lastSeq) {
+                        return;
+                    }
+                    run.lastSeq = data.seq;
+                    if (data.event === 'all_completed') {
+                        delete runs[data.run_id];
+                    }
+                    run.onEvent(data);
+                }
+            });
+            socket.addEventListener('close', () => {
+                open = false;
+                socket = null;
+                // Prompts the server may never have seen cannot be resumed
+                for (const ref of Object.keys(waiting)) {
+                    const handlers = waiting[ref];
+                    delete waiting[ref];
+                    handlers.onError('Connection lost');
+                }
+                if (!opened) {
+                    // No WebSocket on this server: stay on EventSource
+                    unsupported = true;
+                    return;
+                }
+                setTimeout(connect, retryDelay);
+                retryDelay = Math.min(retryDelay * 2, 30000);
+            });
+        }
+
+        connect();
+        return {
+            available: () => open,
+            generate(params, onEvent, onError, onAccepted) {
+                const ref = nextRef++;
+                waiting[ref] = { onEvent, onError, onAccepted };
+                socket.send(JSON.stringify({ ...params, type: 'generate', ref: ref }));
+            },
+            cancel(runId) {
+                // Nothing more is delivered for the run, whatever is still on its way
+                if (runs[runId] && open) {
+                    socket.send(JSON.stringify({ type: 'cancel', run_id: runId }));
+                }
+                delete runs[runId];
+            },
+            reconnect() {
+                // The server reads the session (API keys) when the socket connects
+                if (socket) {
+                    socket.close();
+                }
+            }
+        };
+    }
+
     // Update the timeout in the createResponsePlaceholder function
-    function createResponsePlaceholder(modelId, modelName) {
+    function createResponsePlaceholder(modelId, modelName, deadlineSeconds) {
         const elementId = activeModelResponses[modelId].elementId;
         
         const container = document.createElement('div');
@@ -662,8 +897,8 @@ document.addEventListener('DOMContentLoaded', () => {
         
         chatMessages.appendChild(container);
         
-        // Update the timeout to match backend (60 seconds)
-        const timeoutSeconds = 60; // Match the backend MODEL_TIMEOUT_SECONDS
+        // Match the deadline the backend gave this model (60 seconds if it did not say)
+        const timeoutSeconds = deadlineSeconds || 60;
         activeModelResponses[modelId].timeout = setTimeout(() => {
             // Check if this model response is still showing the typing indicator
             const responseElement = document.getElementById(elementId);
@@ -679,10 +914,306 @@ document.addEventListener('DOMContentLoaded', () => {
         }, timeoutSeconds * 1000); // Convert to milliseconds
     }
     
+    // A response is pending until it has been fully rendered, whether it is
+    // still showing the typing indicator or partway through streaming
+    function isResponsePending(container) {
+        return !!container && (!!container.querySelector('.typing-indicator') ||
+                               container.classList.contains('streaming'));
+    }
+    
+    function removeResponsePlaceholder(modelId) {
+        const info = activeModelResponses[modelId];
+        if (!info) return;
+        if (info.timeout) {
+            clearTimeout(info.timeout);
+            info.timeout = null;
+        }
+        const container = document.getElementById(info.elementId);
+        if (container) {
+            container.remove();
+        }
+        delete activeModelResponses[modelId];
+    }
+    
+    function showThrottleNote(modelId, reason, waitSeconds, attempt) {
+        const info = activeModelResponses[modelId];
+        if (!info) return;
+        const container = document.getElementById(info.elementId);
+        if (!container || !container.querySelector('.typing-indicator')) return;
+        
+        const messageContent = container.querySelector('.message-content');
+        let note = messageContent.querySelector('.throttle-note');
+        if (!note) {
+            note = document.createElement('div');
+            note.className = 'throttle-note';
+            messageContent.appendChild(note);
+        }
+        const wait = `${Number(waitSeconds).toFixed(1)}s`;
+        note.textContent = reason === 'retry'
+            ? `Rate limited, retrying in ${wait} (attempt ${attempt})`
+            : `Waiting ${wait} for the provider's rate limit`;
+    }
+    
+    // Render a response that is still streaming: markdown only, math and
+    // highlighting wait for the final render in updateModelResponse
+    // Streamed text goes on the page once per animation frame, for every model at once,
+    // however many deltas arrived in between
+    const dirtyModels = new Set();
+    let frameRequested = false;
+    let oldestUnrenderedDelta = null;
+
+    function queueStreamingRender(modelId) {
+        dirtyModels.add(modelId);
+        perf.recordDelta();
+        if (oldestUnrenderedDelta === null) {
+            oldestUnrenderedDelta = performance.now();
+        }
+        if (!frameRequested) {
+            frameRequested = true;
+            requestAnimationFrame(renderFrame);
+        }
+    }
+
+    function renderFrame() {
+        frameRequested = false;
+        const started = performance.now();
+        for (const modelId of dirtyModels) {
+            if (activeModelResponses[modelId]) {
+                renderStreamingResponse(modelId);
+            }
+        }
+        dirtyModels.clear();
+        scrollToBottom();
+        const finished = performance.now();
+        perf.recordFrame(finished - started, oldestUnrenderedDelta === null ? null : finished - oldestUnrenderedDelta);
+        oldestUnrenderedDelta = null;
+    }
+
+    // Blocks end at blank lines outside code fences. Only the text not scanned before is
+    // looked at, so finding them costs linear time over the whole answer.
+    function advanceStream(stream, text) {
+        let lineStart = stream.scanned;
+        let newline;
+        while ((newline = text.indexOf('\n', lineStart)) !== -1) {
+            const line = text.slice(lineStart, newline);
+            if (/^ {0,3}(```|~~~)/.test(line)) {
+                stream.inFence = !stream.inFence;
+            } else if (!stream.inFence && line.trim() === '') {
+                stream.boundary = newline + 1;
+            }
+            lineStart = newline + 1;
+        }
+        stream.scanned = lineStart;
+    }
+
+    function renderStreamingResponse(modelId) {
+        const info = activeModelResponses[modelId];
+        const container = document.getElementById(info.elementId);
+        if (!container) return;
+        
+        // The model is answering, so the "taking too long" timer no longer applies
+        if (info.timeout) {
+            clearTimeout(info.timeout);
+            info.timeout = null;
+        }
+        
+        if (!info.stream) {
+            // Replaces the typing indicator (or a "taking too long" note)
+            const messageContent = container.querySelector('.message-content');
+            messageContent.innerHTML = '';
+            info.stream = { scanned: 0, boundary: 0, settled: 0, inFence: false, tail: document.createElement('div') };
+            messageContent.appendChild(info.stream.tail);
+            container.classList.add('streaming');
+        }
+        
+        // A finished block is parsed once more, with its full text, and then left alone;
+        // only the block still being written is parsed again on every frame
+        const stream = info.stream;
+        const text = info.streamedText;
+        advanceStream(stream, text);
+        if (stream.boundary > stream.settled) {
+            const block = stream.tail;
+            stream.tail = document.createElement('div');
+            block.after(stream.tail);
+            renderMarkdownInto(block, processMathInContent(text.slice(stream.settled, stream.boundary)));
+            stream.settled = stream.boundary;
+        }
+        renderMarkdownInto(stream.tail, processMathInContent(text.slice(stream.settled)));
+    }
+
+    // Markdown of long texts (with their code highlighted) is parsed in a Web Worker, so
+    // the page keeps scrolling meanwhile; short texts are quicker to parse right here.
+    // onRendered(highlighted) runs once the HTML is in place.
+    const WORKER_MIN_CHARS = 8000;
+    const markdownWorker = createMarkdownWorker();
+
+    function createMarkdownWorker() {
+        let worker = null;
+        try {
+            worker = new Worker('/static/js/markdown-worker.js');
+        } catch (error) {
+            console.warn('No markdown worker, parsing on the page instead:', error);
+        }
+        const waiting = {};
+        let nextId = 1;
+        if (worker) {
+            worker.addEventListener('message', (event) => {
+                const resolve = waiting[event.data.id];
+                delete waiting[event.data.id];
+                perf.recordParse(event.data.parseMs);
+                resolve(event.data.html);
+            });
+            worker.addEventListener('error', (event) => {
+                // e.g. the libraries could not be loaded: everything is parsed on the page
+                console.warn('Markdown worker failed, parsing on the page instead:', event.message);
+                worker = null;
+                for (const id of Object.keys(waiting)) {
+                    const resolve = waiting[id];
+                    delete waiting[id];
+                    resolve(null);
+                }
+            });
+        }
+        return {
+            available: () => worker !== null,
+            parse(markdown) {
+                const id = nextId++;
+                return new Promise((resolve) => {
+                    waiting[id] = resolve;
+                    worker.postMessage({ id: id, markdown: markdown });
+                });
+            }
+        };
+    }
+
+    function renderMarkdownInto(element, markdown, onRendered) {
+        // Every render is numbered; a worker result older than what is shown is dropped
+        const ticket = (element.markdownTicket || 0) + 1;
+        element.markdownTicket = ticket;
+        if (markdown.length < WORKER_MIN_CHARS || !markdownWorker.available()) {
+            element.markdownNext = null;
+            showMarkdown(element, ticket, marked.parse(markdown), false, onRendered);
+            return;
+        }
+        if (element.markdownBusy) {
+            // One request per element at a time; only the newest text waits for it
+            element.markdownNext = { ticket: ticket, markdown: markdown, onRendered: onRendered };
+            return;
+        }
+        parseInWorker(element, ticket, markdown, onRendered);
+    }
+
+    function parseInWorker(element, ticket, markdown, onRendered) {
+        element.markdownBusy = true;
+        markdownWorker.parse(markdown).then((html) => {
+            element.markdownBusy = false;
+            if (html === null) {
+                showMarkdown(element, ticket, marked.parse(markdown), false, onRendered);
+            } else {
+                showMarkdown(element, ticket, html, true, onRendered);
+            }
+            const next = element.markdownNext;
+            if (next) {
+                element.markdownNext = null;
+                parseInWorker(element, next.ticket, next.markdown, next.onRendered);
+            }
+        });
+    }
+
+    function showMarkdown(element, ticket, html, highlighted, onRendered) {
+        if (ticket < (element.markdownShown || 0)) return;
+        element.markdownShown = ticket;
+        element.innerHTML = html;
+        if (onRendered) {
+            onRendered(highlighted);
+        }
+    }
+
+    // In-page readout for tuning the streaming path: add ?perf=1 to the URL, or press Alt+P.
+    // Frames per second, time spent rendering per frame, time from a delta arriving to
+    // it being on the page, deltas per second and worker parses.
+    function createPerfReadout() {
+        const element = document.createElement('div');
+        element.id = 'perf-readout';
+        element.hidden = true;
+        document.body.appendChild(element);
+        let stats = null;
+        let visible = false;
+        let windowStart = 0;
+
+        function reset(now) {
+            windowStart = now;
+            stats = { ticks: 0, frames: 0, renderMs: 0, maxRenderMs: 0, latencyMs: 0, maxLatencyMs: 0,
+                      latencies: 0, deltas: 0, parses: 0, parseMs: 0 };
+        }
+
+        function tick(now) {
+            if (!visible) return;
+            stats.ticks += 1;
+            const elapsed = now - windowStart;
+            if (elapsed >= 1000) {
+                const perSecond = (count) => Math.round(count * 1000 / elapsed);
+                const average = (total, count) => count ? (total / count).toFixed(1) : '-';
+                element.textContent = [
+                    `${perSecond(stats.ticks)} fps`,
+                    `render ${average(stats.renderMs, stats.frames)} ms (max ${stats.maxRenderMs.toFixed(1)}) in ${stats.frames} frames`,
+                    `delta to page ${average(stats.latencyMs, stats.latencies)} ms (max ${stats.maxLatencyMs.toFixed(1)})`,
+                    `${perSecond(stats.deltas)} deltas/s`,
+                    `worker ${stats.parses} parses, ${average(stats.parseMs, stats.parses)} ms`
+                ].join('\n');
+                reset(now);
+            }
+            requestAnimationFrame(tick);
+        }
+
+        function toggle() {
+            visible = !visible;
+            element.hidden = !visible;
+            if (visible) {
+                reset(performance.now());
+                element.textContent = 'measuring...';
+                requestAnimationFrame(tick);
+            }
+        }
+
+        reset(performance.now());
+        document.addEventListener('keydown', (e) => {
+            if (e.altKey && e.code === 'KeyP') {
+                toggle();
+            }
+        });
+        if (new URLSearchParams(window.location.search).get('perf') === '1') {
+            toggle();
+        }
+        return {
+            recordDelta() {
+                stats.deltas += 1;
+            },
+            recordFrame(renderMs, latencyMs) {
+                stats.frames += 1;
+                stats.renderMs += renderMs;
+                stats.maxRenderMs = Math.max(stats.maxRenderMs, renderMs);
+                if (latencyMs !== null) {
+                    stats.latencies += 1;
+                    stats.latencyMs += latencyMs;
+                    stats.maxLatencyMs = Math.max(stats.maxLatencyMs, latencyMs);
+                }
+            },
+            recordParse(parseMs) {
+                stats.parses += 1;
+                stats.parseMs += parseMs;
+            }
+        };
+    }
+    
     // Update the updateModelResponse function
     function updateModelResponse(modelId, content, completed = false, isError = false) {
         if (!activeModelResponses[modelId]) return;
         
+        // This replaces whatever was streamed; text streamed after it starts over
+        dirtyModels.delete(modelId);
+        activeModelResponses[modelId].stream = null;
+        
         const elementId = activeModelResponses[modelId].elementId;
         const container = document.getElementById(elementId);
         
@@ -716,58 +1247,61 @@ document.addEventListener('DOMContentLoaded', () => {
                 message.classList.add('error-message');
             }
             
-            // Add content with markdown
-            messageContent.innerHTML = marked.parse(processedContent);
-            
-            // Apply syntax highlighting
-            messageContent.querySelectorAll('pre code').forEach((block) => {
-                hljs.highlightElement(block);
-            });
-            
-            // Trigger MathJax to process the newly added content
-            if (window.MathJax) {
-                window.MathJax.typesetPromise([messageContent]).then(() => {
-                    // After MathJax has processed, adjust the container
-                    adjustContainerForMath(container);
-                    
-                    // Fix specific rendering issues
-                    const mathElements = messageContent.querySelectorAll('mjx-container');
-                    mathElements.forEach(mathEl => {
-                        // Fix integral signs
-                        const integrals = mathEl.querySelectorAll('mjx-mo[data-c="222B"]');
-                        integrals.forEach(integral => {
-                            integral.style.marginRight = '0.15em';
-                        });
-                        
-                        // Fix log display
-                        const logs = mathEl.querySelectorAll('mjx-mi:contains("log")');
-                        logs.forEach(log => {
-                            log.style.marginRight = '0.1em';
-                        });
-                        
-                        // Add custom class to math containers that need horizontal scrolling
-                        if (mathEl.scrollWidth > mathEl.clientWidth) {
-                            mathEl.classList.add('scrollable');
-                        }
-                    });
-                }).catch(err => {
-                    console.error('MathJax error:', err);
-                });
-            }
-            
             // Add completion class
             if (completed) {
                 container.classList.add('completed');
             }
+            container.classList.remove('streaming');
             
-            // Apply dynamic sizing based on content length
-            if (content.length < 10) {
-                message.classList.add('short-message');
-            } else {
-                message.classList.remove('short-message');
-            }
-            
-            adjustMessageSize(message);
+            // Add content with markdown (parsed and highlighted in the worker when long)
+            renderMarkdownInto(messageContent, processedContent, (highlighted) => {
+                // Apply syntax highlighting
+                if (!highlighted) {
+                    messageContent.querySelectorAll('pre code').forEach((block) => {
+                        hljs.highlightElement(block);
+                    });
+                }
+                
+                // Trigger MathJax to process the newly added content
+                if (window.MathJax) {
+                    window.MathJax.typesetPromise([messageContent]).then(() => {
+                        // After MathJax has processed, adjust the container
+                        adjustContainerForMath(container);
+                        
+                        // Fix specific rendering issues
+                        const mathElements = messageContent.querySelectorAll('mjx-container');
+                        mathElements.forEach(mathEl => {
+                            // Fix integral signs
+                            const integrals = mathEl.querySelectorAll('mjx-mo[data-c="222B"]');
+                            integrals.forEach(integral => {
+                                integral.style.marginRight = '0.15em';
+                            });
+                            
+                            // Fix log display
+                            const logs = mathEl.querySelectorAll('mjx-mi:contains("log")');
+                            logs.forEach(log => {
+                                log.style.marginRight = '0.1em';
+                            });
+                            
+                            // Add custom class to math containers that need horizontal scrolling
+                            if (mathEl.scrollWidth > mathEl.clientWidth) {
+                                mathEl.classList.add('scrollable');
+                            }
+                        });
+                    }).catch(err => {
+                        console.error('MathJax error:', err);
+                    });
+                }
+                
+                // Apply dynamic sizing based on content length
+                if (content.length < 10) {
+                    message.classList.add('short-message');
+                } else {
+                    message.classList.remove('short-message');
+                }
+                
+                adjustMessageSize(message);
+            });
         }
     }
 
@@ -828,6 +1362,35 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
+    // Requests and tokens used with the saved keys, against any known quotas
+    async function loadUsage() {
+        try {
+            const response = await fetch('/usage');
+            const data = await response.json();
+            const tbody = usageTable.querySelector('tbody');
+            tbody.innerHTML = '';
+            data.usage.forEach(row => {
+                const tr = document.createElement('tr');
+                const quotas = Object.entries(row.quotas).map(([name, quota]) => {
+                    const near = quota.room_in_seconds !== null;
+                    return `<span class="${near ? 'near-quota' : ''}">${name} ${quota.used}/${quota.limit}</span>`;
+                });
+                if (row.exhausted_for_seconds > 0) {
+                    quotas.push(`<span class="near-quota">used up for ${Math.ceil(row.exhausted_for_seconds / 60)} min</span>`);
+                }
+                tr.innerHTML = `<td>${row.model_name}</td>`
+                    + `<td>${row.minute.requests} / ${row.day.requests}</td>`
+                    + `<td>${row.day.prompt_tokens + row.day.completion_tokens}</td>`
+                    + `<td>${quotas.join(' · ') || '-'}</td>`;
+                tbody.appendChild(tr);
+            });
+            usageTable.classList.toggle('hidden', data.usage.length === 0);
+            usageEmpty.classList.toggle('hidden', data.usage.length > 0);
+        } catch (error) {
+            // Usage is informational; it is fetched again when the settings reopen
+        }
+    }
+
     // Update the saveApiKeys function to properly show red indicators for missing keys
     async function saveApiKeys() {
         try {
@@ -843,6 +1406,9 @@ document.addEventListener('DOMContentLoaded', () => {
             });
             
             if (response.ok) {
+                // Reconnect so the channel uses the new keys
+                runChannel.reconnect();
+                
                 // Close the modal
                 settingsModal.style.display = 'none';
                 settingsBtn.classList.remove('active-spin');
@@ -1003,6 +1569,13 @@ document.addEventListener('DOMContentLoaded', () => {
             }
         }, 100);
         
+        // The server no longer needs to remember the old conversation
+        fetch('/forget_conversation', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ conversation_id: currentConversationId })
+        }).catch(() => {});
+        
         // Reset conversation ID to terminate any pending operations
         currentConversationId = 'conv_' + Date.now();
         
@@ -1072,13 +1645,19 @@ document.addEventListener('DOMContentLoaded', () => {
             eventSource = null;
         }
         
+        // Or stop the run on the channel and ignore whatever it still sends
+        if (currentRunId) {
+            runChannel.cancel(currentRunId);
+            currentRunId = null;
+        }
+        
         // For all active model responses that are still processing,
         // mark them as aborted
         for (const [modelId, info] of Object.entries(activeModelResponses)) {
             const elementId = info.elementId;
             const container = document.getElementById(elementId);
             
-            if (container && container.querySelector('.typing-indicator')) {
+            if (isResponsePending(container)) {
                 // Replace typing indicator with aborted message
                 updateModelResponse(
                     modelId,
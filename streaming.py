@@ -0,0 +1,54 @@
+import os
+import time
+
+# Streamed tokens arrive a few characters at a time; sending one SSE event per token
+# costs more in framing and client re-renders than the text itself. Deltas are held
+# per model for a short window (or until enough text piles up) and sent as one event.
+DELTA_BATCH_SECONDS = float(os.getenv('DELTA_BATCH_SECONDS', '0.05'))
+DELTA_BATCH_MAX_CHARS = int(os.getenv('DELTA_BATCH_MAX_CHARS', '2048'))
+
+
+class DeltaBatcher:
+    # Not thread-safe: owned by the single loop that writes the SSE stream
+    def __init__(self, window=DELTA_BATCH_SECONDS, max_chars=DELTA_BATCH_MAX_CHARS):
+        self.window = window
+        self.max_chars = max_chars
+        # model_id -> [parts, first_buffered_at, size]
+        self._pending = {}
+        self._seq = {}
+
+    def add(self, model_id, text, now=None):
+        now = time.monotonic() if now is None else now
+        entry = self._pending.get(model_id)
+        if entry is None:
+            entry = self._pending[model_id] = [[], now, 0]
+        entry[0].append(text)
+        entry[2] += len(text)
+        if entry[2] >= self.max_chars or now - entry[1] >= self.window:
+            return self.flush(model_id)
+        return None
+
+    def flush(self, model_id):
+        # Returns (seq, text) for the buffered deltas, or None if nothing is buffered
+        entry = self._pending.pop(model_id, None)
+        if entry is None:
+            return None
+        seq = self._seq.get(model_id, 0)
+        self._seq[model_id] = seq + 1
+        return seq, ''.join(entry[0])
+
+    def flush_due(self, now=None):
+        now = time.monotonic() if now is None else now
+        due = [model_id for model_id, entry in self._pending.items() if now - entry[1] >= self.window]
+        return [(model_id,) + self.flush(model_id) for model_id in due]
+
+    def next_flush_in(self, now=None):
+        # Seconds until the oldest buffer is due, or None when nothing is buffered
+        if not self._pending:
+            return None
+        now = time.monotonic() if now is None else now
+        oldest = min(entry[1] for entry in self._pending.values())
+        return max(0.0, oldest + self.window - now)
+
+    def sent(self, model_id):
+        return self._seq.get(model_id, 0)
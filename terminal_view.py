@@ -0,0 +1,233 @@
+import sys
+import time
+import shutil
+import threading
+from collections import deque
+
+from model_registry import MODEL_NAMES
+
+# Live terminal view for rawcode.py: every model's answer shown while it streams, with
+# its time to first token and tokens/s. 'panes' splits a terminal into one pane per model
+# and redraws it a few times a second; 'lines' (the default when output is not a
+# terminal) prints each model's lines as they complete, prefixed with the model's name;
+# 'plain' writes a single model's text through as it comes.
+#
+# Deltas are kept as parts and only complete lines are joined, so a long answer costs
+# linear time, and a redraw only looks at the last few lines of each model.
+
+VIEW_FPS = 10
+# Lines of each answer kept for drawing its pane
+PANE_HISTORY_LINES = 200
+
+HIDE_CURSOR = '\x1b[?25l'
+SHOW_CURSOR = '\x1b[?25h'
+ALT_SCREEN = '\x1b[?1049h'
+MAIN_SCREEN = '\x1b[?1049l'
+CLEAR_LINE = '\x1b[K'
+BOLD = '\x1b[1m'
+RESET = '\x1b[0m'
+
+
+class ModelPane:
+    def __init__(self, model_id, history_lines=PANE_HISTORY_LINES):
+        self.model_id = model_id
+        self.name = MODEL_NAMES[model_id]
+        self.lines = deque(maxlen=history_lines)
+        self._partial = []
+        self.chars = 0
+        self.started_at = time.monotonic()
+        self.first_token_at = None
+        self.finished_at = None
+        # Completion tokens reported by the provider; estimated from the text until then
+        self.output_tokens = None
+        self.status = 'waiting'
+        self.response = None
+        self.error = None
+
+    def feed(self, text):
+        # The lines `text` completes
+        if self.first_token_at is None:
+            self.first_token_at = time.monotonic()
+            self.status = 'streaming'
+        self.chars += len(text)
+        if '\n' not in text:
+            self._partial.append(text)
+            return []
+        head, *middle, tail = text.split('\n')
+        self._partial.append(head)
+        completed = [''.join(self._partial)] + middle
+        self._partial = [tail] if tail else []
+        self.lines.extend(completed)
+        return completed
+
+    def flush(self):
+        # Whatever is left of an answer without a final newline
+        line = ''.join(self._partial)
+        self._partial = []
+        if line:
+            self.lines.append(line)
+        return line
+
+    def finish(self, call, response=None, error=None, status=None):
+        self.finished_at = time.monotonic()
+        self.output_tokens = call.output_tokens
+        # A cancelled answer keeps what had been streamed
+        self.response = response if response is not None else call.text()
+        self.error = error
+        self.status = status or ('error' if error else 'done')
+
+    def ttft(self):
+        if self.first_token_at is None:
+            return None
+        return self.first_token_at - self.started_at
+
+    def tokens(self):
+        if self.output_tokens is not None:
+            return self.output_tokens, False
+        # About four characters per token, as in conversations.py
+        return self.chars // 4, True
+
+    def tokens_per_second(self):
+        # Decode rate: tokens over the time since the first one
+        if self.first_token_at is None:
+            return None
+        elapsed = (self.finished_at or time.monotonic()) - self.first_token_at
+        return self.tokens()[0] / elapsed if elapsed > 0 else None
+
+    def stats(self):
+        parts = []
+        ttft = self.ttft()
+        if ttft is not None:
+            parts.append(f"TTFT {ttft:.2f}s")
+        tokens, estimated = self.tokens()
+        if tokens:
+            parts.append(f"{'~' if estimated else ''}{tokens} tokens")
+        rate = self.tokens_per_second()
+        if rate is not None and tokens:
+            parts.append(f"{rate:.1f} tokens/s")
+        if self.finished_at is not None:
+            parts.append(f"{self.finished_at - self.started_at:.2f}s total")
+        return ' · '.join(parts)
+
+    def tail_rows(self, width, count):
+        # The last `count` screen rows of the answer, wrapped at `width`
+        if self._partial:
+            self._partial = [''.join(self._partial)]
+        lines = list(self.lines)[-count:]
+        if self._partial:
+            # A long line without newlines only needs its end
+            lines.append(self._partial[0][-width * count:])
+        rows = []
+        for line in reversed(lines):
+            line = line.replace('\t', '    ').replace('\r', '')
+            wrapped = [line[start:start + width] for start in range(0, len(line), width)] or ['']
+            rows[:0] = wrapped
+            if len(rows) >= count:
+                break
+        return rows[-count:]
+
+
+class LiveView:
+    def __init__(self, model_ids, mode=None, out=sys.stdout, fps=VIEW_FPS):
+        if mode is None:
+            mode = 'panes' if out.isatty() else 'lines'
+        self.mode = mode
+        self.out = out
+        self.fps = fps
+        self.panes = {model_id: ModelPane(model_id) for model_id in model_ids}
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._thread = None
+        self._label_width = max(len(pane.name) for pane in self.panes.values())
+
+    def start(self):
+        if self.mode == 'panes':
+            self.out.write(ALT_SCREEN + HIDE_CURSOR)
+            self._thread = threading.Thread(target=self._draw_loop, name='live-view', daemon=True)
+            self._thread.start()
+
+    def delta(self, model_id, text):
+        with self._lock:
+            pane = self.panes[model_id]
+            first = pane.first_token_at is None
+            completed = pane.feed(text)
+            if self.mode == 'plain':
+                self.out.write(text)
+                self.out.flush()
+            elif self.mode == 'lines':
+                if first:
+                    self._print_locked(pane, f"first token after {pane.ttft():.2f}s")
+                for line in completed:
+                    self._print_locked(pane, line)
+
+    def finish(self, model_id, call, response=None, error=None, status=None):
+        with self._lock:
+            pane = self.panes[model_id]
+            rest = pane.flush()
+            pane.finish(call, response, error, status)
+            if self.mode == 'plain':
+                if pane.first_token_at is None and response:
+                    self.out.write(response)
+                if pane.error:
+                    self.out.write(f"❌ {pane.error}")
+                self.out.write(f"\n\n({' · '.join(part for part in (pane.status, pane.stats()) if part)})\n")
+                self.out.flush()
+            elif self.mode == 'lines':
+                if rest:
+                    self._print_locked(pane, rest)
+                if pane.first_token_at is None and response:
+                    # Nothing was streamed (e.g. a cached answer): show it now
+                    for line in response.split('\n'):
+                        self._print_locked(pane, line)
+                self._print_locked(pane, ' · '.join(part for part in (pane.status, pane.error, pane.stats()) if part))
+
+    def close(self):
+        self._closed.set()
+        if self._thread is not None:
+            self._thread.join()
+            self.out.write(SHOW_CURSOR + MAIN_SCREEN)
+            # The panes only showed the end of each answer; leave the whole of them behind
+            for pane in self.panes.values():
+                self.out.write(f"\n📌 Response from **{pane.name}** ({pane.stats()}):\n\n")
+                self.out.write(f"❌ {pane.error}\n" if pane.error else f"{pane.response or ''}\n")
+                self.out.write("\n" + "=" * 80 + "\n")
+        if self.mode != 'plain':
+            self.out.write(self.summary() + "\n")
+        self.out.flush()
+
+    def summary(self):
+        lines = [f"{'model':28} {'status':>9} {'TTFT s':>8} {'tokens':>8} {'tokens/s':>9} {'total s':>8}"]
+        column = lambda value, width, spec: f"{value:{width}{spec}}" if value is not None else f"{'-':>{width}}"
+        for pane in self.panes.values():
+            tokens, estimated = pane.tokens()
+            total = pane.finished_at - pane.started_at if pane.finished_at is not None else None
+            lines.append(f"{pane.name:28} {pane.status:>9} {column(pane.ttft(), 8, '.2f')} "
+                         f"{('~' if estimated else '') + str(tokens):>8} {column(pane.tokens_per_second(), 9, '.1f')} "
+                         f"{column(total, 8, '.2f')}")
+        return '\n'.join(lines)
+
+    def _print_locked(self, pane, line):
+        self.out.write(f"[{pane.name:{self._label_width}}] {line}\n")
+        self.out.flush()
+
+    def _draw_loop(self):
+        while not self._closed.wait(1 / self.fps):
+            self._draw()
+        self._draw()
+
+    def _draw(self):
+        width, height = shutil.get_terminal_size((100, 30))
+        width = max(20, width)
+        # One header row per pane, the rest shared out; nothing may scroll the screen
+        rows = max(1, (height - 1) // len(self.panes))
+        screen = ['\x1b[H']
+        with self._lock:
+            for pane in self.panes.values():
+                header = '■ ' + ' · '.join(part for part in (pane.name, pane.status, pane.stats(), pane.error) if part)
+                screen.append(BOLD + header[:width] + RESET + CLEAR_LINE + '\n')
+                body = pane.tail_rows(width, rows - 1) if rows > 1 else []
+                body += [''] * (rows - 1 - len(body))
+                screen.extend(row + CLEAR_LINE + '\n' for row in body)
+        screen.append('\x1b[J')
+        self.out.write(''.join(screen))
+        self.out.flush()
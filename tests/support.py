@@ -0,0 +1,10 @@
+import time
+
+
+def wait_for(condition, timeout=5.0):
+    # Polls until condition() is true; the tests use it to line threads up
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError('timed out waiting for the condition')
+        time.sleep(0.005)
@@ -0,0 +1,136 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip('flask')
+pytest.importorskip('openai')
+
+import async_engine
+from bench.mock_providers import start_providers
+from dispatcher import Saturated
+from metrics import ASYNC_FANOUTS_ACTIVE
+from model_registry import MODEL_SPECS
+from tracing import TRACER
+
+# Both on the OpenAI SDK and GitHub's endpoint, so one stand-in serves them
+MODELS = ['gpt41', 'o3']
+API_KEYS = {'github_token': 'test'}
+
+
+@pytest.fixture(scope='module')
+def providers():
+    providers = start_providers('fast')
+    yield providers
+    for server in providers.values():
+        server.stop()
+
+
+@pytest.fixture
+def provider(providers, monkeypatch):
+    for model_id in MODELS:
+        monkeypatch.setitem(MODEL_SPECS[model_id], 'endpoint', providers['github'].url)
+    return providers['github']
+
+
+def _events(run):
+    events = []
+    run.subscribe(lambda seq, event_data: events.append(event_data) if seq is not None else None)
+    return events
+
+
+def _in_flight():
+    return async_engine._inflight_fanouts, ASYNC_FANOUTS_ACTIVE.snapshot().get('[]', 0)
+
+
+async def _fan_out(**kwargs):
+    run = async_engine.start_all_models_async('hello', API_KEYS, 'conversation', use_cache=False,
+                                              model_ids=MODELS, user_id='user', memory=False, **kwargs)
+    await asyncio.gather(*async_engine._fanout_tasks)
+    return run
+
+
+def test_fan_out_streams_into_a_run(provider):
+    before = _in_flight()
+    run = asyncio.run(_fan_out())
+
+    assert run.closed
+    events = _events(run)
+    assert events[0]['event'] == 'run_started'
+    completed = [event for event in events if event['event'] == 'model_completed']
+    assert sorted(event['model_id'] for event in completed) == MODELS
+    assert all('lorem' in event['response'] for event in completed)
+    assert events[-1]['event'] == 'all_completed'
+    assert sorted(events[-1]['answered']) == MODELS
+    assert _in_flight() == before
+
+
+def test_enough_answers_cancel_the_rest(provider):
+    run = asyncio.run(_fan_out(wanted=1))
+
+    events = _events(run)
+    statuses = sorted(event['status'] for event in events if event['event'] in ('model_completed', 'model_error'))
+    assert statuses == ['outpaced', 'success']
+    assert len(events[-1]['answered']) == 1
+
+
+def test_admission_is_refused_when_full(provider, monkeypatch):
+    monkeypatch.setattr(async_engine, 'ASYNC_MAX_INFLIGHT_FANOUTS', async_engine._inflight_fanouts)
+    before = _in_flight()
+
+    async def start():
+        with pytest.raises(Saturated):
+            async_engine.start_all_models_async('hello', API_KEYS, 'conversation', model_ids=MODELS)
+
+    asyncio.run(start())
+    assert _in_flight() == before
+
+
+def test_fan_out_cancelled_before_it_starts_still_ends(provider):
+    before = _in_flight()
+
+    async def cancel_at_once():
+        run = async_engine.start_all_models_async('hello', API_KEYS, 'conversation', model_ids=MODELS)
+        for task in list(async_engine._fanout_tasks):
+            task.cancel()
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        return run
+
+    run = asyncio.run(cancel_at_once())
+    assert run.closed
+    assert _in_flight() == before
+
+
+def test_abandoned_fan_out_is_cancelled_after_the_grace_period(monkeypatch):
+    providers = start_providers('fast', overrides={'first_token': 30, 'sigma': 0.01})
+    for model_id in MODELS:
+        monkeypatch.setitem(MODEL_SPECS[model_id], 'endpoint', providers['github'].url)
+    monkeypatch.setattr(async_engine, 'RESUME_GRACE_SECONDS', 0.05)
+
+    async def walk_away():
+        run = async_engine.start_all_models_async('hello', API_KEYS, 'conversation', use_cache=False,
+                                                  model_ids=MODELS, user_id='user', memory=False)
+        listener = lambda seq, event_data: None
+        run.subscribe(listener)
+        await asyncio.sleep(0.1)
+        run.unsubscribe(listener)
+        await asyncio.wait_for(asyncio.gather(*async_engine._fanout_tasks), 5)
+        return run
+
+    try:
+        run = asyncio.run(walk_away())
+    finally:
+        for server in providers.values():
+            server.stop()
+    events = _events(run)
+    assert sorted(event['status'] for event in events if event['event'] == 'model_error') == ['cancelled', 'cancelled']
+    assert events[-1] == {'event': 'all_completed', 'answered': []}
+
+
+def test_forced_trace_records_each_model(provider, monkeypatch, tmp_path):
+    monkeypatch.setattr(TRACER, 'directory', str(tmp_path))
+    run = asyncio.run(_fan_out(force_trace=True))
+
+    assert _events(run)[0]['trace_url'] == f"/debug/trace/{run.run_id}"
+    names = {event.get('name') for event in TRACER.get(run.run_id)['traceEvents']}
+    assert 'queued' in names
@@ -0,0 +1,75 @@
+import time
+
+from breakers import Breakers, CircuitBreaker, outcome, CLOSED, OPEN, HALF_OPEN
+from cancellation import Cancelled
+
+
+class _StatusError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+
+def _opened(open_seconds=0.01):
+    breaker = CircuitBreaker('model', window=4, min_calls=2, failure_rate=0.5, open_seconds=open_seconds)
+    breaker.record(True)
+    breaker.record(True)
+    assert breaker.state == OPEN
+    return breaker
+
+
+def test_opens_after_enough_failures():
+    breaker = CircuitBreaker('model', window=4, min_calls=4, failure_rate=0.5, open_seconds=60)
+    for failed in (False, True, False):
+        breaker.record(failed)
+    assert breaker.state == CLOSED
+    breaker.record(True)
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+
+
+def test_half_open_lets_a_single_trial_through():
+    breaker = _opened()
+    time.sleep(0.02)
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    assert not breaker.allow()
+    assert not breaker.available()
+
+
+def test_a_trial_that_says_nothing_about_the_model_is_handed_back():
+    breakers = Breakers(['model'])
+    breaker = breakers._breakers['model'] = _opened()
+    time.sleep(0.02)
+    assert breakers.allow('model')
+    # e.g. a cache hit or a call cancelled before it reached the provider
+    breakers.record('model', 'ignored')
+    assert breaker.state == HALF_OPEN
+    assert breakers.available('model')
+    assert breakers.allow('model')
+
+
+def test_trial_success_closes_and_failure_reopens_for_longer():
+    breaker = _opened()
+    time.sleep(0.02)
+    assert breaker.allow()
+    breaker.record(True)
+    assert breaker.state == OPEN
+    assert breaker.open_seconds == 0.02
+    time.sleep(0.03)
+    assert breaker.allow()
+    breaker.record(False)
+    assert breaker.state == CLOSED
+    assert breaker.open_seconds == breaker.base_open_seconds
+
+
+def test_outcome_only_blames_the_model_for_its_own_failures():
+    assert outcome('success') is False
+    assert outcome('timeout') is True
+    assert outcome('cancelled') is None
+    assert outcome('error', Cancelled()) is None
+    # A bad key or request is ours, a server error or 408 the model's
+    assert outcome('error', _StatusError(401)) is None
+    assert outcome('error', _StatusError(503)) is True
+    assert outcome('error', _StatusError(408)) is True
+    assert outcome('error', ValueError('connection reset')) is True
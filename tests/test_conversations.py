@@ -0,0 +1,105 @@
+from conversations import ConversationStore, ModelThread, estimate_tokens, history_budget
+
+
+class _Backend(dict):
+    # The get / setex / delete subset of Redis the session store backends offer
+    def setex(self, key, seconds, value):
+        self[key] = value
+
+    def delete(self, key):
+        self.pop(key, None)
+
+
+class _Sessions:
+    def __init__(self):
+        self.backend = _Backend()
+        self.ttl = 60
+
+
+def _turn_tokens(prompt, response):
+    return estimate_tokens(prompt) + estimate_tokens(response)
+
+
+def test_context_keeps_the_newest_turns_that_fit_and_summarises_the_rest():
+    turn = ('p' * 40, 'r' * 40)
+    thread = ModelThread('gpt41', budget=_turn_tokens(*turn) * 3)
+    for number in range(5):
+        thread.append(f"{number}" + turn[0][1:], turn[1])
+
+    # Turns that could never fit again are dropped as they come in
+    assert len(thread) == 3
+    context = thread.context('next')
+    # With the prompt on top only two of the three kept turns fit
+    assert [message['content'][0] for message in context['messages'][::2]] == ['3', '4']
+    assert context['summary'].startswith('Earlier in this conversation the user asked: 0')
+    assert context['tokens'] <= thread.budget - estimate_tokens('next')
+
+
+def test_new_conversation_has_no_context():
+    assert ModelThread('gpt41').context('hello') is None
+
+
+def test_failed_answers_are_not_remembered():
+    thread = ModelThread('gpt41')
+    thread.append('prompt', None)
+    assert len(thread) == 0
+
+
+def test_max_turns_caps_the_thread():
+    thread = ModelThread('gpt41', budget=10 ** 6, max_turns=2)
+    for number in range(4):
+        thread.append(f"prompt {number}", 'answer')
+    assert len(thread) == 2
+    assert 'prompt 1' in thread.context('next')['summary']
+
+
+def test_cache_key_changes_with_every_turn():
+    thread = ModelThread('gpt41')
+    thread.append('a', 'b')
+    first = thread.context('x')['key']
+    thread.append('c', 'd')
+    assert thread.context('x')['key'] != first
+
+
+def test_history_budget_leaves_room_for_the_answer():
+    assert 0 < history_budget('gpt41') <= 4000
+
+
+def test_dump_and_restore_round_trip():
+    thread = ModelThread('gpt41', budget=100)
+    for number in range(6):
+        thread.append(f"prompt {number}", 'answer ' * 5)
+    copy = ModelThread('gpt41', budget=100)
+    copy.restore(thread.dump())
+    assert copy.context('next') == thread.context('next')
+
+
+def test_shared_store_carries_a_conversation_between_workers():
+    sessions = _Sessions()
+    first, second = ConversationStore(), ConversationStore()
+    first.share(sessions)
+    second.share(sessions)
+
+    first.thread('alice', 'chat', 'gpt41').append('hello', 'hi')
+    thread = second.thread('alice', 'chat', 'gpt41')
+    assert thread.context('next')['messages'] == [
+        {'role': 'user', 'content': 'hello'}, {'role': 'assistant', 'content': 'hi'}]
+    # Other users, conversations and models have threads of their own
+    assert second.thread('bob', 'chat', 'gpt41').context('next') is None
+    assert second.thread('alice', 'other', 'gpt41').context('next') is None
+    assert second.thread('alice', 'chat', 'o3').context('next') is None
+
+    assert second.forget('alice', 'chat')
+    assert first.thread('alice', 'chat', 'gpt41').context('next') is None
+    assert not second.forget('alice', 'chat')
+
+
+def test_memory_store_evicts_the_least_recently_used_conversation():
+    store = ConversationStore(max_conversations=2)
+    store.thread('alice', 'a', 'gpt41').append('p', 'r')
+    store.thread('alice', 'b', 'gpt41').append('p', 'r')
+    store.thread('alice', 'a', 'gpt41')
+    store.thread('alice', 'c', 'gpt41')
+    assert store.evictions == 1
+    assert len(store.thread('alice', 'a', 'gpt41')) == 1
+    assert len(store.thread('alice', 'b', 'gpt41')) == 0
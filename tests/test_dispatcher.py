@@ -0,0 +1,63 @@
+import threading
+
+import pytest
+
+from dispatcher import Dispatcher, Saturated
+from support import wait_for
+
+
+def _blocked(dispatcher, user_id, provider):
+    # Occupies one of the provider's slots until the returned event is set
+    release = threading.Event()
+    started = threading.Event()
+
+    def run():
+        started.set()
+        release.wait(5)
+
+    dispatcher.submit(user_id, provider, run)
+    assert started.wait(5)
+    return release
+
+
+def test_users_are_served_round_robin():
+    dispatcher = Dispatcher(workers=1, provider_limits={'github': 1})
+    release = _blocked(dispatcher, 'first', 'github')
+    order = []
+    futures = [dispatcher.submit('first', 'github', order.append, f'first-{n}') for n in range(3)]
+    futures.append(dispatcher.submit('second', 'github', order.append, 'second-0'))
+    release.set()
+    for future in futures:
+        future.result(5)
+    assert order == ['first-0', 'second-0', 'first-1', 'first-2']
+
+
+def test_provider_limit_holds_back_only_that_provider():
+    dispatcher = Dispatcher(workers=4, provider_limits={'github': 1, 'nvidia': 1})
+    release = _blocked(dispatcher, 'user', 'github')
+    waiting = dispatcher.submit('user', 'github', lambda: 'github')
+    assert dispatcher.submit('user', 'nvidia', lambda: 'nvidia').result(5) == 'nvidia'
+    assert not waiting.done()
+    release.set()
+    assert waiting.result(5) == 'github'
+
+
+def test_cancelled_call_leaves_the_queue():
+    dispatcher = Dispatcher(workers=1, provider_limits={'github': 1}, max_queue=1)
+    release = _blocked(dispatcher, 'user', 'github')
+    queued = dispatcher.submit('user', 'github', lambda: None)
+    with pytest.raises(Saturated):
+        dispatcher.admit({'github': 1}, 60)
+
+    assert queued.cancel()
+    stats = dispatcher.stats()
+    assert stats['queue_depth'] == 0
+    assert stats['queue_depth_by_provider'] == {'github': 0}
+    assert stats['queued_users'] == 0
+    assert stats['cancelled'] == 1
+    # Its place is free again
+    dispatcher.admit({'github': 1}, 60)
+
+    release.set()
+    wait_for(lambda: dispatcher.stats()['completed'] == 1)
+    assert dispatcher.stats()['running_by_provider'] == {'github': 0}
@@ -0,0 +1,103 @@
+import json
+import time
+
+import pytest
+
+import jobs
+from jobs import JobQueue, parse_prompts, DONE, RUNNING
+from support import wait_for
+
+
+def _queue(tmp_path, **kwargs):
+    return JobQueue(path=str(tmp_path / 'jobs.db'), **kwargs)
+
+
+def _status(queue, job):
+    return queue.get(job['job_id'])['status']
+
+
+def test_parse_prompts():
+    assert parse_prompts(['a', {'id': 'x', 'prompt': 'b'}]) == [('1', 'a'), ('x', 'b')]
+
+
+@pytest.mark.parametrize('prompts', [[], 'a', [''], [{'id': 'x', 'prompt': 'a'}, {'id': 'x', 'prompt': 'b'}]])
+def test_parse_prompts_rejects(prompts):
+    with pytest.raises(ValueError):
+        parse_prompts(prompts)
+
+
+def test_runner_answers_every_prompt_for_every_model(tmp_path):
+    queue = _queue(tmp_path)
+
+    def execute(task, done):
+        done(task, {'status': 'success', 'response': task['prompt'].upper()})
+
+    job = queue.create('alice', [('1', 'a'), ('2', 'b')], ['gpt41', 'o3'], {})
+    queue.start(execute)
+    wait_for(lambda: _status(queue, job) == DONE)
+
+    results = queue.results(job['job_id'])
+    assert [(r['id'], r['model'], r['response']) for r in results] == [
+        ('1', 'gpt41', 'A'), ('1', 'o3', 'A'), ('2', 'gpt41', 'B'), ('2', 'o3', 'B')]
+    assert [r['seq'] for r in results] == [1, 2, 3, 4]
+    lines = list(queue.follow(job['job_id'], after=2, sse=False))
+    assert [json.loads(line)['seq'] for line in lines] == [3, 4]
+
+
+def test_task_of_a_crashed_worker_is_taken_over_once_its_lease_runs_out(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, 'JOBS_LEASE_SECONDS', 0.05)
+    crashed, survivor = _queue(tmp_path), _queue(tmp_path)
+    job = crashed.create('alice', [('1', 'a')], ['gpt41'], {'github_token': 'key'})
+
+    # The first worker claims the call and dies before finishing it
+    task = crashed._claim()
+    assert task['attempt'] == 1
+    assert survivor._claim() is None
+    time.sleep(0.1)
+
+    retaken = survivor._claim()
+    assert (retaken['task_id'], retaken['attempt']) == (task['task_id'], 2)
+    assert retaken['api_keys'] == {'github_token': 'key'}
+
+    # A late answer from the first worker no longer counts
+    crashed._done(task, {'status': 'success', 'response': 'stale'})
+    assert _status(survivor, job) == RUNNING
+    survivor._done(retaken, {'status': 'success', 'response': 'fresh'})
+    assert _status(survivor, job) == DONE
+    assert [(r['response'], r['attempts']) for r in survivor.results(job['job_id'])] == [('fresh', 2)]
+
+
+def test_retry_waits_and_only_counts_attempted_calls(tmp_path):
+    queue = _queue(tmp_path)
+    job = queue.create('alice', [('1', 'a')], ['gpt41'], {})
+
+    task = queue._claim()
+    # Rate limited before reaching the provider: back in the queue, attempt not used up
+    queue._done(task, {'status': 'error', 'error': 'rate limited'}, retry_in=0.05, attempted=False)
+    assert queue._claim() is None
+    time.sleep(0.1)
+    task = queue._claim()
+    assert task['attempt'] == 1
+
+    queue._done(task, {'status': 'error', 'error': 'timed out'}, retry_in=0)
+    task = queue._claim()
+    assert task['attempt'] == 2
+
+
+def test_cancel_stops_queued_calls_and_aborts_running_ones(tmp_path):
+    queue = _queue(tmp_path, concurrency=1)
+    aborted = []
+
+    class Handle:
+        def cancel(self):
+            aborted.append(True)
+
+    job = queue.create('alice', [('1', 'a'), ('2', 'b')], ['gpt41'], {})
+    queue.start(lambda task, done: Handle())
+    wait_for(lambda: queue.get(job['job_id'])['running'] == 1)
+
+    assert queue.cancel(job['job_id'])
+    assert aborted == [True]
+    info = queue.get(job['job_id'])
+    assert (info['status'], info['queued'], info['cancelled']) == ('cancelled', 0, 1)
+    assert not queue.cancel(job['job_id'])
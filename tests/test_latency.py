@@ -0,0 +1,109 @@
+import time
+
+import pytest
+
+import latency
+from call_context import CallContext
+from latency import LatencyTracker, parse_deadline, percentile, watch_first_token
+
+
+class _ManualTimer:
+    # call_later that only runs what is due when the test says so
+    def __init__(self):
+        self.pending = []
+
+    def call_later(self, delay, fn):
+        self.pending.append((delay, fn))
+        return len(self.pending)
+
+    def run_next(self):
+        return self.pending.pop(0)[1]()
+
+
+def test_percentile_is_nearest_rank():
+    assert percentile([5, 1, 3, 2, 4], 50) == 3
+    assert percentile(range(1, 101), 95) == 95
+    assert percentile([7], 99) == 7
+
+
+def test_parse_deadline():
+    assert parse_deadline(None) is None
+    assert parse_deadline('') is None
+    assert parse_deadline('2.5') == 2.5
+    assert parse_deadline(10 ** 6) == latency.MODEL_TIMEOUT_CEILING_SECONDS
+    with pytest.raises(ValueError):
+        parse_deadline('0')
+
+
+def test_budget_is_learnt_from_recent_calls():
+    tracker = LatencyTracker(min_samples=5)
+    assert tracker.budget('model') == {'total': latency.MODEL_TIMEOUT_SECONDS,
+                                       'first_token': latency.MODEL_TIMEOUT_SECONDS}
+    for total in (20, 21, 22, 23, 24):
+        tracker.record('model', total, first_token=4)
+    budget = tracker.budget('model')
+    assert budget['total'] == 24 * latency.LATENCY_HEADROOM
+    # Time to first token never gets a budget below its floor
+    assert budget['first_token'] == max(latency.FIRST_TOKEN_FLOOR_SECONDS, 4 * latency.LATENCY_HEADROOM)
+    # A request's deadline caps both
+    assert tracker.budget('model', deadline=3) == {'total': 3, 'first_token': 3}
+
+
+def test_fast_models_are_held_to_the_floor():
+    tracker = LatencyTracker(min_samples=1)
+    tracker.record('model', 0.5, first_token=0.1)
+    assert tracker.budget('model')['total'] == latency.MODEL_TIMEOUT_FLOOR_SECONDS
+
+
+def test_hedge_delay_follows_time_to_first_token():
+    tracker = LatencyTracker(min_samples=2)
+    assert tracker.hedge_delay('model') == latency.HEDGE_DELAY_SECONDS
+    for first_token in (1, 2, 3, 4, 5, 6, 7, 8, 9, 10):
+        tracker.record('model', 20, first_token)
+    assert tracker.hedge_delay('model') == 9
+
+
+def test_first_token_deadline_ignores_time_spent_queued():
+    timer = _ManualTimer()
+    call = CallContext()
+    silent = []
+    watch_first_token(call, {'total': 10, 'first_token': 2}, lambda: silent.append(True), timer.call_later)
+
+    # Still waiting for a worker: the whole budget is still ahead of it
+    timer.run_next()
+    assert not silent and timer.pending[0][0] == 2
+
+    # Running for 1.5 of its 2 seconds: checked again once the rest is up
+    call.running_at = time.monotonic() - 1.5
+    timer.run_next()
+    assert not silent and 0 < timer.pending[0][0] <= 0.5
+
+    # A rate limit wait does not count either
+    call.running_at = time.monotonic() - 3
+    call.throttle_seconds = 2
+    timer.run_next()
+    assert not silent and 0 < timer.pending[0][0] <= 1
+
+    call.throttle_seconds = 0
+    timer.run_next()
+    assert silent == [True]
+
+
+def test_first_token_deadline_stands_down_once_the_model_answers():
+    timer = _ManualTimer()
+    call = CallContext(on_delta=lambda text: None)
+    silent = []
+    watch_first_token(call, {'total': 10, 'first_token': 2}, lambda: silent.append(True), timer.call_later)
+    call.mark_running()
+    call.emit('Hi')
+    timer.run_next()
+    assert not silent and not timer.pending
+
+
+def test_time_to_first_token_is_counted_from_when_the_call_ran():
+    call = CallContext(on_delta=lambda text: None)
+    call.started_at -= 5
+    call.running_at = time.monotonic() - 1
+    call.emit('Hi')
+    assert 1 <= call.first_token_seconds() < 2
+    assert 3.9 < call.queued_seconds() < 4.1
@@ -0,0 +1,119 @@
+import threading
+import time
+from email.utils import formatdate
+
+import pytest
+
+from call_context import CallContext
+from cancellation import Cancelled
+from rate_limits import RateLimited, RateLimiter, TokenBucket, parse_duration, retry_after_seconds
+
+
+class _Response:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class _ProviderError(Exception):
+    # Shaped like the SDKs' status errors
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+        self.response = _Response(status_code, headers)
+
+
+def _failing(*statuses, headers=None):
+    # fn() that fails with each status in turn, then answers
+    calls = []
+
+    def fn():
+        calls.append(time.monotonic())
+        if len(calls) <= len(statuses):
+            raise _ProviderError(statuses[len(calls) - 1], headers)
+        return 'answer'
+    return fn, calls
+
+
+@pytest.mark.parametrize('value, seconds', [
+    ('30', 30), ('1.5', 1.5), ('20ms', 0.02), ('1s', 1), ('6m0s', 360), ('1h', 3600), (None, None), ('soon', None),
+])
+def test_parse_duration(value, seconds):
+    assert parse_duration(value) == seconds
+
+
+def test_retry_after_seconds():
+    assert retry_after_seconds({'retry-after-ms': '250', 'retry-after': '9'}) == 0.25
+    assert retry_after_seconds({'retry-after': '3'}) == 3
+    assert 8 < retry_after_seconds({'retry-after': formatdate(time.time() + 10, usegmt=True)}) <= 10
+    assert retry_after_seconds({}) is None
+
+
+def test_bucket_learns_the_rate_from_headers():
+    bucket = TokenBucket()
+    bucket.learn(200, {'x-ratelimit-limit-requests': '60', 'x-ratelimit-renewalperiod-requests': '60',
+                       'x-ratelimit-remaining-requests': '0', 'x-ratelimit-reset-requests': '2s'})
+    assert bucket.rate == 1
+    assert bucket.capacity == 60
+    wait, _ = bucket.reserve()
+    assert 1.9 < wait <= 2
+
+
+def test_429_is_retried_after_retry_after():
+    limiter = RateLimiter(default_rpm={}, backoff=0.001)
+    fn, calls = _failing(429, headers={'retry-after-ms': '50'})
+    call = CallContext(deadline=5)
+    assert limiter.call('github', 'key', fn, call) == 'answer'
+    assert len(calls) == 2
+    assert calls[1] - calls[0] >= 0.05
+    assert call.retries == 1
+    assert call.throttle_seconds >= 0.05
+    assert limiter.retries == 1
+
+
+def test_errors_that_are_not_worth_repeating_are_raised_at_once():
+    limiter = RateLimiter(default_rpm={}, backoff=0.001)
+    fn, calls = _failing(400)
+    with pytest.raises(_ProviderError):
+        limiter.call('github', 'key', fn, CallContext(deadline=5))
+    assert len(calls) == 1
+
+
+def test_no_retry_once_text_has_been_streamed():
+    limiter = RateLimiter(default_rpm={}, backoff=0.001)
+    call = CallContext(on_delta=lambda text: None, deadline=5)
+    call.emit('partial')
+    fn, calls = _failing(503)
+    with pytest.raises(_ProviderError):
+        limiter.call('github', 'key', fn, call)
+    assert len(calls) == 1
+
+
+def test_no_retry_that_would_end_past_the_deadline():
+    limiter = RateLimiter(default_rpm={}, backoff=0.001)
+    fn, calls = _failing(429, headers={'retry-after': '30'})
+    with pytest.raises(_ProviderError):
+        limiter.call('github', 'key', fn, CallContext(deadline=1))
+    assert len(calls) == 1
+
+
+def test_slot_beyond_the_deadline_fails_straight_away():
+    limiter = RateLimiter(default_rpm={'github': 1})
+    assert limiter.call('github', 'key', lambda: 'first', CallContext(deadline=5)) == 'first'
+    started = time.monotonic()
+    with pytest.raises(RateLimited):
+        limiter.call('github', 'key', lambda: 'second', CallContext(deadline=1))
+    assert time.monotonic() - started < 0.5
+    # Another key has a bucket of its own
+    assert limiter.call('github', 'other', lambda: 'third', CallContext(deadline=5)) == 'third'
+
+
+def test_cancelling_the_call_ends_its_rate_limit_wait():
+    limiter = RateLimiter(default_rpm={'github': 1})
+    limiter.call('github', 'key', lambda: 'first')
+    call = CallContext(deadline=120)
+    threading.Timer(0.05, call.cancel).start()
+    started = time.monotonic()
+    with pytest.raises(Cancelled):
+        limiter.call('github', 'key', lambda: 'second', call)
+    assert time.monotonic() - started < 5
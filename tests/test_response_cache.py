@@ -0,0 +1,151 @@
+import threading
+
+from call_context import CallContext
+from cancellation import Cancelled
+from response_cache import ResponseCache
+from support import wait_for
+
+
+def _run_in_thread(fn):
+    outcome = {}
+
+    def run():
+        try:
+            outcome['result'] = fn()
+        except BaseException as e:
+            outcome['error'] = e
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread, outcome
+
+
+def test_concurrent_identical_calls_share_one_upstream_call():
+    cache = ResponseCache(enabled=True, db_path='')
+    release = threading.Event()
+    upstream = []
+
+    def fetch(call):
+        upstream.append(call)
+        release.wait(5)
+        return 'answer'
+
+    leader_call, follower_call = CallContext(), CallContext()
+    leader, leader_outcome = _run_in_thread(lambda: cache.call('key', fetch, leader_call))
+    wait_for(lambda: upstream)
+    follower, follower_outcome = _run_in_thread(lambda: cache.call('key', fetch, follower_call))
+    wait_for(lambda: cache.coalesced == 1)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+
+    assert leader_outcome['result'] == follower_outcome['result'] == 'answer'
+    assert len(upstream) == 1
+    assert (leader_call.cache_status, follower_call.cache_status) == ('miss', 'coalesced')
+    # And later calls are answered from memory
+    assert cache.call('key', fetch) == 'answer'
+    assert cache.hits == 1
+
+
+def test_follower_makes_its_own_call_when_the_leader_is_cancelled():
+    cache = ResponseCache(enabled=True, db_path='')
+    release = threading.Event()
+    upstream = []
+
+    def fetch(call):
+        upstream.append(call)
+        if len(upstream) == 1:
+            release.wait(5)
+            call.check()
+        return 'answer'
+
+    leader_call, follower_call = CallContext(), CallContext()
+    leader, leader_outcome = _run_in_thread(lambda: cache.call('key', fetch, leader_call))
+    wait_for(lambda: upstream)
+    follower, follower_outcome = _run_in_thread(lambda: cache.call('key', fetch, follower_call))
+    wait_for(lambda: cache.coalesced == 1)
+    leader_call.cancel()
+    release.set()
+    leader.join(5)
+    follower.join(5)
+
+    assert isinstance(leader_outcome['error'], Cancelled)
+    # The leader's cancellation is not the follower's: it retries and leads a call of its own
+    assert follower_outcome['result'] == 'answer'
+    assert upstream == [leader_call, follower_call]
+    assert follower_call.cache_status == 'miss'
+    assert cache.stats()['inflight'] == 0
+
+
+def test_cancelled_follower_leaves_the_leader_running():
+    cache = ResponseCache(enabled=True, db_path='')
+    release = threading.Event()
+    upstream = []
+
+    def fetch(call):
+        upstream.append(call)
+        release.wait(5)
+        return 'answer'
+
+    leader, leader_outcome = _run_in_thread(lambda: cache.call('key', fetch, CallContext()))
+    wait_for(lambda: upstream)
+    follower_call = CallContext()
+    follower, follower_outcome = _run_in_thread(lambda: cache.call('key', fetch, follower_call))
+    wait_for(lambda: cache.coalesced == 1)
+    follower_call.cancel()
+    follower.join(5)
+    release.set()
+    leader.join(5)
+
+    assert isinstance(follower_outcome['error'], Cancelled)
+    assert leader_outcome['result'] == 'answer'
+    assert len(upstream) == 1
+
+
+def test_streaming_follower_gets_the_text_already_streamed():
+    cache = ResponseCache(enabled=True, db_path='')
+    release = threading.Event()
+    streamed = threading.Event()
+
+    def fetch(call):
+        call.emit('Hello, ')
+        streamed.set()
+        release.wait(5)
+        call.emit('world')
+        return 'Hello, world'
+
+    leader, _ = _run_in_thread(lambda: cache.call('key', fetch, CallContext(on_delta=lambda text: None)))
+    streamed.wait(5)
+    deltas = []
+    follower_call = CallContext(on_delta=deltas.append)
+    follower, follower_outcome = _run_in_thread(lambda: cache.call('key', fetch, follower_call))
+    wait_for(lambda: deltas)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+
+    assert follower_outcome['result'] == 'Hello, world'
+    assert ''.join(deltas) == 'Hello, world'
+
+
+def test_bypass_skips_cache_and_coalescing():
+    cache = ResponseCache(enabled=True, db_path='')
+    upstream = []
+
+    def fetch(call):
+        upstream.append(call)
+        return 'answer'
+
+    call = CallContext(use_cache=False)
+    assert cache.call('key', fetch, call) == 'answer'
+    assert cache.call('key', fetch, CallContext(use_cache=False)) == 'answer'
+    assert len(upstream) == 2
+    assert call.cache_status == 'bypass'
+
+
+def test_disk_tier_outlives_the_process(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    ResponseCache(enabled=True, db_path=path).store('key', 'answer')
+    restarted = ResponseCache(enabled=True, db_path=path)
+    assert restarted.lookup('key') == 'answer'
+    assert restarted.disk_hits == 1
@@ -0,0 +1,105 @@
+import json
+
+from runs import Run, RunRegistry, parse_last_event_id
+
+
+def _events(text):
+    # SSE text -> [(id, data)], heartbeats and retry lines left out
+    events = []
+    for block in text.split('\n\n'):
+        fields = dict(line.split(': ', 1) for line in block.splitlines() if not line.startswith((':', 'retry')))
+        if 'data' in fields:
+            events.append((fields.get('id'), json.loads(fields['data'])))
+    return events
+
+
+def _delta(model_id, seq, text):
+    return {'event': 'model_delta', 'model_id': model_id, 'seq': seq, 'delta': text}
+
+
+def _stream(model_id, run, parts):
+    for seq, text in enumerate(parts):
+        run.publish(_delta(model_id, seq, text))
+
+
+def test_parse_last_event_id():
+    assert parse_last_event_id('abc:12') == ('abc', 12)
+    assert parse_last_event_id('a:b:3') == ('a:b', 3)
+    assert parse_last_event_id('abc') == (None, 0)
+    assert parse_last_event_id('abc:x') == (None, 0)
+    assert parse_last_event_id(None) == (None, 0)
+
+
+def test_follow_replays_what_came_after_the_last_event_id():
+    run = Run('run', replay_limit=100)
+    run.publish({'event': 'run_started'})
+    _stream('a', run, ['one ', 'two ', 'three'])
+    run.close()
+
+    events = _events(''.join(run.follow(after_seq=2)))
+    assert [event_id for event_id, _ in events] == ['run:3', 'run:4']
+    assert [data['delta'] for _, data in events] == ['two ', 'three']
+
+
+def test_follow_sends_a_snapshot_when_the_buffer_has_moved_past_the_client():
+    run = Run('run', replay_limit=3)
+    run.publish({'event': 'run_started'})
+    run.publish({'event': 'model_started', 'model_id': 'a'})
+    run.publish({'event': 'model_started', 'model_id': 'b'})
+    _stream('a', run, ['Hel', 'lo ', 'wor', 'ld'])
+    _stream('b', run, ['Bye'])
+    run.publish({'event': 'model_completed', 'model_id': 'b', 'response': 'Bye'})
+    run.close()
+
+    # The client saw up to run_started; the buffer only holds the last three events
+    events = _events(''.join(run.follow(after_seq=1)))
+    assert len(events) == 1
+    event_id, snapshot = events[0]
+    assert snapshot['event'] == 'run_snapshot'
+    # Numbered as of the newest event, so the next reconnect resumes after it
+    assert event_id == 'run:9'
+    assert [event['event'] for event in snapshot['events']] == ['model_started', 'model_started', 'model_completed']
+    # Model a is still streaming: its whole text so far and the delta seq to expect next
+    assert snapshot['texts'] == {'a': {'text': 'Hello world', 'next_seq': 4}}
+    assert run.snapshots == 1
+
+
+def test_subscribe_pushes_the_snapshot_then_live_events():
+    run = Run('run', replay_limit=2)
+    run.publish({'event': 'run_started'})
+    _stream('a', run, ['x', 'y', 'z'])
+    received = []
+    run.subscribe(lambda seq, event_data: received.append((seq, event_data)), after_seq=1)
+    run.publish(_delta('a', 3, '!'))
+    run.close()
+
+    assert received[0][0] == 4
+    assert received[0][1]['event'] == 'run_snapshot'
+    assert received[0][1]['texts'] == {'a': {'text': 'xyz', 'next_seq': 3}}
+    assert received[1] == (5, _delta('a', 3, '!'))
+    assert received[2] == (None, None)
+
+
+def test_last_listener_leaving_an_open_run_calls_on_abandoned():
+    run = Run('run')
+    abandoned = []
+    run.on_abandoned = abandoned.append
+    listener = lambda seq, event_data: None
+    run.subscribe(listener)
+    assert run.subscribers == 1
+    run.unsubscribe(listener)
+    assert abandoned == [run]
+    assert run.subscribers == 0
+
+
+def test_registry_only_hands_a_run_to_its_owner():
+    runs = RunRegistry(max_runs=2, retention=60)
+    run = runs.create(models=2, user_id='alice')
+    assert runs.get(run.run_id) is run
+    assert runs.get(run.run_id, 'alice') is run
+    assert runs.get(run.run_id, 'bob') is None
+    # The oldest run is closed and dropped past max_runs
+    runs.create(user_id='alice')
+    runs.create(user_id='alice')
+    assert runs.get(run.run_id) is None
+    assert run.closed
@@ -0,0 +1,90 @@
+import pytest
+
+flask = pytest.importorskip('flask')
+
+from session_store import SQLiteBackend, ServerSessionInterface, SessionStore
+
+
+def _worker(path):
+    # One gunicorn worker: its own store and cache over the shared file
+    app = flask.Flask(__name__)
+    app.secret_key = 'test secret'
+    app.session_interface = ServerSessionInterface(SessionStore(SQLiteBackend(path), ttl=60))
+
+    @app.route('/set/<value>')
+    def set_value(value):
+        flask.session['value'] = value
+        return 'ok'
+
+    @app.route('/get')
+    def get_value():
+        return flask.session.get('value', '')
+
+    @app.route('/clear')
+    def clear():
+        flask.session.clear()
+        return 'ok'
+
+    return app
+
+
+def test_store_round_trip_and_cache(tmp_path):
+    backend = SQLiteBackend(str(tmp_path / 'sessions.db'))
+    first, second = SessionStore(backend, ttl=60), SessionStore(backend, ttl=60)
+    first.save('sid', 'v1', {'api_keys': {'github_token': 'key'}})
+
+    assert second.load('sid', 'v1')[0] == {'api_keys': {'github_token': 'key'}}
+    assert second.misses == 1
+    # Same version again: answered from memory
+    second.load('sid', 'v1')
+    assert second.hits == 1
+    # Saved again by another worker: the new cookie's version misses the cache
+    first.save('sid', 'v2', {'api_keys': {}})
+    assert second.load('sid', 'v2')[:2] == ({'api_keys': {}}, 'v2')
+    assert second.misses == 2
+
+    first.delete('sid')
+    assert second.load('sid', 'v3') is None
+
+
+def test_expired_sessions_are_gone(tmp_path):
+    backend = SQLiteBackend(str(tmp_path / 'sessions.db'))
+    backend.setex('key', -1, 'value')
+    assert backend.get('key') is None
+    assert backend.dbsize() == 0
+
+
+def test_any_worker_serves_any_session(tmp_path):
+    path = str(tmp_path / 'sessions.db')
+    first, second = _worker(path).test_client(), _worker(path).test_client()
+
+    first.get('/set/hello')
+    cookie = first.get_cookie('session')
+    # The cookie only carries a signed id and version, never the data
+    assert 'hello' not in cookie.value
+    second.set_cookie('session', cookie.value)
+    assert second.get('/get').text == 'hello'
+
+    # Changed on the second worker, seen by the first
+    second.get('/set/again')
+    first.set_cookie('session', second.get_cookie('session').value)
+    assert first.get('/get').text == 'again'
+
+
+def test_tampered_cookie_starts_a_new_session(tmp_path):
+    client = _worker(str(tmp_path / 'sessions.db')).test_client()
+    client.get('/set/hello')
+    client.set_cookie('session', client.get_cookie('session').value + 'x')
+    assert client.get('/get').text == ''
+
+
+def test_clearing_the_session_deletes_it(tmp_path):
+    path = str(tmp_path / 'sessions.db')
+    client = _worker(path).test_client()
+    client.get('/set/hello')
+    cookie = client.get_cookie('session').value
+    client.get('/clear')
+    assert SQLiteBackend(path).dbsize() == 0
+    other = _worker(path).test_client()
+    other.set_cookie('session', cookie)
+    assert other.get('/get').text == ''
@@ -0,0 +1,222 @@
+import os
+import re
+import json
+import time
+import random
+import threading
+import contextvars
+from collections import OrderedDict
+
+# Per-request tracing: where a slow fan-out spent its time, model by model. A sampled
+# run records a span for each phase of each model call (resolving the model function,
+# waiting for a dispatcher worker, rate limit waits, getting the pooled client, TCP
+# connect and TLS, sending the request, waiting for the response headers, streaming)
+# plus the first token, and is written out in Chrome's trace event format, one lane per
+# model: open the file (or /debug/trace/<run_id>) in chrome://tracing or
+# https://ui.perfetto.dev. An unsampled run costs one random() call; its calls carry no
+# trace and every hook returns straight away.
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', '0.01'))
+TRACE_DIR = os.getenv('TRACE_DIR', 'traces')
+# Traces kept in memory per process, and files kept in TRACE_DIR
+TRACE_MAX_RUNS = int(os.getenv('TRACE_MAX_RUNS', '100'))
+TRACE_MAX_FILES = int(os.getenv('TRACE_MAX_FILES', '1000'))
+# Spans of calls still ending (e.g. aborted after the run finished) are waited for
+# this long before the file is written
+TRACE_WRITE_DELAY_SECONDS = float(os.getenv('TRACE_WRITE_DELAY_SECONDS', '2'))
+# Bounds a trace's memory whatever happens in it
+TRACE_MAX_EVENTS = 10000
+
+TRACE_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+# The call whose HTTP request is being sent on this thread or task, for the client hooks
+CURRENT_CALL = contextvars.ContextVar('current_call', default=None)
+
+
+class Trace:
+    def __init__(self, trace_id, name):
+        self.trace_id = trace_id
+        self.name = name
+        self.started_at = time.monotonic()
+        self.wall_started_at = time.time()
+        self.finished_at = None
+        self._lock = threading.Lock()
+        self._events = []
+        self._lanes = {}
+        self.dropped = 0
+
+    def _us(self, monotonic):
+        return round((self.wall_started_at + monotonic - self.started_at) * 1e6)
+
+    def _lane_locked(self, lane):
+        tid = self._lanes.get(lane)
+        if tid is None:
+            tid = self._lanes[lane] = len(self._lanes) + 1
+        return tid
+
+    def _add(self, lane, event):
+        with self._lock:
+            if len(self._events) >= TRACE_MAX_EVENTS:
+                self.dropped += 1
+                return
+            event['tid'] = self._lane_locked(lane)
+            self._events.append(event)
+
+    def span(self, lane, name, start, end, **args):
+        # start and end are time.monotonic() values
+        self._add(lane, {'name': name, 'ph': 'X', 'ts': self._us(start),
+                         'dur': max(0, round((end - start) * 1e6)), 'args': args})
+
+    def instant(self, lane, name, at, **args):
+        self._add(lane, {'name': name, 'ph': 'i', 's': 't', 'ts': self._us(at), 'args': args})
+
+    def to_chrome(self):
+        pid = os.getpid()
+        with self._lock:
+            lanes = list(self._lanes.items())
+            events = list(self._events)
+            dropped = self.dropped
+        metadata = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': f"{self.name} {self.trace_id}"}}]
+        metadata += [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': lane}}
+                     for lane, tid in lanes]
+        metadata += [{'name': 'thread_sort_index', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'sort_index': tid}}
+                     for lane, tid in lanes]
+        return {
+            'traceEvents': metadata + [dict(event, pid=pid) for event in events],
+            'displayTimeUnit': 'ms',
+            'otherData': {'trace_id': self.trace_id, 'name': self.name, 'started_at': self.wall_started_at,
+                          'dropped_events': dropped},
+        }
+
+
+class Tracer:
+    def __init__(self, sample_rate=TRACE_SAMPLE_RATE, directory=TRACE_DIR, max_runs=TRACE_MAX_RUNS):
+        self.sample_rate = sample_rate
+        self.directory = directory
+        self.max_runs = max_runs
+        self._lock = threading.Lock()
+        # trace_id -> Trace, oldest first
+        self._traces = OrderedDict()
+        self.sampled = 0
+        self.skipped = 0
+        self.written = 0
+        self.write_errors = 0
+
+    def start(self, trace_id, name, force=False):
+        # A Trace when this run is sampled (or tracing was asked for), else None
+        if not force and (self.sample_rate <= 0 or random.random() >= self.sample_rate):
+            with self._lock:
+                self.skipped += 1
+            return None
+        trace = Trace(trace_id, name)
+        with self._lock:
+            self.sampled += 1
+            self._traces[trace_id] = trace
+            while len(self._traces) > self.max_runs:
+                self._traces.popitem(last=False)
+        return trace
+
+    def finish(self, trace, call_later):
+        trace.finished_at = time.monotonic()
+        trace.span('run', trace.name, trace.started_at, trace.finished_at)
+        call_later(TRACE_WRITE_DELAY_SECONDS, lambda: self.write(trace))
+
+    def _path(self, trace_id):
+        return os.path.join(self.directory, f"{trace_id}.json")
+
+    def write(self, trace):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self._path(trace.trace_id)
+            with open(path + '.tmp', 'w') as f:
+                json.dump(trace.to_chrome(), f)
+            os.replace(path + '.tmp', path)
+            with self._lock:
+                self.written += 1
+                prune = self.written % 50 == 0
+            if prune:
+                self._prune()
+        except OSError:
+            with self._lock:
+                self.write_errors += 1
+
+    def _prune(self):
+        # Oldest files first once there are too many
+        paths = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith('.json')]
+        if len(paths) <= TRACE_MAX_FILES:
+            return
+        paths.sort(key=os.path.getmtime)
+        for path in paths[:len(paths) - TRACE_MAX_FILES]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def get(self, trace_id):
+        # Chrome trace JSON of a recent trace, from memory or from its file; None if unknown
+        if not TRACE_ID_PATTERN.match(trace_id):
+            return None
+        with self._lock:
+            trace = self._traces.get(trace_id)
+        if trace is not None:
+            return trace.to_chrome()
+        try:
+            with open(self._path(trace_id)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def stats(self):
+        with self._lock:
+            return {
+                'sample_rate': self.sample_rate,
+                'directory': self.directory,
+                'sampled': self.sampled,
+                'skipped': self.skipped,
+                'in_memory': len(self._traces),
+                'written': self.written,
+                'write_errors': self.write_errors,
+                'recent': list(self._traces)[-20:],
+            }
+
+
+def queued(fn, call):
+    # fn, noting when it leaves the pool's queue and starts running (the time to first
+    # token is counted from there) and, when traced, how long it waited
+    submitted_at = time.monotonic()
+    def run(*args, **kwargs):
+        call.mark_running()
+        call.span('queued', submitted_at)
+        return fn(*args, **kwargs)
+    return run
+
+
+def _connection_events(call):
+    # httpcore reports "<phase>.started" and "<phase>.complete" (or ".failed") for TCP
+    # connect, TLS, sending headers and body, and receiving headers and body
+    started = {}
+    def record(name, info):
+        phase, _, state = name.rpartition('.')
+        if state == 'started':
+            started[phase] = time.monotonic()
+        elif phase in started:
+            call.span(phase.split('.', 1)[-1], started.pop(phase), failed=state == 'failed')
+    return record
+
+
+def httpx_request_hook(request):
+    call = CURRENT_CALL.get()
+    if call is not None and call.trace is not None:
+        request.extensions['trace'] = _connection_events(call)
+
+
+async def async_httpx_request_hook(request):
+    call = CURRENT_CALL.get()
+    if call is not None and call.trace is not None:
+        record = _connection_events(call)
+        async def trace(name, info):
+            record(name, info)
+        request.extensions['trace'] = trace
+
+
+# Shared by every request handled by this process
+TRACER = Tracer()
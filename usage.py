@@ -0,0 +1,240 @@
+import os
+import time
+import threading
+
+from client_pool import credential_fingerprint
+from model_registry import MODEL_SPECS, MODEL_NAMES
+from rate_limits import error_status, error_headers, retry_after_seconds
+
+# Usage ledger: requests and prompt/completion tokens per (API key fingerprint, provider,
+# model) over the last minute and the last day, so we know how close each key is to its
+# quotas before the provider starts rejecting it. Fan-outs skip a model whose key has
+# (nearly) used up a quota and report it as 'quota' instead of sending a request that
+# would come back 429, and fastest_k ranks models close to a quota last.
+#
+# Quotas are per key and model. They are set per provider or per model in the
+# environment, e.g. USAGE_QUOTA_GITHUB="rpm=15,rpd=150" and USAGE_QUOTA_O3="rpm=1,rpd=8"
+# (rpm/rpd: requests per minute/day, tpm/tpd: tokens per minute/day). A 429 asking us to
+# come back after more than USAGE_EXHAUSTED_AFTER_SECONDS is taken to mean a quota ran
+# out, and the model is skipped for that key until then, configured or not.
+USAGE_QUOTA_HEADROOM = float(os.getenv('USAGE_QUOTA_HEADROOM', '0.05'))
+# Share of a quota used from which fastest_k ranks the model after the others
+USAGE_DEPRIORITIZE_AT = float(os.getenv('USAGE_DEPRIORITIZE_AT', '0.8'))
+USAGE_EXHAUSTED_AFTER_SECONDS = float(os.getenv('USAGE_EXHAUSTED_AFTER_SECONDS', '120'))
+
+# Window name -> (seconds, slots)
+WINDOWS = {'minute': (60, 12), 'day': (24 * 3600, 96)}
+# Quota name -> (window, counted)
+QUOTAS = {
+    'rpm': ('minute', 'requests'),
+    'rpd': ('day', 'requests'),
+    'tpm': ('minute', 'tokens'),
+    'tpd': ('day', 'tokens'),
+}
+
+REQUESTS, PROMPT_TOKENS, COMPLETION_TOKENS = range(3)
+
+# The ledger is told about calls by spec (probes use a copy of the model's spec)
+_MODEL_IDS = {(spec['provider'], spec['model_name']): model_id for model_id, spec in MODEL_SPECS.items()}
+
+
+def parse_quota(value):
+    # "rpm=15,rpd=150" -> {'rpm': 15, 'rpd': 150}; unreadable entries are ignored
+    quota = {}
+    for item in (value or '').split(','):
+        name, _, number = item.strip().partition('=')
+        if name in QUOTAS and number.strip().isdigit() and int(number) > 0:
+            quota[name] = int(number)
+    return quota
+
+
+def load_quotas():
+    quotas = {}
+    for model_id, spec in MODEL_SPECS.items():
+        quota = parse_quota(os.getenv(f"USAGE_QUOTA_{spec['provider'].upper()}"))
+        quota.update(parse_quota(os.getenv(f"USAGE_QUOTA_{model_id.upper()}")))
+        quotas[model_id] = quota
+    return quotas
+
+
+class RollingWindow:
+    # Counts over the last `span` seconds in fixed slots: a slot is reused once it is a
+    # whole span old, so memory stays constant and a read is one pass over the slots
+    def __init__(self, span, slots):
+        self.span = span
+        self.slots = slots
+        self.slot_seconds = span / slots
+        self._epochs = [-1] * slots
+        self._counts = [[0] * slots for _ in range(3)]
+
+    def add(self, now, counts):
+        epoch = int(now // self.slot_seconds)
+        index = epoch % self.slots
+        if self._epochs[index] != epoch:
+            self._epochs[index] = epoch
+            for values in self._counts:
+                values[index] = 0
+        for values, count in zip(self._counts, counts):
+            values[index] += count
+
+    def _live(self, now):
+        # (epoch, index) of the slots still inside the window, oldest first
+        oldest = int(now // self.slot_seconds) - self.slots + 1
+        return sorted((epoch, index) for index, epoch in enumerate(self._epochs) if epoch >= oldest)
+
+    def totals(self, now):
+        live = self._live(now)
+        return [sum(values[index] for _, index in live) for values in self._counts]
+
+    def room_in(self, now, fields, limit):
+        # Seconds until the sum of `fields` drops below `limit` as old slots expire
+        live = self._live(now)
+        used = sum(self._counts[field][index] for field in fields for _, index in live)
+        wait = 0.0
+        for epoch, index in live:
+            if used < limit:
+                break
+            used -= sum(self._counts[field][index] for field in fields)
+            wait = (epoch + self.slots) * self.slot_seconds - now
+        return max(0.0, wait)
+
+
+class UsageEntry:
+    def __init__(self):
+        self.windows = {name: RollingWindow(span, slots) for name, (span, slots) in WINDOWS.items()}
+        self.totals = [0, 0, 0]
+        self.rejected = 0
+        self.last_used_at = None
+        # Wall time until which the provider told us the quota is gone
+        self.exhausted_until = 0.0
+
+
+class UsageLedger:
+    def __init__(self, quotas=None, headroom=USAGE_QUOTA_HEADROOM):
+        self.quotas = load_quotas() if quotas is None else quotas
+        self.headroom = headroom
+        self._lock = threading.Lock()
+        # (credential fingerprint, provider, model_id) -> UsageEntry
+        self._entries = {}
+
+    def _entry_locked(self, fingerprint, provider, model_id):
+        key = (fingerprint, provider, model_id)
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = UsageEntry()
+        return entry
+
+    def record(self, spec, credential, prompt_tokens, completion_tokens, error=None):
+        # One request that reached the provider. A 429 is not counted against the quota;
+        # one that sends us away for long enough marks the quota as used up.
+        model_id = _MODEL_IDS.get((spec['provider'], spec['model_name']))
+        if model_id is None:
+            return
+        now = time.time()
+        fingerprint = credential_fingerprint(credential)
+        with self._lock:
+            entry = self._entry_locked(fingerprint, spec['provider'], model_id)
+            if error is not None and error_status(error) == 429:
+                entry.rejected += 1
+                retry_after = retry_after_seconds(error_headers(error))
+                if retry_after is not None and retry_after > USAGE_EXHAUSTED_AFTER_SECONDS:
+                    entry.exhausted_until = max(entry.exhausted_until, now + retry_after)
+                return
+            counts = (1, prompt_tokens or 0, completion_tokens or 0)
+            for window in entry.windows.values():
+                window.add(now, counts)
+            entry.totals = [total + count for total, count in zip(entry.totals, counts)]
+            entry.last_used_at = now
+
+    def _quota_state_locked(self, entry, model_id, now):
+        # {quota: (used, limit, seconds until there is room)}
+        state = {}
+        for name, limit in self.quotas.get(model_id, {}).items():
+            window_name, counted = QUOTAS[name]
+            fields = (REQUESTS,) if counted == 'requests' else (PROMPT_TOKENS, COMPLETION_TOKENS)
+            window = entry.windows[window_name] if entry is not None else None
+            totals = window.totals(now) if window is not None else [0, 0, 0]
+            used = sum(totals[field] for field in fields)
+            # Stop short of the limit by the headroom: other processes use the key too
+            usable = limit * (1 - self.headroom)
+            wait = window.room_in(now, fields, usable) if window is not None and used >= usable else None
+            state[name] = (used, limit, wait)
+        return state
+
+    def quota_wait(self, model_id, credential):
+        # None when the key has room for another call to the model, else the seconds
+        # until it will
+        now = time.time()
+        key = (credential_fingerprint(credential), MODEL_SPECS[model_id]['provider'], model_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            waits = [wait for _, _, wait in self._quota_state_locked(entry, model_id, now).values() if wait is not None]
+            if entry.exhausted_until > now:
+                waits.append(entry.exhausted_until - now)
+        wait = max(waits, default=0.0)
+        # No wait left (a slot expiring right now) is room, not a quota to report
+        return wait if wait > 0 else None
+
+    def pressure(self, model_id, credential):
+        # Largest share of any quota the key has used for the model, 0.0 without quotas
+        now = time.time()
+        key = (credential_fingerprint(credential), MODEL_SPECS[model_id]['provider'], model_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return 0.0
+            if entry.exhausted_until > now:
+                return 1.0
+            state = self._quota_state_locked(entry, model_id, now)
+        return max((used / limit for used, limit, _ in state.values()), default=0.0)
+
+    def quota_message(self, model_id, credential):
+        wait = self.quota_wait(model_id, credential) or 0.0
+        return f"{MODEL_NAMES[model_id]} is close to the API key's quota; room again in {wait:.0f}s"
+
+    def report(self, fingerprints=None):
+        # One row per key, provider and model; only the given keys' when fingerprints is set
+        now = time.time()
+        rows = []
+        with self._lock:
+            for (fingerprint, provider, model_id), entry in self._entries.items():
+                if fingerprints is not None and fingerprint not in fingerprints:
+                    continue
+                state = self._quota_state_locked(entry, model_id, now)
+                row = {
+                    'credential': fingerprint,
+                    'provider': provider,
+                    'model_id': model_id,
+                    'model_name': MODEL_NAMES[model_id],
+                    'requests': entry.totals[REQUESTS],
+                    'prompt_tokens': entry.totals[PROMPT_TOKENS],
+                    'completion_tokens': entry.totals[COMPLETION_TOKENS],
+                    'rejected': entry.rejected,
+                    'last_used_at': entry.last_used_at,
+                    'exhausted_for_seconds': round(max(0.0, entry.exhausted_until - now), 1),
+                    'quotas': {name: {'used': used, 'limit': limit,
+                                      'room_in_seconds': round(wait, 1) if wait is not None else None}
+                               for name, (used, limit, wait) in state.items()},
+                }
+                for name, window in entry.windows.items():
+                    requests, prompt_tokens, completion_tokens = window.totals(now)
+                    row[name] = {'requests': requests, 'prompt_tokens': prompt_tokens,
+                                 'completion_tokens': completion_tokens}
+                rows.append(row)
+        return rows
+
+    def stats(self):
+        with self._lock:
+            keys = {fingerprint for fingerprint, _, _ in self._entries}
+            return {
+                'entries': len(self._entries),
+                'credentials': len(keys),
+                'headroom': self.headroom,
+                'quotas': {model_id: quota for model_id, quota in self.quotas.items() if quota},
+            }
+
+
+# Shared by every request handled by this process
+USAGE = UsageLedger()